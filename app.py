@@ -1,23 +1,550 @@
-from flask import Flask, jsonify, redirect, request
-from flask_pydantic_spec import FlaskPydanticSpec
-from datetime import date
+import csv
+import io
+import os
+import threading
+import time
+
+from flask import Blueprint, Flask, current_app, jsonify, redirect, request, Response, stream_with_context, url_for, g
+from datetime import date, timedelta
 from dateutil.relativedelta import relativedelta
 from werkzeug.exceptions import BadRequest
 
-from models import local_session, Livro, Emprestimo, Usuario
+from models import local_session, Livro, Emprestimo, Usuario, Estatistica, EstatisticaUsuario, Mudanca
+from migracoes import aplicar_migracoes
+from busca import montar_consulta_fts, sql_busca_livros, reconstruir_indice_busca
+from estatisticas import CHAVES as CHAVES_ESTATISTICAS, reconciliar_estatisticas
+from database import engine, engine_leitura, sessao_leitura, estatisticas_pool, PoolTimeoutError
+from cache import cache_entidades
+from metricas import metricas, instalar as instalar_metricas
+from compressao import instalar as instalar_compressao
+from atrasos import varrer_atrasos, marcar_reservas_iniciadas, iniciar_agendador, expressao_multa, INTERVALO_VARREDURA
+from mudancas import compactar_mudancas
+from disponibilidade import sql_periodos, buscar_conflito, proxima_data_livre, periodos_livres
+from openapi import SpecEmCache
+from escrita import FilaEscrita, ATIVA as FILA_ESCRITA_ATIVA
 # from flask_sqlalchemy import SQLAlchemy
 # import sqlalchemy
 # from sqlalchemy.exc import IntegrityError
-from sqlalchemy import select
+from sqlalchemy import select, insert, update, literal, Date, Boolean, or_, func, case, type_coerce
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import contains_eager
+
+# rotas da API; registradas no app criado por create_app
+rotas = Blueprint('api', __name__, cli_group=None)
+
+CONFIG_PADRAO = {
+    'SECRET_KEY': 'chave_secreta',
+    # aplica as migrações pendentes antes da primeira requisição do processo
+    'APLICAR_MIGRACOES': True,
+    # documento OpenAPI gerado (ver openapi.py); None desliga o cache em disco
+    'OPENAPI_CACHE': os.path.join(os.path.dirname(os.path.abspath(__file__)), 'openapi_cache.json'),
+    # cadastros pela fila de escrita com group commit (escrita.py)
+    'FILA_ESCRITA': FILA_ESCRITA_ATIVA,
+    # invalida no cache por id o que outros processos gravaram (log de mudanças)
+    'CACHE_ENTRE_PROCESSOS': os.environ.get('CACHE_ENTRE_PROCESSOS', '1') not in ('0', 'false', 'False'),
+}
+
+
+def create_app(config=None):
+    """
+        Cria a aplicação Flask.
+
+        Nada aqui acessa o banco: as engines e sessões (database.py) são
+        criadas no primeiro uso, as migrações rodam antes da primeira
+        requisição e o documento OpenAPI é gerado no primeiro acesso (ou
+        lido do cache em disco). O tempo gasto fica em
+        `app.config['TEMPO_CRIACAO']` e no `/metrics`.
+    """
+    inicio = time.perf_counter()
+    app = Flask(__name__)
+    app.config.update(CONFIG_PADRAO)
+    if config:
+        app.config.update(config)
+
+    spec = SpecEmCache('Flask',
+                       title='Flask API',
+                       version='1.0.0',
+                       caminho_cache=app.config['OPENAPI_CACHE'])
+    spec.register(app)
+    app.extensions['openapi'] = spec
+    app.register_blueprint(rotas)
+    app.teardown_appcontext(fechar_sessao)
+    if app.config['FILA_ESCRITA']:
+        app.extensions['fila_escrita'] = FilaEscrita()
+    instalar_metricas(app)
+    instalar_compressao(app)
+
+    app.config['TEMPO_CRIACAO'] = time.perf_counter() - inicio
+    return app
+
+
+_migracoes_aplicadas = False
+_lock_migracoes = threading.Lock()
+
+
+def garantir_migracoes():
+    """
+        Aplica as migrações pendentes uma vez por processo.
+    """
+    global _migracoes_aplicadas
+    if not _migracoes_aplicadas:
+        with _lock_migracoes:
+            if not _migracoes_aplicadas:
+                aplicar_migracoes()
+                _migracoes_aplicadas = True
+
+
+@rotas.before_app_request
+def preparar_banco():
+    if current_app.config['APLICAR_MIGRACOES']:
+        garantir_migracoes()
+
+
+@rotas.app_errorhandler(PoolTimeoutError)
+def banco_ocupado(e):
+    # nenhuma conexão livre no pool dentro do DATABASE_POOL_TIMEOUT (ex.: o
+    # escritor único ocupado): é falta de capacidade, não erro do cliente
+    return jsonify({'error': 'Banco de dados ocupado, tente novamente'}), 503, {'Retry-After': '1'}
+
+
+# métodos atendidos pela engine de leitura (database.engine_leitura)
+METODOS_LEITURA = ('GET', 'HEAD', 'OPTIONS')
+
+
+def usar_engine(tipo):
+    """
+        Decorator que fixa a engine da view (`'leitura'` ou `'escrita'`),
+        para rotas em que o método HTTP não indica o que ela faz
+        (ex.: POST que só consulta).
+    """
+    if tipo not in ('leitura', 'escrita'):
+        raise ValueError(f'Engine desconhecida: {tipo}')
 
-app = Flask(__name__)
-spec = FlaskPydanticSpec('Flask',
-                         title='Flask API',
-                         version='1.0.0')
-spec.register(app)
-app.secret_key = 'chave_secreta'
+    def decorator(view):
+        view.engine_sessao = tipo
+        return view
+    return decorator
+
+
+def tipo_engine_requisicao():
+    view = current_app.view_functions.get(request.endpoint)
+    tipo = getattr(view, 'engine_sessao', None)
+    if tipo is None:
+        tipo = 'leitura' if request.method in METODOS_LEITURA else 'escrita'
+    return tipo
+
+
+def obter_sessao():
+    """
+        Sessão do banco da requisição atual.
+
+        É criada no primeiro uso e fechada no teardown do Flask, então as
+        views não precisam abrir nem fechar sessões. Requisições GET usam a
+        engine de leitura (pool maior, somente leitura) e as demais a de
+        escrita; `usar_engine` muda isso por rota.
+    """
+    if 'db_session' not in g:
+        if tipo_engine_requisicao() == 'leitura':
+            g.db_session = sessao_leitura()
+        else:
+            g.db_session = local_session()
+    return g.db_session
+
+
+def executar_escrita(operacao):
+    """
+        Executa `operacao(db_session)` e grava (commit).
+
+        Com `FILA_ESCRITA` a operação vai para a fila de escrita e divide a
+        transação com as de outras requisições; sem ela roda na sessão da
+        requisição. Nos dois casos um erro desfaz só esta operação e é
+        levantado aqui.
+    """
+    fila = current_app.extensions.get('fila_escrita')
+    if fila is not None:
+        return fila.executar(operacao)
+    db_session = obter_sessao()
+    try:
+        resultado = operacao(db_session)
+        db_session.commit()
+    except Exception:
+        db_session.rollback()
+        raise
+    return resultado
+
+
+def fechar_sessao(exc):
+    db_session = g.pop('db_session', None)
+    if db_session is not None:
+        if exc is not None:
+            db_session.rollback()
+        db_session.close()
 
-@app.route('/')
+
+# último seq do log de mudanças já aplicado ao cache deste processo
+_seq_cache = None
+_lock_seq_cache = threading.Lock()
+# acima disso é mais barato esvaziar o cache do que invalidar um a um
+LIMITE_SINCRONIA_CACHE = 1000
+
+
+def sincronizar_cache():
+    """
+        Invalida no cache por id os registros gravados por outros processos.
+
+        Cada worker do servidor (servidor.py) e cada comando da CLI tem o seu
+        cache e só invalida o que ele mesmo gravou. Antes de ler do cache, a
+        requisição lê o log de mudanças (mudancas.py) a partir do último seq
+        já aplicado, na mesma transação das consultas seguintes; é uma busca
+        pela chave primária que quase sempre volta vazia. Roda uma vez por
+        requisição.
+    """
+    global _seq_cache
+    if not current_app.config['CACHE_ENTRE_PROCESSOS'] or not cache_entidades.ativo or g.get('cache_sincronizado'):
+        return
+    g.cache_sincronizado = True
+    db_session = obter_sessao()
+    seq = _seq_cache
+    if seq is None:
+        # processo novo: o cache está vazio, basta começar do fim do log
+        atual = db_session.execute(select(func.coalesce(func.max(Mudanca.seq), 0))).scalar()
+        with _lock_seq_cache:
+            if _seq_cache is None:
+                cache_entidades.limpar()
+                _seq_cache = atual
+        return
+    mudancas = db_session.execute(
+        select(Mudanca.seq, Mudanca.entidade, Mudanca.id_entidade).where(Mudanca.seq > seq)
+        .order_by(Mudanca.seq).limit(LIMITE_SINCRONIA_CACHE + 1)).all()
+    if not mudancas:
+        return
+    if len(mudancas) > LIMITE_SINCRONIA_CACHE:
+        ultimo = db_session.execute(select(func.max(Mudanca.seq))).scalar()
+        cache_entidades.limpar()
+    else:
+        ultimo = mudancas[-1].seq
+        por_entidade = {}
+        for mudanca in mudancas:
+            por_entidade.setdefault(mudanca.entidade, []).append(mudanca.id_entidade)
+        for entidade, ids in por_entidade.items():
+            cache_entidades.invalidar(entidade, *ids)
+    with _lock_seq_cache:
+        _seq_cache = max(_seq_cache, ultimo)
+
+
+# paginacao por cursor (keyset) das listagens
+LIMITE_PADRAO = 50
+LIMITE_MAXIMO = 1000
+# quantidade de linhas buscadas por vez no modo streaming
+YIELD_PER = 500
+
+
+def ler_paginacao():
+    """
+        Lê os parâmetros `limit` e `after` da query string.
+
+        Retorna `(None, None)` quando nenhum dos dois foi enviado, indicando
+        que a listagem deve ser enviada inteira em modo streaming.
+    """
+    limit = request.args.get('limit')
+    after = request.args.get('after')
+    if limit is None and after is None:
+        return None, None
+    try:
+        limit = int(limit) if limit is not None else LIMITE_PADRAO
+        after = int(after) if after is not None else 0
+    except ValueError:
+        raise BadRequest('Parâmetros limit e after devem ser inteiros')
+    if limit < 1 or limit > LIMITE_MAXIMO:
+        raise BadRequest(f'Parâmetro limit deve estar entre 1 e {LIMITE_MAXIMO}')
+    return limit, after
+
+
+EXPAND_VALIDOS = ('livro', 'usuario')
+
+
+def ler_expand():
+    """
+        Lê o parâmetro `expand` (ex.: `?expand=livro,usuario`) da query string.
+    """
+    expand = request.args.get('expand')
+    if not expand:
+        return ()
+    itens = tuple(item.strip() for item in expand.split(',') if item.strip())
+    for item in itens:
+        if item not in EXPAND_VALIDOS:
+            raise BadRequest(f'Valor inválido para expand: {item}')
+    return itens
+
+
+def sql_emprestimos(expand=()):
+    """
+        SELECT de emprestimos com JOIN em livro e usuario.
+
+        As relações pedidas em `expand` são preenchidas pelo mesmo JOIN
+        (`contains_eager`), então tudo vem em uma única consulta.
+    """
+    sql = select(Emprestimo).join(
+        Livro, Emprestimo.livro_relacao).join(
+        Usuario, Emprestimo.usuario_relacao)
+    if 'livro' in expand:
+        sql = sql.options(contains_eager(Emprestimo.livro_relacao))
+    if 'usuario' in expand:
+        sql = sql.options(contains_eager(Emprestimo.usuario_relacao))
+    return sql
+
+
+# formato colunar das listagens: {"columns": [...], "rows": [[...], ...]}
+MIMETYPE_COLUNAS = 'application/vnd.bancoapi.colunas+json'
+FORMATOS_LISTAGEM = ('json', 'colunas')
+
+
+def ler_formato():
+    """
+        Formato da listagem: parâmetro `formato` (`json` ou `colunas`) ou, sem
+        ele, o `Accept` (`application/vnd.bancoapi.colunas+json`).
+    """
+    formato = request.args.get('formato')
+    if formato is not None:
+        if formato not in FORMATOS_LISTAGEM:
+            raise BadRequest('Parâmetro formato deve ser json ou colunas')
+        return formato
+    melhor = request.accept_mimetypes.best_match(['application/json', MIMETYPE_COLUNAS])
+    return 'colunas' if melhor == MIMETYPE_COLUNAS else 'json'
+
+
+def resposta_lista(result, **extras):
+    """
+        `{"result": [...]}` ou, no formato colunar, os nomes das colunas uma
+        vez só e cada registro como lista de valores. `extras` (ex.: `next`)
+        vão no mesmo nível nos dois formatos.
+    """
+    if ler_formato() != 'colunas':
+        resposta = jsonify({'result': result, **extras})
+    else:
+        colunas = list(result[0]) if result else []
+        resposta = jsonify({'columns': colunas, 'rows': [list(registro.values()) for registro in result], **extras})
+        resposta.mimetype = MIMETYPE_COLUNAS
+    resposta.vary.add('Accept')
+    return resposta
+
+
+def ler_campos(modelo):
+    """
+        Lê o parâmetro `fields` (ex.: `?fields=id_livro,titulo`) da query string.
+
+        Retorna a lista de colunas de `modelo` pedidas ou `None` se o
+        parâmetro não foi enviado.
+    """
+    fields = request.args.get('fields')
+    if not fields:
+        return None
+    colunas = modelo.__mapper__.columns
+    nomes = [nome.strip() for nome in fields.split(',') if nome.strip()]
+    for nome in nomes:
+        if nome not in colunas:
+            raise BadRequest(f'Campo inválido: {nome}')
+    return [colunas[nome] for nome in nomes]
+
+
+def valor_json(valor):
+    if isinstance(valor, date):
+        return valor.isoformat()
+    return valor
+
+
+def projetar(sql, colunas, coluna_id):
+    """
+        Troca a entidade do SELECT só pelas colunas pedidas.
+
+        As linhas voltam como tuplas e viram dicionários direto, sem criar
+        objetos do ORM nem passar pelo identity map. A chave primária é
+        sempre selecionada porque é o cursor da paginação.
+    """
+    nomes = [coluna.key for coluna in colunas]
+    extras = [] if coluna_id.key in nomes else [coluna_id]
+    sql = sql.with_only_columns(*colunas, *extras, maintain_column_froms=True)
+
+    def serializar(linha):
+        return {nome: valor_json(valor) for nome, valor in zip(nomes, linha)}
+
+    return sql, serializar
+
+
+def responder_listagem(db_session, sql, coluna_id, serializar, ids=None):
+    """
+        Resposta padrão das listagens: aplica `fields` e escolhe entre a
+        busca por lista de ids (`ids`), a página por cursor (`limit`/`after`)
+        e o streaming da lista completa.
+    """
+    escalar = True
+    # o cache só vale para o SELECT sem filtros (ex.: /livros/status<status> filtra)
+    usar_cache = not request.args.get('expand') and not request.view_args
+    colunas = ler_campos(coluna_id.class_)
+    if colunas is not None:
+        if request.args.get('expand'):
+            raise BadRequest('Parâmetros fields e expand não podem ser usados juntos')
+        sql, serializar = projetar(sql, colunas, coluna_id)
+        escalar = False
+        usar_cache = False
+
+    if ids is None and request.args.get('ids'):
+        ids = request.args.get('ids').split(',')
+    if ids is not None:
+        return resposta_lote(db_session, sql, coluna_id, serializar, ler_ids(ids), escalar, usar_cache)
+
+    limit, after = ler_paginacao()
+    if limit is None:
+        return resposta_streaming(sql, coluna_id, serializar, escalar)
+    return resposta_paginada(db_session, sql, coluna_id, serializar, limit, after, escalar)
+
+
+# busca por lista de ids
+LIMITE_IDS = 5000
+# ids por consulta IN, abaixo do limite de variáveis do SQLite (999 nas versões antigas)
+TAMANHO_LOTE_IN = 900
+
+
+def em_lotes(ids, tamanho=TAMANHO_LOTE_IN):
+    ids = list(ids)
+    for inicio in range(0, len(ids), tamanho):
+        yield ids[inicio:inicio + tamanho]
+
+
+def ler_ids(valores):
+    """
+        Converte a lista de ids recebida em inteiros, sem repetições e na ordem recebida.
+    """
+    if not isinstance(valores, list):
+        raise BadRequest('Esperada uma lista de ids')
+    ids = []
+    vistos = set()
+    for valor in valores:
+        if isinstance(valor, str):
+            valor = valor.strip()
+            if not valor:
+                continue
+        try:
+            id = int(valor)
+        except (TypeError, ValueError):
+            raise BadRequest(f'Id inválido: {valor}')
+        if id not in vistos:
+            vistos.add(id)
+            ids.append(id)
+    if not ids:
+        raise BadRequest('Nenhum id informado')
+    if len(ids) > LIMITE_IDS:
+        raise BadRequest(f'Máximo de {LIMITE_IDS} ids por requisição')
+    return ids
+
+
+def resposta_lote(db_session, sql, coluna_id, serializar, ids, escalar=True, usar_cache=True):
+    """
+        Busca vários registros por chave primária com consultas `IN`.
+
+        Os ids já presentes no cache por id não vão ao banco; os demais são
+        buscados em lotes de `TAMANHO_LOTE_IN`. Retorna os registros com o id
+        como chave e a lista dos ids não encontrados.
+    """
+    entidade = coluna_id.class_.__tablename__
+    encontrados = {}
+    faltando = ids
+    if usar_cache:
+        sincronizar_cache()
+    geracao = cache_entidades.geracao()
+    if usar_cache:
+        faltando = []
+        for id in ids:
+            dados = cache_entidades.get(entidade, id)
+            if dados is None:
+                faltando.append(id)
+            else:
+                encontrados[id] = dados
+
+    for inicio in range(0, len(faltando), TAMANHO_LOTE_IN):
+        lote = faltando[inicio:inicio + TAMANHO_LOTE_IN]
+        linhas = db_session.execute(sql.where(coluna_id.in_(lote)))
+        for linha in (linhas.scalars() if escalar else linhas):
+            id = getattr(linha, coluna_id.key)
+            encontrados[id] = serializar(linha)
+            if usar_cache:
+                cache_entidades.set(entidade, id, encontrados[id], geracao)
+
+    nao_encontrados = [id for id in ids if id not in encontrados]
+    if ler_formato() == 'colunas':
+        # as linhas seguem a ordem dos ids enviados
+        return resposta_lista([encontrados[id] for id in ids if id in encontrados],
+                              nao_encontrados=nao_encontrados)
+    return jsonify({
+        'result': {str(id): encontrados[id] for id in ids if id in encontrados},
+        'nao_encontrados': nao_encontrados,
+    })
+
+
+def resposta_paginada(db_session, sql, coluna_id, serializar, limit, after, escalar=True):
+    """
+        Executa `sql` paginado por cursor na coluna `coluna_id` (chave primária).
+
+        Busca `limit + 1` linhas a partir de `after` para saber se existe
+        uma próxima página sem precisar de um COUNT.
+    """
+    sql = sql.where(coluna_id > after).order_by(coluna_id).limit(limit + 1)
+    linhas = db_session.execute(sql)
+    linhas = linhas.scalars().all() if escalar else linhas.all()
+
+    proximo_cursor = None
+    if len(linhas) > limit:
+        linhas = linhas[:limit]
+        proximo_cursor = getattr(linhas[-1], coluna_id.key)
+
+    result = [serializar(linha) for linha in linhas]
+    proximo = None
+    if proximo_cursor is not None:
+        args = request.args.to_dict()
+        args.update({'limit': limit, 'after': proximo_cursor})
+        proximo = url_for(request.endpoint, **(request.view_args or {}), **args)
+
+    return resposta_lista(result, next_cursor=proximo_cursor, next=proximo)
+
+
+def resposta_streaming(sql, coluna_id, serializar, escalar=True, **extras):
+    """
+        Envia a listagem completa como um array JSON gerado aos poucos.
+
+        As linhas são buscadas com `yield_per`, então a lista inteira nunca
+        fica em memória. Com `stream_with_context` o contexto da requisição
+        (e a sessão dela) só é encerrado quando o gerador termina. `extras`
+        (ex.: `seq`) vão no objeto antes da lista.
+    """
+    sql = sql.order_by(coluna_id).execution_options(yield_per=YIELD_PER)
+    colunar = ler_formato() == 'colunas'
+    inicio = '{' + ''.join('{}: {}, '.format(current_app.json.dumps(chave), current_app.json.dumps(valor))
+                           for chave, valor in extras.items())
+
+    def gerar():
+        db_session = obter_sessao()
+        linhas = db_session.execute(sql)
+        primeiro = True
+        for linha in (linhas.scalars() if escalar else linhas):
+            dados = serializar(linha)
+            if primeiro:
+                # no formato colunar os nomes saem do primeiro registro
+                yield inicio + ('"columns": %s, "rows": [' % current_app.json.dumps(list(dados)) if colunar else '"result": [')
+                primeiro = False
+            else:
+                yield ','
+            yield current_app.json.dumps(list(dados.values()) if colunar else dados)
+        if primeiro:
+            yield inicio + ('"columns": [], "rows": []}' if colunar else '"result": []}')
+        else:
+            yield ']}'
+
+    resposta = Response(stream_with_context(gerar()), mimetype=MIMETYPE_COLUNAS if colunar else 'application/json')
+    resposta.vary.add('Accept')
+    return resposta
+
+
+@rotas.route('/')
 def index():
     """
         API para gerenciar uma biblioteca integrada a um banco de dados
@@ -26,8 +553,8 @@ def index():
     # return redirect('/livros')
     return 'texto' 
 
-@app.route('/livros', methods=['GET']) # Qualquer um
-@app.route('/livros/status<status>', methods=['GET']) # Qualquer um
+@rotas.route('/livros', methods=['GET']) # Qualquer um
+@rotas.route('/livros/status<status>', methods=['GET']) # Qualquer um
 def get_livros(status=None):
     """
         Consultar livros
@@ -35,9 +562,17 @@ def get_livros(status=None):
         ### Endpoint:
             GET /livros
             GET /livros/<status>
+            GET /livros?limit=<limit>&after=<id_livro>
 
         ### Parâmetros:
         - `status` **(str)**: **string para ser convertida a boolean**
+        - `limit` **(int)**: quantidade de livros por página (opcional)
+        - `after` **(int)**: cursor, `id_livro` do último livro da página anterior (opcional)
+        - `fields` **(str)**: colunas retornadas, ex.: `id_livro,titulo` (opcional)
+        - `ids` **(str)**: lista de `id_livro` separados por vírgula, ex.: `1,2,3` (opcional)
+        - `formato` **(str)**: `json` (padrão) ou `colunas`, também escolhido pelo `Accept` (opcional)
+
+        Sem `limit`/`after` a lista completa é enviada em streaming.
 
         ### Erros possíveis:
         - **Bad Request**: *status code* **400**
@@ -45,8 +580,11 @@ def get_livros(status=None):
         ### Retorna:
         - **JSON** com a lista de livros e dados
         - **JSON** com a lista de livros e dados que possuam o `status` igual ao recebido de parâmetro
+        - Paginado: **JSON** com `result`, `next_cursor` e `next` (link da próxima página)
+        - Com `ids`: **JSON** com `result` (registros por id) e `nao_encontrados`
+        - Com `formato=colunas`: **JSON** com `columns` (nomes) e `rows` (valores de cada registro)
     """
-    db_session = local_session()
+    db_session = obter_sessao()
 
     try:
         if status is None:
@@ -61,20 +599,13 @@ def get_livros(status=None):
 
             lista_livros_sql = select(Livro).where(Livro.status_emprestado == status_emprestimo)
 
-        lista_livros = db_session.execute(lista_livros_sql).scalars()
-        result = []
-        for livro in lista_livros:
-            result.append(livro.serialize_livro())
-
-        return jsonify({'result': result})
+        return responder_listagem(db_session, lista_livros_sql, Livro.id_livro, Livro.serialize_livro)
     except Exception as e:
         return jsonify({'error': f'{e}'}), 400
-    finally:
-        db_session.close()
 
-@app.route('/livros/livro_ativo<status_livro_ativo>', methods=['GET'])
+@rotas.route('/livros/livro_ativo<status_livro_ativo>', methods=['GET'])
 def get_livros_by_livro_ativo(status_livro_ativo):
-    db_session = local_session()
+    db_session = obter_sessao()
     try:
         if status_livro_ativo in ['1', 1, 'True', True]:
             status = True
@@ -87,93 +618,198 @@ def get_livros_by_livro_ativo(status_livro_ativo):
         lista = []
         for l in livros:
             lista.append(l.serialize_livro())
-        return jsonify({'result': lista})
+        return resposta_lista(lista)
     except Exception as e:
         return jsonify({'error': f'{e}'}), 400
-    finally:
-        db_session.close()
 
-@app.route('/livros/id<id_livro>', methods=['GET']) # DOCUMENTACAO !!!
+@rotas.route('/livros/busca', methods=['GET']) # Qualquer um
+def get_livros_busca():
+    """
+        Buscar livros por titulo, autor e descricao
+
+        ### Endpoint:
+            GET /livros/busca?q=<texto>&limit=<limit>&offset=<offset>
+
+        ### Parâmetros:
+        - `q` **(str)**: palavras buscadas; cada uma casa também como prefixo
+        - `limit` **(int)**: quantidade de livros por página (padrão: 20)
+        - `offset` **(int)**: quantidade de resultados a pular (padrão: 0)
+        - `formato` **(str)**: `json` (padrão) ou `colunas`, também escolhido pelo `Accept` (opcional)
+
+        ### Erros possíveis:
+        - **Bad Request**: *status code* **400**
+
+        ### Retorna:
+        - **JSON** com os livros ordenados por relevância (bm25) e o link `next` da próxima página
+    """
+    db_session = obter_sessao()
+    try:
+        consulta = montar_consulta_fts(request.args.get('q'))
+        if consulta is None:
+            raise BadRequest('Parâmetro q é obrigatório')
+        try:
+            limit = int(request.args.get('limit', 20))
+            offset = int(request.args.get('offset', 0))
+        except ValueError:
+            raise BadRequest('Parâmetros limit e offset devem ser inteiros')
+        if limit < 1 or limit > LIMITE_MAXIMO or offset < 0:
+            raise BadRequest(f'Parâmetro limit deve estar entre 1 e {LIMITE_MAXIMO}')
+
+        livros = db_session.execute(sql_busca_livros(consulta, limit + 1, offset)).scalars().all()
+        proximo = None
+        if len(livros) > limit:
+            livros = livros[:limit]
+            args = request.args.to_dict()
+            args.update({'limit': limit, 'offset': offset + limit})
+            proximo = url_for('.get_livros_busca', **args)
+
+        return resposta_lista([l.serialize_livro() for l in livros], next=proximo)
+    except Exception as e:
+        return jsonify({'error': f'{e}'}), 400
+
+@rotas.route('/livros/id<id_livro>', methods=['GET']) # DOCUMENTACAO !!!
 def get_livros_by_id_livro(id_livro):
-    db_session = local_session()
+    db_session = obter_sessao()
     try:
-        sql = select(Livro).where(Livro.id_livro == id_livro)
-        livro = db_session.execute(sql).scalar()
+        sincronizar_cache()
+        dados_livro = cache_entidades.get('livro', id_livro)
+        if dados_livro is None:
+            # lida antes da consulta: uma escrita no meio descarta o valor lido
+            geracao = cache_entidades.geracao()
+            sql = select(Livro).where(Livro.id_livro == id_livro)
+            livro = db_session.execute(sql).scalar()
+
+            if not livro:
+                raise BadRequest('Id do livro não encontrado')
 
-        if not livro:
+            dados_livro = livro.serialize_livro()
+            cache_entidades.set('livro', id_livro, dados_livro, geracao)
+
+        return jsonify({'result': dados_livro})
+    except Exception as e:
+        return jsonify({'error': f'{e}'}), 400
+
+# janela padrão de GET /livros/id<id>/disponibilidade
+DIAS_DISPONIBILIDADE = 30
+
+
+@rotas.route('/livros/id<id_livro>/disponibilidade', methods=['GET']) # Qualquer um
+def get_livro_disponibilidade(id_livro):
+    """
+        Consultar a disponibilidade de um livro em um período
+
+        ### Endpoint:
+            GET /livros/id<id_livro>/disponibilidade?de=<data>&ate=<data>
+
+        ### Parâmetros:
+        - `id_livro` **(int)**
+        - `de` **(str)**: início do período, `aaaa-mm-dd` (padrão: hoje)
+        - `ate` **(str)**: fim do período (exclusivo), `aaaa-mm-dd` (padrão: `de` + 30 dias)
+
+        ### Erros possíveis:
+        - **Bad Request**: *status code* **400**
+
+        ### Retorna:
+        - **JSON** com `disponivel` (livre no período inteiro), os períodos
+          `ocupados` e `livres` dentro da janela e a `proxima_data_livre` a partir de `de`
+    """
+    db_session = obter_sessao()
+    try:
+        id_livro = int(id_livro)
+        de = ler_data('de') or date.today()
+        ate = ler_data('ate') or de + timedelta(days=DIAS_DISPONIBILIDADE)
+        if ate <= de:
+            raise BadRequest('Parâmetro ate deve ser depois de de')
+        livro = db_session.execute(select(Livro.livro_ativo).where(Livro.id_livro == id_livro)).first()
+        if livro is None:
             raise BadRequest('Id do livro não encontrado')
 
-        # lista = []
-        # for l in livro:
-        #     lista.append(l.serialize_livro())
-        return jsonify({'result': livro.serialize_livro()})
+        periodos = db_session.execute(sql_periodos(id_livro, de)).all() if livro.livro_ativo else []
+        ocupados = [p for p in periodos if p.data_emprestimo < ate]
+        return jsonify({'result': {
+            'id_livro': id_livro,
+            'livro_ativo': livro.livro_ativo,
+            'de': de.isoformat(),
+            'ate': ate.isoformat(),
+            'disponivel': livro.livro_ativo and not ocupados,
+            'ocupados': [{'id_emprestimo': p.id_emprestimo, 'de': p.data_emprestimo.isoformat(),
+                          'ate': p.data_fim.isoformat()} for p in ocupados],
+            'livres': [{'de': inicio.isoformat(), 'ate': fim.isoformat()}
+                       for inicio, fim in periodos_livres(periodos, de, ate)] if livro.livro_ativo else [],
+            'proxima_data_livre': proxima_data_livre(periodos, de).isoformat() if livro.livro_ativo else None,
+        }})
     except Exception as e:
         return jsonify({'error': f'{e}'}), 400
-    finally:
-        db_session.close()
 
-@app.route('/usuarios', methods=['GET']) # Qualquer um
-# @app.route('/usuarios/<id_user>', methods=['GET'])
+@rotas.route('/usuarios', methods=['GET']) # Qualquer um
+# @rotas.route('/usuarios/<id_user>', methods=['GET'])
 def get_usuarios():
     """
         Consultar usuários
 
         ### Endpoint:
             GET /usuarios
-            GET /usuarios/<id_user>
+            GET /usuarios?limit=<limit>&after=<id>
 
         ### Parâmetros:
-        - `id_user` **(str)**: **string para ser convertida a inteiro**
+        - `limit` **(int)**: quantidade de usuários por página (opcional)
+        - `after` **(int)**: cursor, `id` do último usuário da página anterior (opcional)
+        - `fields` **(str)**: colunas retornadas, ex.: `id,nome` (opcional)
+        - `ids` **(str)**: lista de `id` separados por vírgula, ex.: `1,2,3` (opcional)
+        - `formato` **(str)**: `json` (padrão) ou `colunas`, também escolhido pelo `Accept` (opcional)
+
+        Sem `limit`/`after` a lista completa é enviada em streaming.
 
         ### Erros possíveis:
         - **Bad Request**: *status code* **400**
 
         ### Retorna:
         - **JSON** com a lista de usuários e dados
+        - Paginado: **JSON** com `result`, `next_cursor` e `next` (link da próxima página)
+        - Com `ids`: **JSON** com `result` (registros por id) e `nao_encontrados`
+        - Com `formato=colunas`: **JSON** com `columns` (nomes) e `rows` (valores de cada registro)
     """
 
-    db_session = local_session()
+    db_session = obter_sessao()
 
     try:
         sql = select(Usuario)
-        sql_executar = db_session.execute(sql).scalars()
-        result = []
-        for usuario in sql_executar:
-            result.append(usuario.serialize_usuario())
-        return jsonify({'result': result})
+        return responder_listagem(db_session, sql, Usuario.id, Usuario.serialize_usuario)
     except Exception as e:
         return jsonify({'error': f'{e}'}), 400
-    finally:
-        db_session.close()
 
-@app.route('/usuarios/id<id>') # DOCUMENTACAO !!!
+@rotas.route('/usuarios/id<id>') # DOCUMENTACAO !!!
 def get_usuario_by_id(id):
-    db_session = local_session()
+    db_session = obter_sessao()
 
     try:
-        sql = select(Usuario).where(Usuario.id == id)
-        usuario = db_session.execute(sql).scalar()
-        if not usuario:
-            raise BadRequest('Usuário com id inserido não encontrado')
-        # result = []
-        # for u in usuario:
-        #     result.append(u.serialize_usuario())
-        return jsonify({'result': usuario.serialize_usuario()})
+        sincronizar_cache()
+        dados_usuario = cache_entidades.get('usuario', id)
+        if dados_usuario is None:
+            geracao = cache_entidades.geracao()
+            sql = select(Usuario).where(Usuario.id == id)
+            usuario = db_session.execute(sql).scalar()
+            if not usuario:
+                raise BadRequest('Usuário com id inserido não encontrado')
+            dados_usuario = usuario.serialize_usuario()
+            cache_entidades.set('usuario', id, dados_usuario, geracao)
+        return jsonify({'result': dados_usuario})
     except Exception as e:
         return jsonify({'error': f'{e}'}), 400
-    finally:
-        db_session.close()
 
-@app.route('/emprestimos/user<id_user>', methods=['GET']) # Administradores
+@rotas.route('/emprestimos/user<id_user>', methods=['GET']) # Administradores
 def get_emprestimos_user(id_user):
     """
             Consultar emprestimos por usuario
 
             ### Endpoint:
                 GET /emprestimos/<id_user>
+                GET /emprestimos/<id_user>?expand=livro,usuario
 
             ### Parâmetros:
             - `id_user` **(str)**: **string para ser convertida a inteiro**
+            - `expand` **(str)**: `livro` e/ou `usuario`, embute os objetos relacionados (opcional)
+            - `formato` **(str)**: `json` (padrão) ou `colunas`, também escolhido pelo `Accept` (opcional)
 
             ### Erros possíveis:
             - **Bad Request**: *status code* **400**
@@ -181,89 +817,602 @@ def get_emprestimos_user(id_user):
             ### Retorna:
             - **JSON** com a lista de emprestimos realizados pelo usuario
         """
-    db_session = local_session()
+    db_session = obter_sessao()
 
     try:
         id_usuario = int(id_user)
-        sql = select(Emprestimo, Usuario, Livro).join(
-            Usuario, Emprestimo.ID == Usuario.id).join(
-            Livro, Emprestimo.ID_livro == Livro.id_livro
-        ).where(Usuario.id == id_usuario)
+        expand = ler_expand()
+        sql = sql_emprestimos(expand).where(Usuario.id == id_usuario)
         sql_executar = db_session.execute(sql).scalars()
         result = []
         for i in sql_executar:
-            result.append(i.serialize_emprestimo())
+            result.append(i.serialize_emprestimo(expand))
         if result:
-            return jsonify({'result': result})
+            return resposta_lista(result)
         else:
             return jsonify({'result': 'Não existem dados referente a esse usuario'})
     except Exception as e:
         return jsonify({'error': f'{e}'}), 400
-    finally:
-        db_session.close()
 
-@app.route('/emprestimos', methods=['GET']) # Administradores
+@rotas.route('/emprestimos', methods=['GET']) # Administradores
 def get_emprestimos():
     """
         Consultar emprestimos
 
         ### Endpoint:
             GET /emprestimos
+            GET /emprestimos?limit=<limit>&after=<id_emprestimo>
+            GET /emprestimos?expand=livro,usuario
+
+        ### Parâmetros:
+        - `expand` **(str)**: `livro` e/ou `usuario`, embute os objetos relacionados (opcional)
+        - `limit` **(int)**: quantidade de emprestimos por página (opcional)
+        - `after` **(int)**: cursor, `id_emprestimo` do último emprestimo da página anterior (opcional)
+        - `fields` **(str)**: colunas retornadas, ex.: `id_emprestimo,data_devolucao` (não combina com `expand`)
+        - `ids` **(str)**: lista de `id_emprestimo` separados por vírgula, ex.: `1,2,3` (opcional)
+        - `formato` **(str)**: `json` (padrão) ou `colunas`, também escolhido pelo `Accept` (opcional)
+
+        Sem `limit`/`after` a lista completa é enviada em streaming.
 
         ### Erros possíveis:
         - **Bad Request**: *status code* **400**
 
         ### Retorna:
         - **JSON** com a lista de emprestimos
+        - Paginado: **JSON** com `result`, `next_cursor` e `next` (link da próxima página)
+        - Com `ids`: **JSON** com `result` (registros por id) e `nao_encontrados`
+        - Com `formato=colunas`: **JSON** com `columns` (nomes) e `rows` (valores de cada registro)
     """
-    db_session = local_session()
+    db_session = obter_sessao()
     try:
-        lista_emprestimos_sql = select(Emprestimo).join(
-            Livro, Emprestimo.ID_livro == Livro.id_livro).join(
-            Usuario, Emprestimo.ID == Usuario.id
-        )
-        lista_emprestimos = db_session.execute(lista_emprestimos_sql).scalars().all()
-        print(lista_emprestimos)
-        result = []
-        for emprestimo in lista_emprestimos:
-            result.append(emprestimo.serialize_emprestimo())
+        expand = ler_expand()
+        lista_emprestimos_sql = sql_emprestimos(expand)
+
+        def serializar(emprestimo):
+            return emprestimo.serialize_emprestimo(expand)
 
-        return jsonify({'result': result})
+        return responder_listagem(db_session, lista_emprestimos_sql, Emprestimo.id_emprestimo, serializar)
     except Exception as e:
         return jsonify({'error': f'{e}'}), 400
-    finally:
-        db_session.close()
 
-@app.route('/emprestimos/id<id_emprestimo>', methods=['GET']) # Administradores
-def get_emprestimo_by_id_emprestimo(id_emprestimo):
-    db_session = local_session()
+@rotas.route('/emprestimos/atrasados', methods=['GET']) # Administradores
+def get_emprestimos_atrasados():
+    """
+        Consultar emprestimos atrasados
+
+        ### Endpoint:
+            GET /emprestimos/atrasados
+            GET /emprestimos/atrasados?expand=livro,usuario
+
+        ### Parâmetros:
+        - `expand` **(str)**: `livro` e/ou `usuario`, embute os objetos relacionados (opcional)
+        - `formato` **(str)**: `json` (padrão) ou `colunas`, também escolhido pelo `Accept` (opcional)
+
+        ### Erros possíveis:
+        - **Bad Request**: *status code* **400**
+
+        ### Retorna:
+        - **JSON** com os emprestimos em aberto cuja `data_devolucao` já passou,
+          do mais atrasado para o mais recente
+    """
+    db_session = obter_sessao()
+    try:
+        expand = ler_expand()
+        # faixa no índice (status_finalizado, data_devolucao)
+        sql = sql_emprestimos(expand).where(
+            Emprestimo.status_finalizado == False,
+            Emprestimo.data_devolucao < date.today()
+        ).order_by(Emprestimo.data_devolucao)
+        emprestimos = db_session.execute(sql).scalars()
+        return resposta_lista([e.serialize_emprestimo(expand) for e in emprestimos])
+    except Exception as e:
+        return jsonify({'error': f'{e}'}), 400
+
+@rotas.route('/emprestimos/vencendo', methods=['GET']) # Administradores
+def get_emprestimos_vencendo():
+    """
+        Consultar emprestimos que vencem nos próximos dias
+
+        ### Endpoint:
+            GET /emprestimos/vencendo?dias=<dias>
+
+        ### Parâmetros:
+        - `dias` **(int)**: tamanho da janela a partir de hoje (padrão: 7)
+        - `expand` **(str)**: `livro` e/ou `usuario`, embute os objetos relacionados (opcional)
+        - `formato` **(str)**: `json` (padrão) ou `colunas`, também escolhido pelo `Accept` (opcional)
+
+        ### Erros possíveis:
+        - **Bad Request**: *status code* **400**
+
+        ### Retorna:
+        - **JSON** com os emprestimos em aberto com `data_devolucao` entre hoje e hoje + `dias`
+    """
+    db_session = obter_sessao()
     try:
-        lista_emprestimos_sql = select(Emprestimo).where(Emprestimo.id_emprestimo == id_emprestimo)
-        emprestimo = db_session.execute(lista_emprestimos_sql).scalar()
+        dias = int(request.args.get('dias', 7))
+        if dias < 0:
+            raise BadRequest('Parâmetro dias não pode ser negativo')
+        expand = ler_expand()
+        hoje = date.today()
+        sql = sql_emprestimos(expand).where(
+            Emprestimo.status_finalizado == False,
+            Emprestimo.data_devolucao >= hoje,
+            Emprestimo.data_devolucao <= hoje + timedelta(days=dias)
+        ).order_by(Emprestimo.data_devolucao)
+        emprestimos = db_session.execute(sql).scalars()
+        return resposta_lista([e.serialize_emprestimo(expand) for e in emprestimos])
+    except Exception as e:
+        return jsonify({'error': f'{e}'}), 400
 
-        sql_livro = select(Livro).where(Livro.id_livro == emprestimo.ID_livro)
-        livro = db_session.execute(sql_livro).scalar()
+# exportação do histórico de emprestimos (GET /emprestimos/export)
+def colunas_exportacao(hoje):
+    """
+        Colunas exportadas; `status_atrasado` e `multa` dos emprestimos em
+        aberto são calculados em `hoje`, como em `Emprestimo.atraso`.
+    """
+    em_aberto = Emprestimo.status_finalizado == False
+    return (
+        Emprestimo.id_emprestimo,
+        Emprestimo.data_emprestimo,
+        Emprestimo.data_devolucao,
+        Emprestimo.status_finalizado,
+        type_coerce(case((em_aberto, Emprestimo.data_devolucao < hoje), else_=Emprestimo.status_atrasado),
+                    Boolean).label('status_atrasado'),
+        case((em_aberto, expressao_multa(hoje)), else_=Emprestimo.multa).label('multa'),
+        Emprestimo.ID,
+        Livro.titulo,
+        Emprestimo.ID_livro,
+        Usuario.nome,
+    )
+# linhas acumuladas antes de cada envio do CSV/NDJSON
+LINHAS_POR_ENVIO = 200
+
+
+def ler_data(nome):
+    """
+        Lê uma data `aaaa-mm-dd` da query string; `None` se não foi enviada.
+    """
+    valor = request.args.get(nome)
+    if not valor:
+        return None
+    try:
+        return date.fromisoformat(valor)
+    except ValueError:
+        raise BadRequest(f'Parâmetro {nome} deve ser uma data no formato aaaa-mm-dd')
+
+
+@rotas.route('/emprestimos/export', methods=['GET']) # Administradores
+def get_emprestimos_export():
+    """
+        Exportar o histórico de emprestimos
+
+        ### Endpoint:
+            GET /emprestimos/export?formato=<csv|ndjson>&desde=<aaaa-mm-dd>&ate=<aaaa-mm-dd>
 
-        sql_user = select(Usuario).where(Usuario.id == emprestimo.ID)
-        usuario = db_session.execute(sql_user).scalar()
+        ### Parâmetros:
+        - `formato` **(str)**: `csv` (padrão) ou `ndjson`
+        - `desde` **(str)**: data de emprestimo inicial, inclusiva (opcional)
+        - `ate` **(str)**: data de emprestimo final, inclusiva (opcional)
+
+        As linhas são lidas com `yield_per` e enviadas em streaming, então o
+        download começa na hora e o uso de memória não depende do tamanho do
+        histórico. Cada linha traz também o `titulo` do livro e o `nome` do usuario.
+
+        ### Erros possíveis:
+        - **Bad Request**: *status code* **400**
 
-        if not emprestimo or not livro or not usuario:
-            raise BadRequest('Emprestimo com id inserido não encontrado')
+        ### Retorna:
+        - **CSV** com cabeçalho ou **NDJSON** (um emprestimo por linha), ordenado por `data_emprestimo`
+    """
+    try:
+        formato = request.args.get('formato', 'csv')
+        if formato not in ('csv', 'ndjson'):
+            raise BadRequest('Parâmetro formato deve ser csv ou ndjson')
+        desde = ler_data('desde')
+        ate = ler_data('ate')
+
+        # LEFT JOIN: emprestimos de livros/usuarios apagados também são exportados
+        colunas = colunas_exportacao(date.today())
+        sql = select(*colunas).select_from(Emprestimo).outerjoin(
+            Livro, Emprestimo.livro_relacao).outerjoin(
+            Usuario, Emprestimo.usuario_relacao)
+        if desde is not None:
+            sql = sql.where(Emprestimo.data_emprestimo >= desde)
+        if ate is not None:
+            sql = sql.where(Emprestimo.data_emprestimo <= ate)
+        # percorre o índice de data_emprestimo, sem ordenar em memória
+        sql = sql.order_by(Emprestimo.data_emprestimo, Emprestimo.id_emprestimo).execution_options(
+            yield_per=YIELD_PER)
+        nomes = [coluna.key for coluna in colunas]
+    except Exception as e:
+        return jsonify({'error': f'{e}'}), 400
 
-        # result = []
-        # for e in emprestimo:
-        #     result.append(e.serialize_emprestimo())
-        emprestimo = emprestimo.serialize_emprestimo()
-        usuario = usuario.serialize_usuario()
-        livro = livro.serialize_livro()
+    def gerar():
+        db_session = obter_sessao()
+        buffer = io.StringIO()
+        escritor = csv.writer(buffer)
+        if formato == 'csv':
+            escritor.writerow(nomes)
+        for i, linha in enumerate(db_session.execute(sql), start=1):
+            if formato == 'csv':
+                escritor.writerow(valor_json(valor) for valor in linha)
+            else:
+                buffer.write(current_app.json.dumps({nome: valor_json(valor) for nome, valor in zip(nomes, linha)}))
+                buffer.write('\n')
+            if i % LINHAS_POR_ENVIO == 0:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue()
+
+    extensao, mimetype = ('csv', 'text/csv') if formato == 'csv' else ('ndjson', 'application/x-ndjson')
+    return Response(stream_with_context(gerar()), mimetype=mimetype, headers={
+        'Content-Disposition': f'attachment; filename=emprestimos.{extensao}',
+    })
+
+@rotas.route('/emprestimos/id<id_emprestimo>', methods=['GET']) # Administradores
+def get_emprestimo_by_id_emprestimo(id_emprestimo):
+    db_session = obter_sessao()
+    try:
+        # as três entidades ficam em cache separadas, assim editar um livro
+        # ou usuario não deixa o detalhe do emprestimo desatualizado
+        sincronizar_cache()
+        emprestimo = cache_entidades.get('emprestimo', id_emprestimo)
+        livro = usuario = None
+        if emprestimo is not None:
+            livro = cache_entidades.get('livro', emprestimo['ID_livro'])
+            usuario = cache_entidades.get('usuario', emprestimo['ID'])
+
+        if emprestimo is None or livro is None or usuario is None:
+            # emprestimo, livro e usuario em uma única consulta
+            geracao = cache_entidades.geracao()
+            sql = sql_emprestimos(EXPAND_VALIDOS).where(Emprestimo.id_emprestimo == id_emprestimo)
+            obj_emprestimo = db_session.execute(sql).scalar()
+
+            if not obj_emprestimo:
+                raise BadRequest('Emprestimo com id inserido não encontrado')
+
+            usuario = obj_emprestimo.usuario_relacao.serialize_usuario()
+            livro = obj_emprestimo.livro_relacao.serialize_livro()
+            emprestimo = obj_emprestimo.serialize_emprestimo()
+            cache_entidades.set('usuario', usuario['id'], usuario, geracao)
+            cache_entidades.set('livro', livro['id_livro'], livro, geracao)
+            cache_entidades.set('emprestimo', emprestimo['id_emprestimo'], emprestimo, geracao)
 
         return jsonify({'result': {'livro':livro, 'usuario':usuario, 'emprestimo':emprestimo}})
     except Exception as e:
         return jsonify({'error': f'{e}'}), 400
-    finally:
-        db_session.close()
 
-@app.route('/usuarios', methods=['POST']) # Administradores
+@rotas.route('/cache/estatisticas', methods=['GET']) # Administradores
+def get_cache_estatisticas():
+    """
+        Consultar estatísticas do cache de consultas por id
+
+        ### Endpoint:
+            GET /cache/estatisticas
+
+        ### Retorna:
+        - **JSON** com hits, misses, evictions, expirados, invalidações e tamanho do cache
+    """
+    return jsonify({'result': cache_entidades.estatisticas()})
+
+@rotas.route('/estatisticas', methods=['GET']) # Administradores
+def get_estatisticas():
+    """
+        Consultar estatísticas do acervo e dos emprestimos
+
+        ### Endpoint:
+            GET /estatisticas
+
+        Os contadores são mantidos a cada escrita, então a consulta não
+        depende do tamanho das tabelas.
+
+        ### Erros possíveis:
+        - **Bad Request**: *status code* **400**
+
+        ### Retorna:
+        - **JSON** com `livros_total`, `livros_ativos`, `livros_emprestados`,
+          `usuarios_total`, `usuarios_ativos`, `emprestimos_total` e `emprestimos_abertos`
+    """
+    db_session = obter_sessao()
+    try:
+        valores = dict(db_session.execute(select(Estatistica.chave, Estatistica.valor)).all())
+        return jsonify({'result': {chave: valores.get(chave, 0) for chave in CHAVES_ESTATISTICAS}})
+    except Exception as e:
+        return jsonify({'error': f'{e}'}), 400
+
+@rotas.route('/estatisticas/usuario<id_user>', methods=['GET']) # Administradores
+def get_estatisticas_usuario(id_user):
+    """
+        Consultar emprestimos em aberto de um usuario
+
+        ### Endpoint:
+            GET /estatisticas/usuario<id_user>
+
+        ### Parâmetros:
+        - `id_user` **(str)**: **string para ser convertida a inteiro**
+
+        ### Erros possíveis:
+        - **Bad Request**: *status code* **400**
+
+        ### Retorna:
+        - **JSON** com `id_usuario` e `emprestimos_abertos`
+    """
+    db_session = obter_sessao()
+    try:
+        id_usuario = int(id_user)
+        abertos = db_session.execute(
+            select(EstatisticaUsuario.emprestimos_abertos).where(EstatisticaUsuario.id_usuario == id_usuario)
+        ).scalar()
+        if abertos is None:
+            if db_session.get(Usuario, id_usuario) is None:
+                raise BadRequest('Usuário com id inserido não encontrado')
+            abertos = 0
+        return jsonify({'result': {'id_usuario': id_usuario, 'emprestimos_abertos': abertos}})
+    except Exception as e:
+        return jsonify({'error': f'{e}'}), 400
+
+# entidades do log de mudanças: chave primária e serialização
+ENTIDADES_MUDANCAS = {
+    'livro': (Livro.id_livro, Livro.serialize_livro),
+    'usuario': (Usuario.id, Usuario.serialize_usuario),
+    'emprestimo': (Emprestimo.id_emprestimo, Emprestimo.serialize_emprestimo),
+}
+
+
+def ler_entidade_mudancas(obrigatoria=False):
+    entidade = request.args.get('entidade')
+    if entidade is None and not obrigatoria:
+        return None
+    if entidade not in ENTIDADES_MUDANCAS:
+        raise BadRequest('Parâmetro entidade deve ser livro, usuario ou emprestimo')
+    return entidade
+
+
+def anexar_dados_mudancas(db_session, mudancas):
+    """
+        Preenche `dados` de cada mudança com os valores atuais das colunas
+        alteradas (o registro inteiro no insert; `None` se foi removido).
+    """
+    ids = {}
+    for mudanca in mudancas:
+        if mudanca['operacao'] != 'delete':
+            ids.setdefault(mudanca['entidade'], set()).add(mudanca['id'])
+    registros = {}
+    for entidade, ids_entidade in ids.items():
+        coluna_id, serializar = ENTIDADES_MUDANCAS[entidade]
+        for lote in em_lotes(ids_entidade):
+            for registro in db_session.execute(select(coluna_id.class_).where(coluna_id.in_(lote))).scalars():
+                registros[entidade, getattr(registro, coluna_id.key)] = serializar(registro)
+    for mudanca in mudancas:
+        dados = registros.get((mudanca['entidade'], mudanca['id']))
+        if dados is not None and mudanca['colunas'] is not None:
+            dados = {coluna: dados[coluna] for coluna in mudanca['colunas']}
+        mudanca['dados'] = dados
+
+
+@rotas.route('/mudancas', methods=['GET'])
+def get_mudancas():
+    """
+        Consultar as mudanças feitas depois de um ponto (sincronização incremental)
+
+        ### Endpoint:
+            GET /mudancas?desde=<seq>&limit=<limit>
+            GET /mudancas?desde=<seq>&entidade=livro
+
+        ### Parâmetros:
+        - `desde` **(int)**: último `seq` já aplicado pelo cliente (padrão: 0)
+        - `limit` **(int)**: máximo de mudanças (padrão: 50, máximo: 1000)
+        - `entidade` **(str)**: `livro`, `usuario` ou `emprestimo` (opcional)
+        - `formato` **(str)**: `json` (padrão) ou `colunas`, também escolhido pelo `Accept` (opcional)
+
+        Para começar, o cliente baixa `GET /mudancas/snapshot` e segue daqui
+        com o `seq` dele. Depois da compactação só a última mudança de cada
+        registro fica no log, com a junção das colunas alteradas.
+
+        ### Erros possíveis:
+        - **Bad Request**: *status code* **400**
+
+        ### Retorna:
+        - **JSON** com as mudanças em ordem de `seq` (`entidade`, `id`,
+          `operacao`, `colunas`, `data` e `dados` com os valores atuais das
+          colunas alteradas), o `seq` para a próxima chamada e `next`
+          quando houver mais mudanças
+    """
+    db_session = obter_sessao()
+    try:
+        try:
+            desde = int(request.args.get('desde', 0))
+            limit = int(request.args.get('limit', LIMITE_PADRAO))
+        except ValueError:
+            raise BadRequest('Parâmetros desde e limit devem ser inteiros')
+        if limit < 1 or limit > LIMITE_MAXIMO:
+            raise BadRequest(f'Parâmetro limit deve estar entre 1 e {LIMITE_MAXIMO}')
+        entidade = ler_entidade_mudancas()
+
+        # com um escritor por vez no SQLite os seq ficam visíveis em ordem,
+        # então um cliente nunca pula uma mudança de uma transação mais lenta
+        sql = select(Mudanca).where(Mudanca.seq > desde)
+        if entidade is not None:
+            sql = sql.where(Mudanca.entidade == entidade)
+        mudancas = db_session.execute(sql.order_by(Mudanca.seq).limit(limit + 1)).scalars().all()
+        mais = len(mudancas) > limit
+        mudancas = mudancas[:limit]
+
+        result = [mudanca.serialize_mudanca() for mudanca in mudancas]
+        anexar_dados_mudancas(db_session, result)
+        seq = mudancas[-1].seq if mudancas else desde
+        proximo = None
+        if mais:
+            args = request.args.to_dict()
+            args.update({'desde': seq, 'limit': limit})
+            proximo = url_for(request.endpoint, **args)
+        return resposta_lista(result, seq=seq, next=proximo)
+    except Exception as e:
+        return jsonify({'error': f'{e}'}), 400
+
+@rotas.route('/mudancas/snapshot', methods=['GET'])
+def get_mudancas_snapshot():
+    """
+        Baixar todos os registros de uma entidade com o seq do log (início da sincronização)
+
+        ### Endpoint:
+            GET /mudancas/snapshot?entidade=<entidade>
+
+        ### Parâmetros:
+        - `entidade` **(str)**: `livro`, `usuario` ou `emprestimo`
+        - `formato` **(str)**: `json` (padrão) ou `colunas`, também escolhido pelo `Accept` (opcional)
+
+        O `seq` e os registros são lidos na mesma transação, então o
+        snapshot tem exatamente as mudanças até `seq`; o cliente continua com
+        `GET /mudancas?desde=<seq>`.
+
+        ### Erros possíveis:
+        - **Bad Request**: *status code* **400**
+
+        ### Retorna:
+        - **JSON** com `seq` e `result` (todos os registros, enviados em streaming)
+    """
+    db_session = obter_sessao()
+    try:
+        entidade = ler_entidade_mudancas(obrigatoria=True)
+        coluna_id, serializar = ENTIDADES_MUDANCAS[entidade]
+        # abre a transação de leitura; o streaming usa a mesma sessão
+        seq = db_session.execute(select(func.coalesce(func.max(Mudanca.seq), 0))).scalar()
+        return resposta_streaming(select(coluna_id.class_), coluna_id, serializar, seq=seq)
+    except Exception as e:
+        return jsonify({'error': f'{e}'}), 400
+
+@rotas.route('/pronto', methods=['GET'])
+def get_pronto():
+    """
+        Readiness: indica se o processo pode receber requisições
+
+        ### Endpoint:
+            GET /pronto
+
+        ### Erros possíveis:
+        - **Service Unavailable**: *status code* **503** (banco inacessível ou worker encerrando)
+
+        ### Retorna:
+        - **JSON** com `status` `pronto` e o `pid` do worker
+    """
+    if current_app.config.get('ENCERRANDO'):
+        return jsonify({'status': 'encerrando', 'pid': os.getpid()}), 503
+    try:
+        with engine_leitura.connect() as conn:
+            conn.exec_driver_sql('SELECT 1')
+    except Exception as e:
+        return jsonify({'status': 'indisponivel', 'error': f'{e}', 'pid': os.getpid()}), 503
+    return jsonify({'status': 'pronto', 'pid': os.getpid()})
+
+@rotas.route('/metrics', methods=['GET'])
+def get_metrics():
+    """
+        Métricas no formato texto do Prometheus
+
+        ### Endpoint:
+            GET /metrics
+
+        ### Retorna:
+        - Latência por rota (histograma), requisições por status, consultas
+          SQL e tempo de banco por rota, contadores do cache e uso do pool
+          de cada engine (leitura e escrita)
+    """
+    estatisticas_cache = cache_entidades.estatisticas()
+    extras = [('cache_{}_total'.format(nome), 'counter', 'Cache por id: {}.'.format(nome), estatisticas_cache[nome])
+              for nome in ('hits', 'misses', 'evictions', 'expirados', 'invalidacoes', 'descartados')]
+    extras.append(('cache_tamanho', 'gauge', 'Entradas no cache por id.', estatisticas_cache['tamanho']))
+    extras.append(('app_criacao_segundos', 'gauge', 'Tempo do create_app neste processo.',
+                   round(current_app.config['TEMPO_CRIACAO'], 6)))
+
+    fila = current_app.extensions.get('fila_escrita')
+    if fila is not None:
+        estatisticas_fila = fila.estatisticas()
+        for chave, tipo, ajuda in (
+            ('lotes', 'counter', 'Transações gravadas pela fila de escrita.'),
+            ('operacoes', 'counter', 'Operações gravadas pela fila de escrita.'),
+            ('erros', 'counter', 'Operações da fila de escrita desfeitas por erro.'),
+            ('maior_lote', 'gauge', 'Maior lote da fila de escrita.'),
+        ):
+            extras.append(('fila_escrita_{}{}'.format(chave, '_total' if tipo == 'counter' else ''),
+                           tipo, ajuda, estatisticas_fila[chave]))
+
+    pools = [(nome, estatisticas_pool(e)) for nome, e in (('leitura', engine_leitura), ('escrita', engine))]
+    pools = [(nome, dados) for nome, dados in pools if dados is not None]
+    for chave, nome, tipo, ajuda in (
+        ('tamanho', 'db_pool_tamanho', 'gauge', 'Conexões fixas do pool.'),
+        ('em_uso', 'db_pool_em_uso', 'gauge', 'Conexões em uso.'),
+        ('overflow', 'db_pool_overflow', 'gauge', 'Conexões abertas além do tamanho do pool.'),
+        ('esperas', 'db_pool_esperas_total', 'counter', 'Pedidos de conexão ao pool.'),
+        ('tempo_espera', 'db_pool_espera_segundos_total', 'counter', 'Tempo total esperando conexão.'),
+        ('espera_maxima', 'db_pool_espera_maxima_segundos', 'gauge', 'Maior espera por conexão.'),
+        ('timeouts', 'db_pool_timeouts_total', 'counter', 'Pedidos de conexão que estouraram o pool_timeout.'),
+    ):
+        extras.append((nome, tipo, ajuda, [({'engine': engine_nome}, dados[chave]) for engine_nome, dados in pools]))
+    return Response(metricas.exportar_prometheus(extras), mimetype='text/plain; version=0.0.4')
+
+@rotas.route('/metrics/sql_lentas', methods=['GET']) # Administradores
+def get_metrics_sql_lentas():
+    """
+        Consultar o log de SQL lenta
+
+        ### Endpoint:
+            GET /metrics/sql_lentas
+
+        ### Retorna:
+        - **JSON** com as últimas consultas acima de `METRICAS_SQL_LENTA_MS`,
+          com rota, duração e `EXPLAIN QUERY PLAN`
+    """
+    return jsonify({'result': list(metricas.sql_lentas)})
+
+@rotas.route('/livros/batch', methods=['POST']) # Qualquer um
+@rotas.route('/usuarios/batch', methods=['POST']) # Administradores
+@rotas.route('/emprestimos/batch', methods=['POST']) # Administradores
+@usar_engine('leitura')
+def get_lote_por_ids():
+    """
+        Consultar vários livros, usuários ou emprestimos por id
+
+        ### Endpoint:
+            POST /livros/batch
+            POST /usuarios/batch
+            POST /emprestimos/batch
+
+        ### Corpo:
+        - `ids` **(list)**: lista de ids (até 5000)
+
+        Aceita os mesmos `fields` e `expand` (emprestimos) das listagens.
+
+        ### Erros possíveis:
+        - **Bad Request**: *status code* **400**
+
+        ### Retorna:
+        - **JSON** com `result` (registros por id) e `nao_encontrados`
+    """
+    db_session = obter_sessao()
+    try:
+        dados = request.get_json()
+        if not isinstance(dados, dict) or 'ids' not in dados:
+            raise BadRequest('Esperado um objeto JSON com a lista ids')
+        entidade = request.path.split('/')[1]
+        if entidade == 'livros':
+            return responder_listagem(db_session, select(Livro), Livro.id_livro,
+                                      Livro.serialize_livro, dados['ids'])
+        if entidade == 'usuarios':
+            return responder_listagem(db_session, select(Usuario), Usuario.id,
+                                      Usuario.serialize_usuario, dados['ids'])
+        expand = ler_expand()
+
+        def serializar(emprestimo):
+            return emprestimo.serialize_emprestimo(expand)
+
+        return responder_listagem(db_session, sql_emprestimos(expand), Emprestimo.id_emprestimo,
+                                  serializar, dados['ids'])
+    except Exception as e:
+        return jsonify({'error': f'{e}'}), 400
+
+@rotas.route('/usuarios', methods=['POST']) # Administradores
 def novo_usuario():
     """
         Cadastrar usuario
@@ -277,32 +1426,42 @@ def novo_usuario():
         ### Retorna:
         - **JSON** mensagem de **sucesso**
     """
-    db_session = local_session()
     try:
         dados_usuario = request.get_json()
         nome = dados_usuario['nome']
         cpf = dados_usuario['cpf']
         telefone = dados_usuario['telefone']
-        cpf = str(cpf)
-        if not nome or not cpf or not telefone or len(cpf) != 11:
+        if not nome or not cpf or not telefone:
             return jsonify({'result': 'Error. Integrity Error (faltam informações) '}), 400
         else:
-            cpf_f = '{0}.{1}.{2}-{3}'.format(cpf[:3], cpf[3:6], cpf[6:9], cpf[9:])
-            usuario = select(Usuario).where(Usuario.cpf == cpf_f)
-            usuario = db_session.execute(usuario).scalars()
-            if usuario:
-                raise TypeError
-            else:
-                post = Usuario(nome=nome, cpf=cpf_f, telefone=telefone)
-                post.save(db_session)
-                db_session.close()
-                return jsonify({'result': 'Usuario criado com sucesso!'}), 200
+            # com ou sem pontuação, como no /usuarios/sync
+            cpf_f = formatar_cpf(cpf)
+
+            def operacao(db_session):
+                usuario = select(Usuario.id).where(Usuario.cpf == cpf_f)
+                if db_session.execute(usuario).scalar() is not None:
+                    raise TypeError('CPF já cadastrado')
+                # mesmo formato do editar_usuarios e do /usuarios/sync
+                post = Usuario(nome=nome, cpf=cpf_f, telefone=formatar_telefone(telefone))
+                db_session.add(post)
+                db_session.flush()
+                return post.id
+
+            id_usuario = executar_escrita(operacao)
+            cache_entidades.invalidar('usuario', id_usuario)
+            return jsonify({'result': 'Usuario criado com sucesso!'}), 200
+    except PoolTimeoutError:
+        raise
     except Exception as e:
         return jsonify({"error": str(e)}), 400
-    finally:
-        db_session.close()
 
-@app.route('/emprestimos', methods=['POST']) # Administradores
+class PeriodoOcupado(Exception):
+    def __init__(self, proxima_data_livre):
+        super().__init__('Livro já está emprestado no período')
+        self.proxima_data_livre = proxima_data_livre
+
+
+@rotas.route('/emprestimos', methods=['POST']) # Administradores
 def novo_emprestimo():
     """
         Cadastrar emprestimos
@@ -310,94 +1469,221 @@ def novo_emprestimo():
         ### Endpoint:
             POST /emprestimos
 
+        ### Corpo:
+        - `data_emprestimo` **(str)**: data no formato `aaaa-mm-dd`
+        - `id_usuario`, `id_livro` **(int)**
+        - `tempo_emprestimo` **(int)** e `tipo_tempo` **(str)**: `d`, `w`, `m` ou `y`
+
+        O emprestimo ocupa o livro de `data_emprestimo` até a devolução, e
+        pode começar no futuro (reserva) se o período estiver livre. Uma
+        reserva não marca `status_emprestado`: o livro continua disponível
+        até o dia do início, quando a varredura (atrasos.py) o marca.
+
         ### Erros possíveis:
         - **Bad Request**: *status code* **400**
+        - **Conflict**: *status code* **409** (período ocupado; a resposta
+          traz `proxima_data_livre` para a mesma duração)
 
         ### Retorna:
-        - **JSON** mensagem de **sucesso**
+        - **JSON** mensagem de **sucesso** e o `id_emprestimo` criado
     """
-    db_session = local_session()
     try:
-
-        db_session = local_session()
-
         json_dados_emprestimo = request.get_json()
-        data_emprestimo = json_dados_emprestimo['data_emprestimo']
-        usuario_id = json_dados_emprestimo['id_usuario']
-        livro_id = json_dados_emprestimo['id_livro']
+        usuario_id = int(json_dados_emprestimo['id_usuario'])
+        livro_id = int(json_dados_emprestimo['id_livro'])
+        # data formato yyyy-mm-dd
+        obj_data_emprestimo = date.fromisoformat(json_dados_emprestimo['data_emprestimo'])
 
-        tempo_emprestimo = json_dados_emprestimo['tempo_emprestimo']
+        tempo_emprestimo = int(json_dados_emprestimo['tempo_emprestimo'])
         tipo_tempo = json_dados_emprestimo['tipo_tempo']
+        tipos_tempo = {'d': 'days', 'w': 'weeks', 'm': 'months', 'y': 'years'}
+        if tipo_tempo not in tipos_tempo or tempo_emprestimo < 1:
+            raise ValueError('tempo_emprestimo ou tipo_tempo inválido')
+        data_devolucao = obj_data_emprestimo + relativedelta(**{tipos_tempo[tipo_tempo]: tempo_emprestimo})
+
+        em_andamento = obj_data_emprestimo <= date.today()
+
+        def operacao(db_session):
+            def periodo_ocupado():
+                periodos = db_session.execute(sql_periodos(livro_id, obj_data_emprestimo)).all()
+                return PeriodoOcupado(proxima_data_livre(periodos, obj_data_emprestimo,
+                                                         (data_devolucao - obj_data_emprestimo).days))
+
+            # Para um emprestimo que já começou o UPDATE é um compare-and-set
+            # (só passa se o livro não estiver emprestado): de dois pedidos
+            # simultâneos um só muda a linha, em qualquer banco. Uma reserva
+            # não muda o valor, mas o UPDATE vem antes da verificação de
+            # conflito para abrir a transação de escrita; como o SQLite tem um
+            # escritor por vez, nenhum emprestimo é gravado entre a
+            # verificação e o INSERT.
+            reserva = db_session.execute(
+                update(Livro).where(
+                    Livro.id_livro == livro_id,
+                    Livro.livro_ativo == True,
+                    or_(Livro.status_emprestado == False, literal(not em_andamento))
+                ).values(status_emprestado=True if em_andamento else Livro.status_emprestado)
+                .execution_options(synchronize_session=False)
+            )
+            if reserva.rowcount != 1:
+                ativo = select(Livro.id_livro).where(Livro.id_livro == livro_id, Livro.livro_ativo == True)
+                if db_session.execute(ativo).scalar() is None:
+                    raise BadRequest('Livro não encontrado ou inativo')
+                raise periodo_ocupado()
+
+            if buscar_conflito(db_session, livro_id, obj_data_emprestimo, data_devolucao) is not None:
+                raise periodo_ocupado()
+
+            # INSERT ... SELECT: só insere se o usuario existir e estiver ativo
+            novo = db_session.execute(
+                insert(Emprestimo).from_select(
+                    ['data_emprestimo', 'data_devolucao', 'status_finalizado', 'status_atrasado', 'ID', 'ID_livro'],
+                    # já vencido (cadastrado com data passada): a varredura só vê os que vencem depois dela
+                    select(literal(obj_data_emprestimo, Date), literal(data_devolucao, Date),
+                           literal(False), literal(data_devolucao < date.today()),
+                           Usuario.id, literal(livro_id)).where(
+                        Usuario.id == usuario_id,
+                        Usuario.usuario_ativo == True)
+                ).returning(Emprestimo.id_emprestimo)
+            ).scalar()
+            if novo is None:
+                raise BadRequest('Usuário não encontrado ou inativo')
+            return novo
+
+        novo = executar_escrita(operacao)
+        cache_entidades.invalidar('livro', livro_id)
+        return jsonify({'result': 'Emprestimo criado com sucesso!', 'id_emprestimo': novo}), 200
+
+    except PeriodoOcupado as e:
+        return jsonify({'error': 'Livro já está emprestado no período',
+                        'proxima_data_livre': e.proxima_data_livre.isoformat()}), 409
+    except PoolTimeoutError:
+        raise
+    except Exception as e:
+        return jsonify({"error": str(e)}), 400
+
+def liberar_livros(db_session, ids_livros):
+    """
+        Marca os livros como disponíveis, exceto os que ainda têm emprestimo
+        em aberto já começado (reservas futuras não seguram o livro).
+    """
+    outro_aberto = select(Emprestimo.id_emprestimo).where(
+        Emprestimo.ID_livro == Livro.id_livro,
+        Emprestimo.status_finalizado == False,
+        Emprestimo.data_emprestimo <= date.today()).exists()
+    for lote in em_lotes(ids_livros):
+        db_session.execute(update(Livro).where(
+            Livro.id_livro.in_(lote), Livro.status_emprestado == True, ~outro_aberto
+        ).values(status_emprestado=False).execution_options(synchronize_session=False))
 
-        if len(data_emprestimo) == 10:
-            usuario_id = int(usuario_id)
-            livro_id = int(livro_id)
-            select_user = db_session.execute(select(Usuario).where(Usuario.id == usuario_id)).scalar()
-            if not select_user.usuario_ativo:
-                raise TypeError
-            select_livro = db_session.execute(select(Livro).where(Livro.id_livro == livro_id)).scalar()
-            if not select_livro.livro_ativo:
-                raise TypeError
-            # data formato yyyy-mm-dd
-            ano_emprestimo = '{}'.format(data_emprestimo[:4])
-            mes_emprestimo = '{}'.format(data_emprestimo[5:7])
-            dia_emprestimo = '{}'.format(data_emprestimo[8:])
 
-            obj_data_emprestimo = date(int(ano_emprestimo), int(mes_emprestimo), int(dia_emprestimo))
+def devolver_emprestimos(db_session, ids_emprestimos, ids_livros):
+    """
+        Finaliza os emprestimos pedidos (por id ou pelo livro) e libera os livros.
 
-            tipos_validos = ['d', 'w', 'm', 'y']
-            if tipo_tempo in tipos_validos:
-                data_devolucao = None
-                if tipo_tempo == 'd':
-                    data_devolucao = data_emprestimo + relativedelta(days=tempo_emprestimo)
+        Tudo é feito com UPDATEs `IN` em lotes, na transação de `db_session`
+        (o commit fica com quem chama). Retorna o resultado por item pedido:
+        `devolvido`, `ja_devolvido` ou `nao_encontrado` para emprestimos e
+        `devolvido` ou `sem_emprestimo_aberto` para livros.
+    """
+    abertos = {}
+    ja_devolvidos = set()
+    for lote in em_lotes(ids_emprestimos):
+        linhas = db_session.execute(select(
+            Emprestimo.id_emprestimo, Emprestimo.ID_livro, Emprestimo.status_finalizado).where(
+            Emprestimo.id_emprestimo.in_(lote)))
+        for id_emprestimo, id_livro, finalizado in linhas:
+            if finalizado:
+                ja_devolvidos.add(id_emprestimo)
+            else:
+                abertos[id_emprestimo] = id_livro
+
+    # pelo livro só fecha o emprestimo em andamento; as reservas futuras continuam
+    emprestimos_do_livro = {}
+    for lote in em_lotes(ids_livros):
+        linhas = db_session.execute(select(Emprestimo.id_emprestimo, Emprestimo.ID_livro).where(
+            Emprestimo.ID_livro.in_(lote), Emprestimo.status_finalizado == False,
+            Emprestimo.data_emprestimo <= date.today()))
+        for id_emprestimo, id_livro in linhas:
+            abertos[id_emprestimo] = id_livro
+            emprestimos_do_livro.setdefault(id_livro, []).append(id_emprestimo)
+
+    # o RETURNING diz quais foram realmente fechados por esta transação;
+    # a multa e o atraso do dia da devolução ficam gravados
+    fechados = set()
+    hoje = date.today()
+    for lote in em_lotes(abertos):
+        fechados.update(db_session.execute(update(Emprestimo).where(
+            Emprestimo.id_emprestimo.in_(lote), Emprestimo.status_finalizado == False
+        ).values(status_finalizado=True, status_atrasado=Emprestimo.data_devolucao < hoje,
+                 multa=expressao_multa(hoje)).returning(Emprestimo.id_emprestimo).execution_options(
+            synchronize_session=False)).scalars())
+    livros_liberados = {abertos[id_emprestimo] for id_emprestimo in fechados}
+    liberar_livros(db_session, livros_liberados)
+
+    resultado_emprestimos = []
+    for id_emprestimo in ids_emprestimos:
+        if id_emprestimo in fechados:
+            item = {'status': 'devolvido', 'id_livro': abertos[id_emprestimo]}
+        elif id_emprestimo in ja_devolvidos or id_emprestimo in abertos:
+            item = {'status': 'ja_devolvido'}
+        else:
+            item = {'status': 'nao_encontrado'}
+        resultado_emprestimos.append({'id_emprestimo': id_emprestimo, **item})
+
+    resultado_livros = []
+    for id_livro in ids_livros:
+        devolvidos = [id for id in emprestimos_do_livro.get(id_livro, []) if id in fechados]
+        if devolvidos:
+            resultado_livros.append({'id_livro': id_livro, 'status': 'devolvido', 'id_emprestimos': devolvidos})
+        else:
+            resultado_livros.append({'id_livro': id_livro, 'status': 'sem_emprestimo_aberto'})
 
-                elif tipo_tempo == 'w':
-                    data_devolucao = data_emprestimo + relativedelta(weeks=tempo_emprestimo)
+    return resultado_emprestimos, resultado_livros, fechados, livros_liberados
 
-                elif tipo_tempo == 'm':
-                    data_devolucao = data_emprestimo + relativedelta(months=tempo_emprestimo)
 
-                elif tipo_tempo == 'y':
-                    data_devolucao = data_emprestimo + relativedelta(years=tempo_emprestimo)
+@rotas.route('/emprestimos/devolucoes', methods=['POST']) # Administradores
+def devolver_emprestimos_lote():
+    """
+        Devolver vários emprestimos de uma vez
 
-                # ano_devolucao = '{}'.format(data_devolucao[:4])
-                # mes_devolucao = '{}'.format(data_devolucao[5:7])
-                # dia_devolucao = '{}'.format(data_devolucao[8:])
+        ### Endpoint:
+            POST /emprestimos/devolucoes
 
-                # obj_data_devolucao = date(int(ano_devolucao), int(mes_devolucao), int(dia_devolucao))
+        ### Corpo:
+        - `emprestimos` **(list[int])**: ids dos emprestimos devolvidos (opcional)
+        - `livros` **(list[int])**: ids dos livros devolvidos; fecha o emprestimo em andamento de cada um (opcional)
 
-                delta = data_devolucao - obj_data_emprestimo
-                print('delta:', delta, 'delta days:', delta.days)
+        Os emprestimos são finalizados e os livros liberados com UPDATEs em
+        lote numa única transação: ou tudo é gravado ou nada é.
 
-                if not data_emprestimo or not data_devolucao or not usuario_id or not livro_id or delta.days < 0:
-                    raise ValueError
-                else:
-                    livro_emprestado = select(Livro).where(Livro.id_livro == livro_id)
-                    livro_emprestado = db_session.execute(livro_emprestado).scalar()
-                    if not livro_emprestado.status_emprestado:
-                        post = Emprestimo(data_devolucao=data_devolucao,
-                                          data_emprestimo=data_emprestimo,
-                                          ID = usuario_id,
-                                          ID_livro =livro_id
-                                          )
-                        post.save(db_session)
-                        db_session.close()
-                        livro_emprestado.status = True
-                        return jsonify({'result': 'Emprestimo criado com sucesso!'}), 200
-                    else:
-                        return jsonify(
-                            {'result': 'Error. Integrity Error (faltam informações ou informações corretas) '}), 400
-            else:
-                raise ValueError
-        else:
-            raise ValueError
+        ### Erros possíveis:
+        - **Bad Request**: *status code* **400**
 
+        ### Retorna:
+        - **JSON** com o resultado de cada item (`emprestimos` e `livros`) e o total `devolvidos`
+    """
+    try:
+        dados = request.get_json()
+        if not isinstance(dados, dict) or not (dados.get('emprestimos') or dados.get('livros')):
+            raise BadRequest('Informe a lista de emprestimos e/ou de livros')
+        ids_emprestimos = ler_ids(dados['emprestimos']) if dados.get('emprestimos') else []
+        ids_livros = ler_ids(dados['livros']) if dados.get('livros') else []
+
+        resultado_emprestimos, resultado_livros, fechados, livros_liberados = executar_escrita(
+            lambda db_session: devolver_emprestimos(db_session, ids_emprestimos, ids_livros))
+        cache_entidades.invalidar('emprestimo', *fechados)
+        cache_entidades.invalidar('livro', *livros_liberados)
+
+        return jsonify({
+            'result': {'emprestimos': resultado_emprestimos, 'livros': resultado_livros},
+            'devolvidos': len(fechados),
+        }), 200
+    except PoolTimeoutError:
+        raise
     except Exception as e:
-        return jsonify({"error": str(e)}), 400
-    finally:
-        db_session.close()
+        return jsonify({'error': f'{e}'}), 400
 
-@app.route('/livros', methods=['POST']) # Administradores
+@rotas.route('/livros', methods=['POST']) # Administradores
 def novo_livro():
     """
         Cadastrar livros
@@ -411,7 +1697,6 @@ def novo_livro():
         ### Retorna:
         - **JSON** mensagem de **sucesso**
     """
-    db_session = local_session()
     try:
         json_dados_livro = request.get_json()
         titulo = json_dados_livro['titulo']
@@ -422,21 +1707,335 @@ def novo_livro():
         if not titulo or not autor or not isbn:
             raise ValueError
         else:
-            post = Livro(titulo=titulo,
-                         autor=autor,
-                         descricao=descricao,
-                         isbn=isbn,
-                         status_emprestado=False)
-            post.save(db_session)
-            db_session.close()
+            def operacao(db_session):
+                post = Livro(titulo=titulo,
+                             autor=autor,
+                             descricao=descricao,
+                             isbn=isbn,
+                             status_emprestado=False)
+                db_session.add(post)
+                db_session.flush()
+                return post.id_livro
+
+            id_livro = executar_escrita(operacao)
+            cache_entidades.invalidar('livro', id_livro)
             return jsonify({'result': 'Livro criado com sucesso!'}), 200
 
+    except PoolTimeoutError:
+        raise
     except Exception as e:
         return jsonify({"error": str(e)}), 400
-    finally:
-        db_session.close()
 
-@app.route('/usuarios/<id_user>', methods=['PUT']) # Administradores
+# importacao em massa de livros: linhas por INSERT executemany (e por commit)
+TAMANHO_LOTE_VALIDACAO = 1000
+
+
+def validar_livro(dados):
+    """
+        Valida um livro recebido na importação em massa.
+
+        Retorna o dicionário pronto para o INSERT ou levanta `ValueError`
+        com a descrição do problema.
+    """
+    if not isinstance(dados, dict):
+        raise ValueError('Linha não é um objeto JSON')
+    faltando = [campo for campo in ('titulo', 'autor', 'isbn') if not dados.get(campo)]
+    if faltando:
+        raise ValueError('Campos obrigatórios ausentes: {}'.format(', '.join(faltando)))
+    return {
+        'titulo': str(dados['titulo']),
+        'autor': str(dados['autor']),
+        'isbn': str(dados['isbn']),
+        'descricao': dados.get('descricao'),
+        'status_emprestado': False,
+        'livro_ativo': True,
+    }
+
+
+def ler_linhas_bulk():
+    """
+        Gera os objetos enviados no corpo da requisição.
+
+        Aceita um array JSON (`application/json`), NDJSON
+        (`application/x-ndjson`) ou CSV com cabeçalho (`text/csv`). NDJSON e
+        CSV são lidos linha a linha do stream sem carregar o corpo inteiro.
+        Linhas NDJSON inválidas são geradas como a exceção correspondente
+        para entrarem no relatório de erros.
+    """
+    if request.mimetype == 'text/csv':
+        texto = io.TextIOWrapper(request.stream, encoding=request.mimetype_params.get('charset', 'utf-8'))
+        yield from csv.DictReader(texto)
+    elif request.mimetype in ('application/x-ndjson', 'application/ndjson'):
+        for linha in request.stream:
+            linha = linha.strip()
+            if not linha:
+                continue
+            try:
+                yield current_app.json.loads(linha)
+            except ValueError as e:
+                yield ValueError(f'JSON inválido: {e}')
+    else:
+        dados = request.get_json()
+        if not isinstance(dados, list):
+            raise BadRequest('Esperado um array JSON')
+        yield from dados
+
+
+def inserir_lote_livros(db_session, lote, erros):
+    """
+        Insere um lote validado com um único INSERT executemany.
+
+        Se o lote falhar no banco, ele é refeito linha a linha para que só
+        as linhas problemáticas entrem no relatório de erros.
+    """
+    # a conexão é pega fora do try: sem conexão (timeout do pool) o erro
+    # é da requisição inteira e não das linhas do lote
+    db_session.connection()
+    try:
+        with db_session.begin_nested():
+            db_session.execute(insert(Livro), [linha for _, linha in lote])
+        return len(lote)
+    except Exception:
+        inseridos = 0
+        for numero, linha in lote:
+            try:
+                with db_session.begin_nested():
+                    db_session.execute(insert(Livro), [linha])
+                inseridos += 1
+            except Exception as e:
+                erros.append({'linha': numero, 'error': str(e)})
+        return inseridos
+
+
+@rotas.route('/livros/bulk', methods=['POST']) # Administradores
+def novo_livro_bulk():
+    """
+        Cadastrar livros em massa
+
+        ### Endpoint:
+            POST /livros/bulk
+
+        ### Corpo:
+        - `application/json`: array de livros
+        - `application/x-ndjson`: um livro por linha
+
+        Cada livro tem `titulo`, `autor`, `isbn` e `descricao` (opcional).
+        Linhas inválidas não interrompem a importação, elas são listadas em `erros`.
+
+        O corpo é lido e validado sem conexão; a conexão de escrita (o pool
+        de escrita tem uma só) fica com a requisição apenas durante o INSERT
+        e o commit de cada lote, e as outras escritas entram entre um lote e
+        outro mesmo com um cliente lento enviando o corpo.
+
+        Como cada lote tem o seu commit, uma falha no meio (corpo truncado ou
+        mal codificado, erro no banco) não desfaz os lotes já gravados: a
+        resposta de erro traz os `inseridos` até ali, os `erros` dessas linhas
+        e a `linha` a partir da qual o corpo deve ser reenviado.
+
+        ### Erros possíveis:
+        - **Bad Request**: *status code* **400** (com `inseridos`, `erros` e `linha` se a falha veio no meio)
+        - **Service Unavailable**: *status code* **503** (sem conexão de escrita livre no `DATABASE_POOL_TIMEOUT`)
+
+        ### Retorna:
+        - **JSON** com a quantidade de livros `inseridos` e a lista de `erros` por linha
+    """
+    db_session = obter_sessao()
+    inseridos = 0
+    erros = []
+    # primeira linha ainda não gravada
+    pendente = 1
+    try:
+        lote = []
+
+        for numero, dados in enumerate(ler_linhas_bulk(), start=1):
+            try:
+                if isinstance(dados, Exception):
+                    raise dados
+                lote.append((numero, validar_livro(dados)))
+            except ValueError as e:
+                erros.append({'linha': numero, 'error': str(e)})
+
+            if len(lote) >= TAMANHO_LOTE_VALIDACAO:
+                gravados = inserir_lote_livros(db_session, lote, erros)
+                # o commit devolve a conexão de escrita ao pool antes de ler o próximo lote
+                db_session.commit()
+                inseridos += gravados
+                pendente = numero + 1
+                lote = []
+
+        gravados = inserir_lote_livros(db_session, lote, erros) if lote else 0
+        db_session.commit()
+        inseridos += gravados
+
+        return jsonify({'result': {'inseridos': inseridos, 'erros': erros}}), 200
+    except PoolTimeoutError:
+        db_session.rollback()
+        raise
+    except Exception as e:
+        db_session.rollback()
+        return jsonify({'error': str(e), 'inseridos': inseridos, 'linha': pendente,
+                        'erros': [erro for erro in erros if erro['linha'] < pendente]}), 400
+
+# sincronização em massa de usuarios pelo cpf
+TAMANHO_LOTE_SYNC = 5000
+
+
+def formatar_cpf(cpf):
+    """
+        Normaliza o CPF para o formato guardado no banco (`000.000.000-00`).
+
+        Aceita o CPF com ou sem pontuação; levanta `ValueError` se não tiver 11 dígitos.
+    """
+    digitos = ''.join(c for c in str(cpf) if c.isdigit())
+    if len(digitos) != 11:
+        raise ValueError('CPF deve ter 11 dígitos')
+    return '{0}.{1}.{2}-{3}'.format(digitos[:3], digitos[3:6], digitos[6:9], digitos[9:])
+
+
+def formatar_telefone(telefone):
+    """
+        Normaliza o telefone com 11 dígitos para `00 00000-0000`; outros ficam como vieram.
+
+        Usado em todas as escritas (cadastro, edição e sync), para que o
+        upsert do sync compare o mesmo formato que está no banco.
+    """
+    digitos = ''.join(c for c in str(telefone) if c.isdigit())
+    if len(digitos) == 11:
+        return '{} {}-{}'.format(digitos[:2], digitos[2:7], digitos[7:])
+    return str(telefone)
+
+
+def validar_usuario(dados):
+    """
+        Valida um usuario recebido na sincronização.
+
+        Retorna o dicionário pronto para o upsert ou levanta `ValueError`.
+    """
+    if not isinstance(dados, dict):
+        raise ValueError('Linha não é um objeto')
+    faltando = [campo for campo in ('nome', 'cpf', 'telefone') if not dados.get(campo)]
+    if faltando:
+        raise ValueError('Campos obrigatórios ausentes: {}'.format(', '.join(faltando)))
+    ativo = dados.get('usuario_ativo', True)
+    if ativo in ('1', 1, 'True', 'true', True):
+        ativo = True
+    elif ativo in ('0', 0, 'False', 'false', False):
+        ativo = False
+    else:
+        raise ValueError('usuario_ativo inválido')
+    return {
+        'nome': str(dados['nome']).strip(),
+        'cpf': formatar_cpf(dados['cpf']),
+        'telefone': formatar_telefone(dados['telefone']),
+        'usuario_ativo': ativo,
+    }
+
+
+def sincronizar_lote_usuarios(db_session, lote):
+    """
+        Faz o upsert de um lote de usuarios pelo cpf (índice único).
+
+        Os cpfs que já existem são consultados antes para separar inseridos
+        de atualizados; o `WHERE` do `DO UPDATE` faz com que usuarios sem
+        mudanças não sejam regravados. Retorna `(inseridos, atualizados,
+        inalterados, ids_existentes)`.
+    """
+    cpfs = [linha['cpf'] for linha in lote]
+    existentes = {}
+    for inicio in range(0, len(cpfs), TAMANHO_LOTE_IN):
+        existentes.update(db_session.execute(
+            select(Usuario.cpf, Usuario.id).where(Usuario.cpf.in_(cpfs[inicio:inicio + TAMANHO_LOTE_IN]))
+        ).all())
+
+    sql = sqlite_insert(Usuario)
+    sql = sql.on_conflict_do_update(
+        index_elements=[Usuario.cpf],
+        set_={
+            'nome': sql.excluded.nome,
+            'telefone': sql.excluded.telefone,
+            'usuario_ativo': sql.excluded.usuario_ativo,
+        },
+        where=or_(Usuario.nome.is_distinct_from(sql.excluded.nome),
+                  Usuario.telefone.is_distinct_from(sql.excluded.telefone),
+                  Usuario.usuario_ativo.is_distinct_from(sql.excluded.usuario_ativo))
+    )
+    # rowcount do executemany soma as linhas inseridas e as atualizadas
+    alteradas = db_session.connection().execute(sql, lote).rowcount
+
+    inseridos = len(lote) - len(existentes)
+    atualizados = alteradas - inseridos
+    return inseridos, atualizados, len(existentes) - atualizados, list(existentes.values())
+
+
+@rotas.route('/usuarios/sync', methods=['POST']) # Administradores
+def sincronizar_usuarios():
+    """
+        Sincronizar usuarios em massa (upsert pelo CPF)
+
+        ### Endpoint:
+            POST /usuarios/sync
+
+        ### Corpo:
+        - `application/json`: array de usuarios
+        - `application/x-ndjson`: um usuario por linha
+        - `text/csv`: cabeçalho `nome,cpf,telefone[,usuario_ativo]`
+
+        Usuarios com CPF novo são inseridos, os existentes têm `nome`,
+        `telefone` e `usuario_ativo` atualizados. Se o mesmo CPF aparecer
+        mais de uma vez, vale a última linha. Como no `/livros/bulk`, a
+        conexão de escrita só é usada durante o upsert de cada lote.
+
+        ### Erros possíveis:
+        - **Bad Request**: *status code* **400**
+        - **Service Unavailable**: *status code* **503** (sem conexão de escrita livre no `DATABASE_POOL_TIMEOUT`)
+
+        ### Retorna:
+        - **JSON** com a quantidade de usuarios `inseridos`, `atualizados`,
+          `inalterados` e a lista de `erros` por linha
+    """
+    db_session = obter_sessao()
+    try:
+        totais = {'inseridos': 0, 'atualizados': 0, 'inalterados': 0}
+        erros = []
+        lote = {}
+        ids_alterados = []
+
+        def enviar_lote():
+            # o lote já foi lido e validado; o commit devolve a conexão de escrita ao pool
+            inseridos, atualizados, inalterados, ids = sincronizar_lote_usuarios(db_session, list(lote.values()))
+            db_session.commit()
+            totais['inseridos'] += inseridos
+            totais['atualizados'] += atualizados
+            totais['inalterados'] += inalterados
+            ids_alterados.extend(ids)
+            lote.clear()
+
+        for numero, dados in enumerate(ler_linhas_bulk(), start=1):
+            try:
+                if isinstance(dados, Exception):
+                    raise dados
+                usuario = validar_usuario(dados)
+            except ValueError as e:
+                erros.append({'linha': numero, 'error': str(e)})
+                continue
+            # dict por cpf: repetições dentro do lote ficam com a última linha
+            lote.pop(usuario['cpf'], None)
+            lote[usuario['cpf']] = usuario
+            if len(lote) >= TAMANHO_LOTE_SYNC:
+                enviar_lote()
+        if lote:
+            enviar_lote()
+
+        cache_entidades.invalidar('usuario', *ids_alterados)
+        return jsonify({'result': dict(totais, erros=erros)}), 200
+    except PoolTimeoutError:
+        db_session.rollback()
+        raise
+    except Exception as e:
+        db_session.rollback()
+        return jsonify({"error": str(e)}), 400
+
+@rotas.route('/usuarios/<id_user>', methods=['PUT']) # Administradores
 def editar_usuarios(id_user):
     """
         Editar usuarios
@@ -453,13 +2052,8 @@ def editar_usuarios(id_user):
         ### Retorna:
         - **JSON** mensagem de **sucesso**
     """
-    db_session = local_session()
-
     try:
         id_usuario = id_user
-        usuario_sql = select(Usuario).where(Usuario.id == id_usuario)
-        usuario = db_session.execute(usuario_sql).scalar()
-
         json_dados_usuario = request.get_json()
         telefone = ''
         cpf = ''
@@ -475,61 +2069,50 @@ def editar_usuarios(id_user):
             if 'usuario_ativo' in json_dados_usuario:
                 usuario_ativo = json_dados_usuario['usuario_ativo']
 
-            if nome != '':
-                if not nome == '':
+            def operacao(db_session):
+                usuario_sql = select(Usuario).where(Usuario.id == id_usuario)
+                usuario = db_session.execute(usuario_sql).scalar()
+                if usuario is None:
+                    raise BadRequest('Id do usuario não encontrado')
+
+                if nome != '':
                     usuario.nome = nome
-                else:
-                    raise ValueError
-            if cpf != '':
-                cpf = str(cpf)
-
-                if not cpf == '':
-                    if len(cpf) == 11:
-                        cpf_f = '{0}.{1}.{2}-{3}'.format(cpf[:3], cpf[3:6], cpf[6:9], cpf[9:])
-                        select_usuario = select(Usuario).where(Usuario.cpf == cpf_f)
-                        sql_usuario = db_session.execute(select_usuario).scalars()
-                        if sql_usuario:
-                            print('cpf igaullllll')
-                            raise ValueError
-                        else:
-                            usuario.cpf = cpf_f
+                if cpf != '':
+                    cpf_f = formatar_cpf(cpf)
+                    select_usuario = select(Usuario.id).where(Usuario.cpf == cpf_f)
+                    sql_usuario = db_session.execute(select_usuario).scalar()
+                    if sql_usuario is not None and sql_usuario != usuario.id:
+                        raise ValueError('CPF já cadastrado')
+                    usuario.cpf = cpf_f
+                if telefone != '':
+                    if len(telefone) == 11:
+                        usuario.telefone = formatar_telefone(str(telefone))
                     else:
                         raise ValueError
-                else:
-                    raise ValueError
-            if telefone != '':
-                tel = str(telefone)
-                if not telefone == '':
-                    if len(telefone) == 11:
-                        tel_f = '{} {}-{}'.format(tel[:2], tel[2:7], tel[7:])
-                        usuario.telefone = tel_f
+                if usuario_ativo != '':
+                    if usuario_ativo in ['1','True', 'true']:
+                        usuario.usuario_ativo = True
+                    elif usuario_ativo in ['0','False', 'false']:
+                        usuario.usuario_ativo = False
                     else:
                         raise ValueError
-                else:
-                    raise ValueError
-            if usuario_ativo != '':
-                if usuario_ativo in ['1','True', 'true']:
-                    usuario.usuario_ativo = True
-                elif usuario_ativo in ['0','False', 'false']:
-                    usuario.usuario_ativo = False
-                else:
-                    raise ValueError
+                db_session.flush()
+                return usuario.id
 
-            usuario.save(db_session)
-            db_session.close()
+            cache_entidades.invalidar('usuario', executar_escrita(operacao))
             return jsonify({'result': 'Usuario editado com sucesso!'}), 200
 
         else:
             raise ValueError
 
+    except PoolTimeoutError:
+        raise
     except Exception as e:
         return jsonify({"error": str(e)}), 400
-    finally:
-        db_session.close()
 
 
 
-@app.route('/livros/<id_livro>', methods=['PUT']) # Administradores
+@rotas.route('/livros/<id_livro>', methods=['PUT']) # Administradores
 def editar_livros(id_livro):
     """
         Editar livros
@@ -546,11 +2129,7 @@ def editar_livros(id_livro):
         ### Retorna:
         - **JSON** mensagem de **sucesso**
     """
-    db_session = local_session()
     try:
-        id_livro = id_livro
-        livro_sql = select(Livro).where(Livro.id_livro == id_livro)
-        livro = db_session.execute(livro_sql).scalar()
         json_dados_livro = request.get_json()
         # status_emprestado = request.form['autor']
         isbn = ''
@@ -567,42 +2146,51 @@ def editar_livros(id_livro):
                 autor = json_dados_livro['autor']
             if 'descricao' in json_dados_livro:
                 descricao = json_dados_livro['descricao']
+            if 'livro_ativo' in json_dados_livro:
+                livro_ativo = str(json_dados_livro['livro_ativo'])
 
-            if titulo != '':
-                livro.titulo = titulo
+            def operacao(db_session):
+                livro_sql = select(Livro).where(Livro.id_livro == id_livro)
+                livro = db_session.execute(livro_sql).scalar()
+                if livro is None:
+                    raise BadRequest('Id do livro não encontrado')
 
-            if autor != '':
-                livro.autor = autor
+                if titulo != '':
+                    livro.titulo = titulo
 
-            if descricao is not None:
-                livro.descricao = descricao
+                if autor != '':
+                    livro.autor = autor
 
-            if isbn != '':
-                int(isbn)
-                livro.isbn = isbn
+                if descricao is not None:
+                    livro.descricao = descricao
 
-            if livro_ativo != '':
-                if livro_ativo in ['1','True', 'true']:
-                    status = True
-                elif livro_ativo in ['0','False', 'false']:
-                    status = False
-                else:
-                    raise ValueError
-                livro.livro_ativo = status
+                if isbn != '':
+                    int(isbn)
+                    livro.isbn = isbn
 
-            livro.save(db_session)
-            db_session.close()
+                if livro_ativo != '':
+                    if livro_ativo in ['1','True', 'true']:
+                        status = True
+                    elif livro_ativo in ['0','False', 'false']:
+                        status = False
+                    else:
+                        raise ValueError
+                    livro.livro_ativo = status
+                db_session.flush()
+                return livro.id_livro
+
+            cache_entidades.invalidar('livro', executar_escrita(operacao))
             return jsonify({'result': 'Livro editado com sucesso!'}), 200
 
         else:
             raise TypeError
+    except PoolTimeoutError:
+        raise
     except Exception as e:
         return jsonify({"error": str(e)}), 400
-    finally:
-        db_session.close()
 
 
-@app.route('/emprestimos/<id_emp>', methods=['PUT']) # Administradores
+@rotas.route('/emprestimos/<id_emp>', methods=['PUT']) # Administradores
 def editar_emprestimos(id_emp):
     """
         Editar emprestimos
@@ -615,19 +2203,13 @@ def editar_emprestimos(id_emp):
 
         ### Erros possíveis:
         - **Bad Request**: *status code* **400**
+        - **Conflict**: *status code* **409** (reabrir um emprestimo cujo período já foi ocupado)
 
         ### Retorna:
         - **JSON** mensagem de **sucesso**
     """
-    db_session = local_session()
     try:
         id_emprestimo = id_emp
-        emprestimo_sql = select(Emprestimo, Usuario, Livro).join(
-            Usuario, Emprestimo.ID == Usuario.id).join(
-            Livro, Emprestimo.ID_livro == Livro.id_livro).where(
-            Emprestimo.id_emprestimo == id_emprestimo)
-        emprestimo = db_session.execute(emprestimo_sql).scalar()
-
         json_dados_emprestimo = request.get_json()
 
         if 'status' in json_dados_emprestimo:
@@ -639,9 +2221,46 @@ def editar_emprestimos(id_emp):
                     status = False
                 else:
                     raise ValueError
-                emprestimo.status_finalizado = status
-                emprestimo.save(db_session)
-                db_session.close()
+
+                def operacao(db_session):
+                    emprestimo_sql = select(Emprestimo).join(
+                        Usuario, Emprestimo.ID == Usuario.id).join(
+                        Livro, Emprestimo.ID_livro == Livro.id_livro).where(
+                        Emprestimo.id_emprestimo == id_emprestimo)
+                    emprestimo = db_session.execute(emprestimo_sql).scalar()
+                    if emprestimo is None:
+                        raise BadRequest('Emprestimo com id inserido não encontrado')
+
+                    if emprestimo.status_finalizado and not status:
+                        # reabrir ocupa o período de novo; o UPDATE vem antes da
+                        # verificação pelo mesmo motivo do novo_emprestimo (lock de escrita)
+                        em_andamento = emprestimo.data_emprestimo <= date.today()
+                        db_session.execute(update(Livro).where(Livro.id_livro == emprestimo.ID_livro)
+                                           .values(status_emprestado=True if em_andamento else Livro.status_emprestado)
+                                           .execution_options(synchronize_session=False))
+                        if buscar_conflito(db_session, emprestimo.ID_livro, emprestimo.data_emprestimo,
+                                           emprestimo.data_devolucao, ignorar=emprestimo.id_emprestimo) is not None:
+                            periodos = db_session.execute(sql_periodos(
+                                emprestimo.ID_livro, emprestimo.data_emprestimo, ignorar=emprestimo.id_emprestimo)).all()
+                            raise PeriodoOcupado(proxima_data_livre(
+                                periodos, emprestimo.data_emprestimo,
+                                (emprestimo.data_devolucao - emprestimo.data_emprestimo).days))
+                    if status and not emprestimo.status_finalizado:
+                        # grava a multa e o atraso do dia da devolução
+                        emprestimo.status_atrasado, emprestimo.multa = emprestimo.atraso()
+                    elif not status and emprestimo.status_finalizado:
+                        # reaberto já vencido: a varredura só vê os que vencem depois dela
+                        emprestimo.status_atrasado = emprestimo.data_devolucao < date.today()
+                    emprestimo.status_finalizado = status
+                    db_session.flush()
+                    if status:
+                        # a devolução também libera o livro (mesma transação)
+                        liberar_livros(db_session, [emprestimo.ID_livro])
+                    return emprestimo.ID_livro
+
+                id_livro = executar_escrita(operacao)
+                cache_entidades.invalidar('emprestimo', id_emprestimo)
+                cache_entidades.invalidar('livro', id_livro)
                 return jsonify({'result': 'Emprestimo editado com sucesso!'}), 200
 
             else:
@@ -649,15 +2268,92 @@ def editar_emprestimos(id_emp):
         else:
             raise TypeError
 
+    except PeriodoOcupado as e:
+        return jsonify({'error': 'Livro já está emprestado no período',
+                        'proxima_data_livre': e.proxima_data_livre.isoformat()}), 409
+    except PoolTimeoutError:
+        raise
     except Exception as e:
         return jsonify({"error": str(e)}), 400
-    finally:
-        db_session.close()
 
-    print('teste git')
 
+@rotas.cli.command('reconstruir-busca')
+def reconstruir_busca():
+    """Refaz o índice de busca textual dos livros."""
+    garantir_migracoes()
+    with engine.begin() as conn:
+        reconstruir_indice_busca(conn)
+    print('Índice de busca reconstruído')
+
+
+@rotas.cli.command('reconciliar-estatisticas')
+def reconciliar_contadores():
+    """Recalcula do zero os contadores de GET /estatisticas."""
+    garantir_migracoes()
+    with engine.begin() as conn:
+        reconciliar_estatisticas(conn)
+    print('Estatísticas recalculadas')
+
+
+@rotas.cli.command('gerar-openapi')
+def gerar_openapi():
+    """Gera o documento OpenAPI e grava o cache em disco."""
+    spec = current_app.extensions['openapi']
+    print('{} rotas documentadas; cache em {}'.format(len(spec.spec['paths']), spec.caminho_cache))
+
+
+@rotas.cli.command('compactar-mudancas')
+def compactar_mudancas_cli():
+    """Deixa no log de mudanças só a última mudança de cada registro."""
+    garantir_migracoes()
+    resultado = compactar_mudancas(engine)
+    print('{} registros compactados, {} mudanças removidas'.format(resultado['registros'], resultado['removidas']))
 
-if __name__ == '__main__':
-    app.run(debug=True, host='0.0.0.0', port=5001)
 
-# teste de push git
+@rotas.cli.command('varrer-atrasos')
+def varrer_atrasos_cli():
+    """Marca os emprestimos que venceram e os livros das reservas iniciadas."""
+    garantir_migracoes()
+    resultado = varrer_atrasos()
+    print('Varredura de {}: {} emprestimos atualizados'.format(resultado['data_referencia'], resultado['atualizados']))
+    reservas = marcar_reservas_iniciadas()
+    print('Reservas iniciadas: {} livros marcados como emprestados'.format(reservas['atualizados']))
+
+
+def iniciar_worker(numero):
+    """
+        Roda em cada worker do `servidor.py` logo depois do fork.
+    """
+    # as conexões abertas pelo mestre (migrações) não podem ser usadas por
+    # dois processos; close=False não as fecha no mestre, só esquece o pool
+    for e in (engine, engine_leitura):
+        if e.criado:
+            e.dispose(close=False)
+    # a varredura de atrasos roda em um worker só
+    if numero == 0 and INTERVALO_VARREDURA > 0:
+        iniciar_agendador(INTERVALO_VARREDURA)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='API da biblioteca')
+    parser.add_argument('--workers', type=int, default=0, help='processos (0: servidor de desenvolvimento)')
+    parser.add_argument('--threads', type=int, default=8, help='threads por processo')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--porta', type=int, default=5001)
+    args = parser.parse_args()
+    app = create_app()
+
+    if args.workers > 0:
+        from servidor import servir
+        # migrações e documento OpenAPI uma vez no mestre, antes do fork
+        garantir_migracoes()
+        app.extensions['openapi'].spec
+        servir(app, args.host, args.porta, args.workers, args.threads, ao_iniciar=iniciar_worker)
+    else:
+        # com o reloader do modo debug o agendador só roda no processo que atende
+        # as requisições (WERKZEUG_RUN_MAIN), não no que observa os arquivos
+        if INTERVALO_VARREDURA > 0 and os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+            iniciar_agendador(INTERVALO_VARREDURA)
+        app.run(debug=True, host=args.host, port=args.porta)
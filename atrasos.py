@@ -0,0 +1,141 @@
+#varredura periódica dos emprestimos que venceram (status_atrasado) e das reservas que começaram.
+import logging
+import os
+import threading
+from datetime import date
+
+from sqlalchemy import select, update, func, literal, Float
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from models import engine, Emprestimo, Livro, Varredura, MULTA_DIARIA
+from cache import cache_entidades
+
+logger = logging.getLogger('bancoAPI.atrasos')
+
+NOME_VARREDURA = 'atrasos'
+NOME_RESERVAS = 'reservas'
+# emprestimos atualizados por transação, para não segurar o lock de escrita
+TAMANHO_LOTE_VARREDURA = 1000
+# intervalo do agendador em segundos (VARREDURA_INTERVALO, 0 desliga)
+INTERVALO_VARREDURA = float(os.environ.get('VARREDURA_INTERVALO', 3600))
+
+
+def expressao_multa(hoje, multa_diaria=MULTA_DIARIA):
+    """
+        Multa acumulada até `hoje` em SQL (a mesma conta de `Emprestimo.atraso`).
+    """
+    dias = func.julianday(hoje) - func.julianday(Emprestimo.data_devolucao)
+    return func.max(func.round(dias * multa_diaria, 2), literal(0.0, Float))
+
+
+def varrer_atrasos(bind=engine, hoje=None, tamanho_lote=TAMANHO_LOTE_VARREDURA):
+    """
+        Marca `status_atrasado` dos emprestimos em aberto que venceram.
+
+        A marca d'água guarda a última data processada e os candidatos são
+        os emprestimos em aberto, ainda não marcados, com `data_devolucao`
+        em [marca, hoje): uma faixa do índice (`status_finalizado`,
+        `data_devolucao`) com só os que venceram desde a última varredura.
+        Emprestimos gravados já vencidos (cadastrados com data passada ou
+        reabertos) são marcados na própria escrita. A multa não é gravada
+        aqui: em aberto ela é calculada na leitura (`Emprestimo.atraso`) e
+        gravada na devolução, então cada emprestimo é atualizado uma vez
+        só, quando vence, e não a cada dia de atraso.
+
+        Retorna `{'data_referencia', 'atualizados'}`.
+    """
+    hoje = hoje or date.today()
+    em_atraso = (Emprestimo.status_finalizado == False, Emprestimo.status_atrasado == False,
+                 Emprestimo.data_devolucao < hoje)
+    with bind.connect() as conn:
+        marca = conn.execute(select(Varredura.data_referencia).where(Varredura.nome == NOME_VARREDURA)).scalar()
+        sql = select(Emprestimo.id_emprestimo).where(*em_atraso)
+        if marca is not None:
+            sql = sql.where(Emprestimo.data_devolucao >= marca)
+        ids = conn.execute(sql).scalars().all()
+
+    # uma conexão por lote: as requisições de escrita entram entre um lote e outro
+    atualizados = 0
+    for inicio in range(0, len(ids), tamanho_lote):
+        lote = ids[inicio:inicio + tamanho_lote]
+        with bind.begin() as conn:
+            # o filtro é repetido porque o emprestimo pode ter sido finalizado nesse meio tempo
+            resultado = conn.execute(update(Emprestimo).where(
+                Emprestimo.id_emprestimo.in_(lote), *em_atraso).values(status_atrasado=True))
+        atualizados += resultado.rowcount
+        cache_entidades.invalidar('emprestimo', *lote)
+
+    # a marca não volta (ex.: uma execução manual com uma data anterior)
+    gravar_marca(bind, NOME_VARREDURA, max(hoje, marca) if marca else hoje, atualizados)
+    logger.info('varredura de atrasos de %s: %d emprestimos atualizados', hoje, atualizados)
+    return {'data_referencia': hoje.isoformat(), 'atualizados': atualizados}
+
+
+def gravar_marca(bind, nome, hoje, atualizados):
+    with bind.begin() as conn:
+        sql = sqlite_insert(Varredura).values(nome=nome, data_referencia=hoje, atualizados=atualizados)
+        conn.execute(sql.on_conflict_do_update(index_elements=[Varredura.nome], set_={
+            'data_referencia': sql.excluded.data_referencia,
+            'atualizados': sql.excluded.atualizados,
+        }))
+
+
+def marcar_reservas_iniciadas(bind=engine, hoje=None, tamanho_lote=TAMANHO_LOTE_VARREDURA):
+    """
+        Marca `status_emprestado` dos livros cujas reservas começaram.
+
+        O novo_emprestimo só marca o livro quando o emprestimo já começou;
+        as reservas entram aqui no dia do início. A marca d'água guarda a
+        última data processada e os candidatos são os emprestimos em aberto
+        com início em (marca, hoje], uma faixa do índice de `data_emprestimo`.
+
+        Retorna `{'data_referencia', 'atualizados'}`.
+    """
+    hoje = hoje or date.today()
+    with bind.connect() as conn:
+        marca = conn.execute(select(Varredura.data_referencia).where(Varredura.nome == NOME_RESERVAS)).scalar()
+        sql = select(Emprestimo.ID_livro).distinct().where(
+            Emprestimo.data_emprestimo <= hoje, Emprestimo.status_finalizado == False)
+        if marca is not None:
+            sql = sql.where(Emprestimo.data_emprestimo > marca)
+        ids = conn.execute(sql).scalars().all()
+
+    atualizados = 0
+    for inicio in range(0, len(ids), tamanho_lote):
+        lote = ids[inicio:inicio + tamanho_lote]
+        with bind.begin() as conn:
+            resultado = conn.execute(update(Livro).where(
+                Livro.id_livro.in_(lote), Livro.status_emprestado == False).values(status_emprestado=True))
+        atualizados += resultado.rowcount
+        cache_entidades.invalidar('livro', *lote)
+
+    gravar_marca(bind, NOME_RESERVAS, hoje, atualizados)
+    if atualizados:
+        logger.info('reservas iniciadas até %s: %d livros marcados como emprestados', hoje, atualizados)
+    return {'data_referencia': hoje.isoformat(), 'atualizados': atualizados}
+
+
+def iniciar_agendador(intervalo=INTERVALO_VARREDURA, bind=engine):
+    """
+        Roda `varrer_atrasos` e `marcar_reservas_iniciadas` agora e depois a
+        cada `intervalo` segundos numa thread daemon.
+
+        Retorna o `threading.Event` que encerra o agendador quando setado.
+    """
+    parar = threading.Event()
+
+    def executar():
+        while True:
+            try:
+                varrer_atrasos(bind)
+            except Exception:
+                logger.exception('falha na varredura de atrasos')
+            try:
+                marcar_reservas_iniciadas(bind)
+            except Exception:
+                logger.exception('falha na marcação das reservas iniciadas')
+            if parar.wait(intervalo):
+                return
+
+    threading.Thread(target=executar, name='varredura-atrasos', daemon=True).start()
+    return parar
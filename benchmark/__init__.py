@@ -0,0 +1 @@
+#benchmarks da API: gerador de dados sintéticos (gerador.py) e executor das rotas (executor.py).
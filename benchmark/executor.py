@@ -0,0 +1,379 @@
+#executor dos benchmarks: chama todas as rotas e mede latência e throughput.
+#
+#uso:
+#   python -m benchmark.executor --livros 5000 --repeticoes 200
+#   python -m benchmark.executor --concorrencia 8 --baseline bench_baseline.json
+#   python -m benchmark.executor --partida 20 --rotas get_livros
+import argparse
+import json
+import os
+import platform
+import subprocess
+import random
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+
+# a configuração do banco (DATABASE_URL) é lida no primeiro uso das engines;
+# benchmark.gerador e app só são importados dentro de main(), depois de
+# DATABASE_URL apontar para o banco de rascunho
+TERMOS_BUSCA = ('dom', 'casm', 'memo', 'sert', 'vida', 'estr', 'mar')
+
+
+class Cenario:
+    """
+        Uma rota do benchmark.
+
+        `gerar(i, rnd, tamanhos)` devolve `(url, corpo_json)` da i-ésima
+        requisição; o corpo é `None` nas rotas sem corpo. `cabecalhos` são
+        enviados em todas as requisições do cenário. `esperados` são os
+        status que a rota pode devolver com os dados gerados (ex.: 409 de um
+        livro já emprestado); qualquer outro conta como erro.
+    """
+
+    def __init__(self, nome, metodo, gerar, escrita=False, cabecalhos=None, esperados=('200',)):
+        self.nome = nome
+        self.metodo = metodo
+        self.gerar = gerar
+        self.escrita = escrita
+        self.cabecalhos = cabecalhos or {}
+        self.esperados = frozenset(esperados)
+
+
+def _id(rnd, tamanhos, entidade):
+    return rnd.randint(1, tamanhos[entidade])
+
+
+def _exportacao(rnd):
+    # um mês do histórico (os emprestimos finalizados do gerador vão até ~4 anos atrás)
+    desde = date.fromordinal(date.today().toordinal() - rnd.randrange(40, 1500))
+    ate = date.fromordinal(desde.toordinal() + 30)
+    return '/emprestimos/export?formato=ndjson&desde={}&ate={}'.format(desde, ate), None
+
+
+CENARIOS = [
+    Cenario('index', 'GET', lambda i, rnd, t: ('/', None)),
+    Cenario('get_livros_pagina', 'GET', lambda i, rnd, t: ('/livros?limit=50&after={}'.format(_id(rnd, t, 'livros')), None)),
+    Cenario('get_livros_stream', 'GET', lambda i, rnd, t: ('/livros', None)),
+    Cenario('get_livros_stream_gzip', 'GET', lambda i, rnd, t: ('/livros', None),
+            cabecalhos={'Accept-Encoding': 'gzip'}),
+    Cenario('get_livros_colunas', 'GET', lambda i, rnd, t: ('/livros?formato=colunas', None)),
+    Cenario('get_livros_fields', 'GET', lambda i, rnd, t: ('/livros?fields=id_livro,titulo', None)),
+    Cenario('get_livros_status', 'GET', lambda i, rnd, t: ('/livros/status1?limit=50', None)),
+    Cenario('get_livros_by_livro_ativo', 'GET', lambda i, rnd, t: ('/livros/livro_ativo0', None)),
+    Cenario('get_livros_by_id_livro', 'GET', lambda i, rnd, t: ('/livros/id{}'.format(_id(rnd, t, 'livros')), None)),
+    Cenario('get_livro_disponibilidade', 'GET', lambda i, rnd, t: ('/livros/id{}/disponibilidade'.format(
+        _id(rnd, t, 'livros')), None)),
+    Cenario('get_livros_busca', 'GET', lambda i, rnd, t: ('/livros/busca?q={}'.format(rnd.choice(TERMOS_BUSCA)), None)),
+    Cenario('get_usuarios_pagina', 'GET', lambda i, rnd, t: ('/usuarios?limit=50&after={}'.format(_id(rnd, t, 'usuarios')), None)),
+    Cenario('get_usuarios_stream', 'GET', lambda i, rnd, t: ('/usuarios', None)),
+    Cenario('get_usuario_by_id', 'GET', lambda i, rnd, t: ('/usuarios/id{}'.format(_id(rnd, t, 'usuarios')), None)),
+    Cenario('get_emprestimos_user', 'GET', lambda i, rnd, t: ('/emprestimos/user{}?expand=livro'.format(_id(rnd, t, 'usuarios')), None)),
+    Cenario('get_emprestimos_pagina', 'GET', lambda i, rnd, t: ('/emprestimos?limit=50&expand=livro,usuario&after={}'.format(_id(rnd, t, 'emprestimos')), None)),
+    Cenario('get_emprestimos_stream', 'GET', lambda i, rnd, t: ('/emprestimos', None)),
+    Cenario('get_emprestimos_atrasados', 'GET', lambda i, rnd, t: ('/emprestimos/atrasados', None)),
+    Cenario('get_emprestimos_vencendo', 'GET', lambda i, rnd, t: ('/emprestimos/vencendo?dias=7', None)),
+    Cenario('get_emprestimos_export', 'GET', lambda i, rnd, t: _exportacao(rnd)),
+    Cenario('get_emprestimo_by_id_emprestimo', 'GET', lambda i, rnd, t: ('/emprestimos/id{}'.format(_id(rnd, t, 'emprestimos')), None)),
+    Cenario('get_cache_estatisticas', 'GET', lambda i, rnd, t: ('/cache/estatisticas', None)),
+    Cenario('get_livros_ids', 'GET', lambda i, rnd, t: ('/livros?ids={}'.format(
+        ','.join(str(_id(rnd, t, 'livros')) for _ in range(50))), None)),
+    Cenario('get_lote_por_ids', 'POST', lambda i, rnd, t: ('/emprestimos/batch?expand=livro', {
+        'ids': [_id(rnd, t, 'emprestimos') for _ in range(500)]})),
+    Cenario('get_lote_livros', 'POST', lambda i, rnd, t: ('/livros/batch', {
+        'ids': [_id(rnd, t, 'livros') for _ in range(100)]})),
+    Cenario('get_lote_usuarios', 'POST', lambda i, rnd, t: ('/usuarios/batch', {
+        'ids': [_id(rnd, t, 'usuarios') for _ in range(100)]})),
+    Cenario('get_estatisticas', 'GET', lambda i, rnd, t: ('/estatisticas', None)),
+    Cenario('get_estatisticas_usuario', 'GET', lambda i, rnd, t: ('/estatisticas/usuario{}'.format(_id(rnd, t, 'usuarios')), None)),
+    Cenario('get_metrics', 'GET', lambda i, rnd, t: ('/metrics', None)),
+    Cenario('get_metrics_sql_lentas', 'GET', lambda i, rnd, t: ('/metrics/sql_lentas', None)),
+    Cenario('get_pronto', 'GET', lambda i, rnd, t: ('/pronto', None)),
+    # o log tem uma mudança (insert) por registro gerado
+    Cenario('get_mudancas', 'GET', lambda i, rnd, t: ('/mudancas?limit=200&desde={}'.format(
+        rnd.randint(0, sum(t.values()))), None)),
+    Cenario('get_mudancas_livro', 'GET', lambda i, rnd, t: ('/mudancas?entidade=livro&limit=200&desde={}'.format(
+        rnd.randint(0, sum(t.values()))), None)),
+    Cenario('get_mudancas_snapshot', 'GET', lambda i, rnd, t: ('/mudancas/snapshot?entidade=livro', None)),
+    Cenario('novo_usuario', 'POST', lambda i, rnd, t: ('/usuarios', {
+        'nome': 'Bench {}'.format(i), 'cpf': '9{:010d}'.format(rnd.randrange(10 ** 10)), 'telefone': '18999999999'}), escrita=True),
+    Cenario('novo_livro', 'POST', lambda i, rnd, t: ('/livros', {
+        'titulo': 'Bench {}'.format(i), 'autor': 'Autor', 'isbn': '123', 'descricao': 'bench'}), escrita=True),
+    Cenario('novo_livro_bulk', 'POST', lambda i, rnd, t: ('/livros/bulk', [
+        {'titulo': 'Bulk {} {}'.format(i, j), 'autor': 'Autor', 'isbn': '123'} for j in range(100)]), escrita=True),
+    Cenario('novo_emprestimo', 'POST', lambda i, rnd, t: ('/emprestimos', {
+        'data_emprestimo': date.today().isoformat(), 'id_usuario': _id(rnd, t, 'usuarios'),
+        'id_livro': _id(rnd, t, 'livros'), 'tempo_emprestimo': 2, 'tipo_tempo': 'w'}), escrita=True,
+            # livro já emprestado (409) ou livro/usuario inativo (400)
+            esperados=('200', '400', '409')),
+    Cenario('novo_emprestimo_reserva', 'POST', lambda i, rnd, t: ('/emprestimos', {
+        'data_emprestimo': date.fromordinal(date.today().toordinal() + rnd.randint(1, 90)).isoformat(),
+        'id_usuario': _id(rnd, t, 'usuarios'), 'id_livro': _id(rnd, t, 'livros'),
+        'tempo_emprestimo': 1, 'tipo_tempo': 'w'}), escrita=True, esperados=('200', '400', '409')),
+    Cenario('sincronizar_usuarios', 'POST', lambda i, rnd, t: ('/usuarios/sync', [
+        {'nome': 'Sync {}'.format(j), 'cpf': '{:011d}'.format(rnd.randint(1, t['usuarios'] * 2)), 'telefone': '18999999999'}
+        for j in range(500)]), escrita=True),
+    Cenario('devolver_emprestimos', 'POST', lambda i, rnd, t: ('/emprestimos/devolucoes', {
+        'livros': [_id(rnd, t, 'livros') for _ in range(20)]}), escrita=True),
+    Cenario('editar_usuarios', 'PUT', lambda i, rnd, t: ('/usuarios/{}'.format(_id(rnd, t, 'usuarios')), {
+        'nome': 'Editado {}'.format(i)}), escrita=True),
+    Cenario('editar_livros', 'PUT', lambda i, rnd, t: ('/livros/{}'.format(_id(rnd, t, 'livros')), {
+        'descricao': 'editado {}'.format(i)}), escrita=True),
+    Cenario('editar_emprestimos', 'PUT', lambda i, rnd, t: ('/emprestimos/{}'.format(_id(rnd, t, 'emprestimos')), {
+        'status': '1'}), escrita=True),
+]
+
+
+def gerador_aleatorio(semente, cenario):
+    # semente própria por rota: a sequência não coincide com a do gerador de dados
+    return random.Random('{}:{}'.format(semente, cenario.nome))
+
+
+def percentil(valores_ordenados, p):
+    """Percentil pelo método nearest-rank."""
+    if not valores_ordenados:
+        return None
+    indice = max(0, int(round(p / 100.0 * len(valores_ordenados) + 0.5)) - 1)
+    return valores_ordenados[min(indice, len(valores_ordenados) - 1)]
+
+
+def resumir(cenario, latencias, status, duracao):
+    latencias = sorted(latencias)
+    total = len(latencias)
+    return {
+        'metodo': cenario.metodo,
+        'requisicoes': total,
+        'erros': sum(n for codigo, n in status.items() if codigo not in cenario.esperados),
+        'status': status,
+        'throughput_rps': round(total / duracao, 2) if duracao else None,
+        'media_ms': round(sum(latencias) / total * 1000, 3) if total else None,
+        'p50_ms': round(percentil(latencias, 50) * 1000, 3) if total else None,
+        'p95_ms': round(percentil(latencias, 95) * 1000, 3) if total else None,
+        'p99_ms': round(percentil(latencias, 99) * 1000, 3) if total else None,
+    }
+
+
+def executar_test_client(app, cenario, repeticoes, tamanhos, semente):
+    """
+        Executa o cenário em sequência pelo test client do Flask (sem rede).
+    """
+    cliente = app.test_client()
+    rnd = gerador_aleatorio(semente, cenario)
+    latencias = []
+    status = {}
+    inicio_total = time.perf_counter()
+    for i in range(repeticoes):
+        url, corpo = cenario.gerar(i, rnd, tamanhos)
+        inicio = time.perf_counter()
+        resposta = cliente.open(url, method=cenario.metodo, json=corpo, headers=cenario.cabecalhos)
+        resposta.get_data()
+        resposta.close()
+        latencias.append(time.perf_counter() - inicio)
+        chave = str(resposta.status_code)
+        status[chave] = status.get(chave, 0) + 1
+    return resumir(cenario, latencias, status, time.perf_counter() - inicio_total)
+
+
+def requisicao_http(base, metodo, url, corpo, cabecalhos):
+    dados = None
+    cabecalhos = dict(cabecalhos)
+    if corpo is not None:
+        dados = json.dumps(corpo).encode()
+        cabecalhos['Content-Type'] = 'application/json'
+    req = urllib.request.Request(base + url, data=dados, method=metodo, headers=cabecalhos)
+    try:
+        with urllib.request.urlopen(req) as resposta:
+            resposta.read()
+            return resposta.status
+    except urllib.error.HTTPError as e:
+        e.read()
+        return e.code
+
+
+def executar_concorrente(base, cenario, repeticoes, tamanhos, semente, concorrencia):
+    """
+        Executa o cenário por HTTP com `concorrencia` requisições simultâneas.
+    """
+    rnd = gerador_aleatorio(semente, cenario)
+    pedidos = [cenario.gerar(i, rnd, tamanhos) for i in range(repeticoes)]
+    lock = threading.Lock()
+    latencias = []
+    status = {}
+
+    def enviar(pedido):
+        url, corpo = pedido
+        inicio = time.perf_counter()
+        codigo = requisicao_http(base, cenario.metodo, url, corpo, cenario.cabecalhos)
+        duracao = time.perf_counter() - inicio
+        with lock:
+            latencias.append(duracao)
+            status[str(codigo)] = status.get(str(codigo), 0) + 1
+
+    inicio_total = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concorrencia) as executor:
+        list(executor.map(enviar, pedidos))
+    return resumir(cenario, latencias, status, time.perf_counter() - inicio_total)
+
+
+# processo novo: importa o app, cria com create_app e atende a primeira requisição
+SCRIPT_PARTIDA = '''
+from app import create_app
+cliente = create_app().test_client()
+print(cliente.get(%r).status_code)
+'''
+PARTIDA_FRIA = Cenario('partida_fria', 'GET', lambda i, rnd, t: ('/livros?limit=20', None))
+
+
+def medir_partida(repeticoes):
+    """
+        Mede a partida a frio: de iniciar o interpretador até a primeira resposta.
+
+        Cada repetição é um processo novo (herda `DATABASE_URL`), então entram
+        os imports, o `create_app`, a criação das engines e a primeira consulta.
+    """
+    url, _ = PARTIDA_FRIA.gerar(0, None, None)
+    raiz = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    latencias = []
+    status = {}
+    inicio_total = time.perf_counter()
+    for _ in range(repeticoes):
+        inicio = time.perf_counter()
+        saida = subprocess.run([sys.executable, '-c', SCRIPT_PARTIDA % url], cwd=raiz,
+                               capture_output=True, text=True)
+        latencias.append(time.perf_counter() - inicio)
+        chave = saida.stdout.strip().splitlines()[-1] if saida.returncode == 0 else '500'
+        status[chave] = status.get(chave, 0) + 1
+    return resumir(PARTIDA_FRIA, latencias, status, time.perf_counter() - inicio_total)
+
+
+def iniciar_servidor(app):
+    """
+        Sobe um servidor local multi-thread em uma porta livre.
+    """
+    from werkzeug.serving import make_server
+    servidor = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=servidor.serve_forever, daemon=True).start()
+    return servidor, 'http://127.0.0.1:{}'.format(servidor.server_port)
+
+
+def comparar(resultado, baseline, tolerancia):
+    """
+        Compara p50/p95 com um resultado anterior.
+
+        Retorna a lista de rotas que ficaram mais lentas que a tolerância (%).
+    """
+    regressoes = []
+    for nome, atual in resultado['rotas'].items():
+        anterior = baseline.get('rotas', {}).get(nome)
+        if not anterior:
+            continue
+        for metrica in ('p50_ms', 'p95_ms'):
+            if not anterior.get(metrica) or atual.get(metrica) is None:
+                continue
+            variacao = (atual[metrica] - anterior[metrica]) / anterior[metrica] * 100
+            marca = ''
+            if variacao > tolerancia:
+                marca = '  <-- regressão'
+                regressoes.append((nome, metrica, round(variacao, 1)))
+            print('{:<34} {:<6} {:>10.3f} -> {:>10.3f} ms ({:+.1f}%){}'.format(
+                nome, metrica, anterior[metrica], atual[metrica], variacao, marca))
+    return regressoes
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark das rotas da API')
+    parser.add_argument('--banco', default='bench_biblioteca.sqlite3', help='arquivo SQLite de rascunho')
+    parser.add_argument('--usuarios', type=int, default=1000)
+    parser.add_argument('--livros', type=int, default=5000)
+    parser.add_argument('--emprestimos', type=int, default=20000)
+    parser.add_argument('--semente', type=int, default=42)
+    parser.add_argument('--manter-banco', action='store_true', help='não recria o banco de rascunho')
+    parser.add_argument('--repeticoes', type=int, default=100, help='requisições por rota')
+    parser.add_argument('--concorrencia', type=int, default=0,
+                        help='usa um servidor local com N requisições simultâneas (0 = test client)')
+    parser.add_argument('--rotas', help='nomes das rotas separados por vírgula (padrão: todas)')
+    parser.add_argument('--sem-escrita', action='store_true', help='executa só as rotas de leitura')
+    parser.add_argument('--partida', type=int, default=0, metavar='N',
+                        help='mede também a partida a frio com N processos novos')
+    parser.add_argument('--saida', default='bench_resultado.json')
+    parser.add_argument('--baseline', help='resultado anterior para comparação')
+    parser.add_argument('--tolerancia', type=float, default=10.0, help='variação máxima aceita (%%)')
+    args = parser.parse_args(argv)
+
+    url = 'sqlite:///' + args.banco
+    os.environ['DATABASE_URL'] = url
+    from benchmark import gerador
+
+    tamanhos = {'usuarios': args.usuarios, 'livros': args.livros, 'emprestimos': args.emprestimos}
+    if not args.manter_banco or not os.path.exists(args.banco):
+        gerador.limpar_banco(args.banco)
+        inicio = time.perf_counter()
+        gerador.popular(url, args.usuarios, args.livros, args.emprestimos, args.semente)
+        print('banco gerado em {:.2f}s'.format(time.perf_counter() - inicio))
+
+    from app import create_app
+    app = create_app({'OPENAPI_CACHE': None})
+
+    cenarios = [c for c in CENARIOS if not (args.sem_escrita and c.escrita)]
+    if args.rotas:
+        nomes = set(args.rotas.split(','))
+        cenarios = [c for c in cenarios if c.nome in nomes]
+    # leituras primeiro, para que as escritas não alterem os dados lidos
+    cenarios.sort(key=lambda c: c.escrita)
+
+    servidor = base = None
+    if args.concorrencia:
+        servidor, base = iniciar_servidor(app)
+
+    rotas = {}
+    try:
+        for cenario in cenarios:
+            if servidor:
+                rotas[cenario.nome] = executar_concorrente(base, cenario, args.repeticoes, tamanhos,
+                                                           args.semente, args.concorrencia)
+            else:
+                rotas[cenario.nome] = executar_test_client(app, cenario, args.repeticoes, tamanhos,
+                                                           args.semente)
+            r = rotas[cenario.nome]
+            print('{:<34} {:>9} rps  p50 {:>9} ms  p95 {:>9} ms  p99 {:>9} ms  erros {:>4}  {}'.format(
+                cenario.nome, r['throughput_rps'], r['p50_ms'], r['p95_ms'], r['p99_ms'], r['erros'], r['status']))
+    finally:
+        if servidor:
+            servidor.shutdown()
+
+    if args.partida:
+        r = rotas[PARTIDA_FRIA.nome] = medir_partida(args.partida)
+        print('{:<34} {:>9} ms  p50 {:>9} ms  p95 {:>9} ms  {}'.format(
+            PARTIDA_FRIA.nome, r['media_ms'], r['p50_ms'], r['p95_ms'], r['status']))
+
+    resultado = {
+        'meta': {
+            'data': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'plataforma': platform.platform(),
+            'repeticoes': args.repeticoes,
+            'concorrencia': args.concorrencia,
+            'semente': args.semente,
+            'tamanhos': tamanhos,
+        },
+        'rotas': rotas,
+    }
+    with open(args.saida, 'w') as arquivo:
+        json.dump(resultado, arquivo, indent=2, sort_keys=True)
+    print('resultado salvo em', args.saida)
+
+    if args.baseline:
+        with open(args.baseline) as arquivo:
+            regressoes = comparar(resultado, json.load(arquivo), args.tolerancia)
+        if regressoes:
+            print('{} regressões acima de {}%'.format(len(regressoes), args.tolerancia))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,131 @@
+#gerador de dados sintéticos para os benchmarks.
+import argparse
+import os
+import random
+from datetime import date, timedelta
+
+from sqlalchemy import insert
+
+from database import criar_engine
+from migracoes import aplicar_migracoes
+from models import Usuario, Livro, Emprestimo
+
+TAMANHO_LOTE = 5000
+
+PALAVRAS = ('dom', 'casmurro', 'memorias', 'postumas', 'sertao', 'veredas', 'grande',
+            'vidas', 'secas', 'hora', 'estrela', 'capitaes', 'areia', 'mar', 'morto',
+            'cortico', 'iracema', 'guarani', 'quincas', 'borba', 'senhora', 'lucola')
+NOMES = ('Ana', 'Bruno', 'Carla', 'Diego', 'Elisa', 'Fabio', 'Gabriela', 'Heitor',
+         'Isabela', 'Joao', 'Larissa', 'Marcos', 'Natalia', 'Otavio', 'Paula', 'Rafael')
+SOBRENOMES = ('Silva', 'Souza', 'Oliveira', 'Santos', 'Pereira', 'Lima', 'Costa', 'Almeida')
+
+
+def em_lotes(linhas, tamanho=TAMANHO_LOTE):
+    lote = []
+    for linha in linhas:
+        lote.append(linha)
+        if len(lote) >= tamanho:
+            yield lote
+            lote = []
+    if lote:
+        yield lote
+
+
+def gerar_usuarios(rnd, quantidade):
+    for i in range(1, quantidade + 1):
+        cpf = '{:011d}'.format(i)
+        yield {
+            'id': i,
+            'nome': '{} {}'.format(rnd.choice(NOMES), rnd.choice(SOBRENOMES)),
+            'cpf': '{0}.{1}.{2}-{3}'.format(cpf[:3], cpf[3:6], cpf[6:9], cpf[9:]),
+            'telefone': '18 9{:04d}-{:04d}'.format(rnd.randrange(10000), rnd.randrange(10000)),
+            'usuario_ativo': rnd.random() > 0.05,
+        }
+
+
+def gerar_livros(rnd, quantidade, emprestados):
+    for i in range(1, quantidade + 1):
+        yield {
+            'id_livro': i,
+            'isbn': '{:013d}'.format(9780000000000 + i),
+            'titulo': ' '.join(rnd.sample(PALAVRAS, 3)).title(),
+            'autor': '{} {}'.format(rnd.choice(NOMES), rnd.choice(SOBRENOMES)),
+            'descricao': ' '.join(rnd.choices(PALAVRAS, k=rnd.randrange(5, 40))),
+            'status_emprestado': i in emprestados,
+            'livro_ativo': rnd.random() > 0.02,
+        }
+
+
+def gerar_emprestimos(rnd, quantidade, usuarios, livros, abertos):
+    """
+        Gera `quantidade` emprestimos; os livros em `abertos` recebem o
+        último emprestimo em aberto, os demais são finalizados no passado.
+    """
+    hoje = date.today()
+    abertos = sorted(abertos)
+    for i in range(1, quantidade + 1):
+        em_aberto = i > quantidade - len(abertos)
+        if em_aberto:
+            id_livro = abertos[quantidade - i]
+            inicio = hoje - timedelta(days=rnd.randrange(0, 40))
+        else:
+            id_livro = rnd.randint(1, livros)
+            inicio = hoje - timedelta(days=rnd.randrange(40, 1500))
+        yield {
+            'id_emprestimo': i,
+            'data_emprestimo': inicio,
+            'data_devolucao': inicio + timedelta(days=rnd.choice((7, 14, 21, 30))),
+            'status_finalizado': not em_aberto,
+            'ID': rnd.randint(1, usuarios),
+            'ID_livro': id_livro,
+        }
+
+
+def limpar_banco(caminho):
+    """
+        Remove o arquivo de um banco de rascunho (e os arquivos do WAL).
+    """
+    for sufixo in ('', '-wal', '-shm'):
+        if os.path.exists(caminho + sufixo):
+            os.remove(caminho + sufixo)
+
+
+def popular(url, usuarios=1000, livros=5000, emprestimos=20000, semente=42):
+    """
+        Cria o schema em `url` e insere os dados sintéticos em lotes.
+
+        A mesma `semente` gera sempre os mesmos dados, para que execuções
+        diferentes do benchmark sejam comparáveis.
+    """
+    rnd = random.Random(semente)
+    engine = criar_engine(url, perfil='memoria' if ':memory:' in url else 'padrao')
+    aplicar_migracoes(engine)
+    # ~10% dos livros com emprestimo em aberto
+    quantidade_abertos = min(livros // 10, emprestimos)
+    abertos = set(rnd.sample(range(1, livros + 1), quantidade_abertos))
+
+    with engine.begin() as conn:
+        for lote in em_lotes(gerar_usuarios(rnd, usuarios)):
+            conn.execute(insert(Usuario), lote)
+        for lote in em_lotes(gerar_livros(rnd, livros, abertos)):
+            conn.execute(insert(Livro), lote)
+        for lote in em_lotes(gerar_emprestimos(rnd, emprestimos, usuarios, livros, abertos)):
+            conn.execute(insert(Emprestimo), lote)
+    engine.dispose()
+    return {'usuarios': usuarios, 'livros': livros, 'emprestimos': emprestimos, 'semente': semente}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Gera dados sintéticos para o benchmark')
+    parser.add_argument('--banco', default='bench_biblioteca.sqlite3', help='arquivo SQLite de destino')
+    parser.add_argument('--usuarios', type=int, default=1000)
+    parser.add_argument('--livros', type=int, default=5000)
+    parser.add_argument('--emprestimos', type=int, default=20000)
+    parser.add_argument('--semente', type=int, default=42)
+    args = parser.parse_args(argv)
+    limpar_banco(args.banco)
+    print(popular('sqlite:///' + args.banco, args.usuarios, args.livros, args.emprestimos, args.semente))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+#verificação dos planos de consulta (EXPLAIN QUERY PLAN) de todas as rotas.
+#
+#uso:
+#   python -m benchmark.planos
+#
+#executa cada cenário do benchmark uma vez sobre um banco sintético, captura
+#as consultas SQL emitidas e falha (código de saída 1) se alguma fizer
+#varredura completa (SCAN) de uma tabela fora das rotas que listam tudo.
+#a mesma verificação roda no pytest (tests/test_planos.py); o script serve
+#para ver os planos (-v) ou conferir com outros tamanhos de banco.
+import argparse
+import os
+import re
+import sys
+
+# rotas cujo objetivo é percorrer a tabela inteira
+SCAN_PERMITIDO = {
+    'get_livros_stream': {'livro'},
+    'get_livros_stream_gzip': {'livro'},
+    'get_livros_colunas': {'livro'},
+    'get_livros_fields': {'livro'},
+    'get_usuarios_stream': {'usuario'},
+    'get_emprestimos_stream': {'emprestimo'},
+    'get_mudancas_snapshot': {'livro'},
+}
+# tabelas de tamanho fixo, que podem ser lidas inteiras em qualquer rota
+TABELAS_PEQUENAS = {'estatistica'}
+
+# "SCAN livro_fts VIRTUAL TABLE ..." é a busca no índice FTS e "SCAN CONSTANT ROW"
+# um SELECT sem tabela (ex.: o `SELECT 1` do /pronto), não são varreduras
+PADRAO_SCAN = re.compile(r'^SCAN (?!CONSTANT ROW)(\w+)\b(?! VIRTUAL TABLE)')
+
+
+def verificar(app, engines, cenarios, tamanhos, semente):
+    """
+        Executa cada cenário e devolve `{rota: [(sql, plano, tabelas_varridas)]}`.
+    """
+    from sqlalchemy import event
+    from benchmark.executor import gerador_aleatorio
+    from metricas import explicar_consulta
+
+    capturadas = []
+
+    def capturar(conn, cursor, statement, parameters, context, executemany):
+        plano = None if executemany else explicar_consulta(conn, statement, parameters)
+        if plano is not None:
+            capturadas.append((statement, plano))
+
+    for engine in engines:
+        event.listen(engine, 'before_cursor_execute', capturar)
+    cliente = app.test_client()
+    resultado = {}
+    try:
+        for cenario in cenarios:
+            capturadas.clear()
+            url, corpo = cenario.gerar(0, gerador_aleatorio(semente, cenario), tamanhos)
+            resposta = cliente.open(url, method=cenario.metodo, json=corpo, headers=cenario.cabecalhos)
+            resposta.get_data()
+            resposta.close()
+            consultas = []
+            for statement, plano in capturadas:
+                tabelas = set()
+                for linha in plano:
+                    encontrado = PADRAO_SCAN.match(linha)
+                    if encontrado:
+                        tabelas.add(encontrado.group(1))
+                consultas.append((statement, plano, tabelas))
+            resultado[cenario.nome] = consultas
+    finally:
+        for engine in engines:
+            event.remove(engine, 'before_cursor_execute', capturar)
+    return resultado
+
+
+def varreduras_proibidas(resultado):
+    """
+        Consultas de `verificar` que varrem tabelas fora de `SCAN_PERMITIDO`.
+
+        Retorna `[(rota, sql, plano, tabelas)]`.
+    """
+    falhas = []
+    for rota, consultas in resultado.items():
+        permitido = SCAN_PERMITIDO.get(rota, set()) | TABELAS_PEQUENAS
+        for statement, plano, tabelas in consultas:
+            if tabelas - permitido:
+                falhas.append((rota, statement, plano, tabelas - permitido))
+    return falhas
+
+
+def descrever(rota, statement, plano, marca='FALHA'):
+    linhas = ['[{}] {}: {}'.format(marca, rota, ' '.join(statement.split())[:160])]
+    linhas.extend('         ' + linha for linha in plano)
+    return '\n'.join(linhas)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Verifica os planos de consulta de todas as rotas')
+    parser.add_argument('--banco', default='bench_planos.sqlite3', help='arquivo SQLite de rascunho')
+    parser.add_argument('--usuarios', type=int, default=2000)
+    parser.add_argument('--livros', type=int, default=5000)
+    parser.add_argument('--emprestimos', type=int, default=20000)
+    parser.add_argument('--semente', type=int, default=42)
+    parser.add_argument('-v', '--verbose', action='store_true', help='mostra o plano de todas as consultas')
+    args = parser.parse_args(argv)
+
+    url = 'sqlite:///' + args.banco
+    os.environ['DATABASE_URL'] = url
+    from benchmark import gerador
+    from benchmark.executor import CENARIOS
+
+    gerador.limpar_banco(args.banco)
+    # com dados suficientes o planejador escolhe os índices como em produção
+    gerador.popular(url, args.usuarios, args.livros, args.emprestimos, args.semente)
+    from app import create_app
+    from database import engine, engine_leitura
+    app = create_app({'OPENAPI_CACHE': None})
+    with engine.begin() as conn:
+        conn.exec_driver_sql('ANALYZE')
+
+    tamanhos = {'usuarios': args.usuarios, 'livros': args.livros, 'emprestimos': args.emprestimos}
+    resultado = verificar(app, {engine.obter(), engine_leitura.obter()}, CENARIOS, tamanhos, args.semente)
+
+    falhas = varreduras_proibidas(resultado)
+    if args.verbose:
+        proibidas = {(rota, statement) for rota, statement, _, _ in falhas}
+        for rota, consultas in resultado.items():
+            for statement, plano, _ in consultas:
+                print(descrever(rota, statement, plano, 'FALHA' if (rota, statement) in proibidas else 'ok'))
+    else:
+        for rota, statement, plano, _ in falhas:
+            print(descrever(rota, statement, plano))
+    gerador.limpar_banco(args.banco)
+
+    print('{} rotas verificadas, {} consultas com varredura completa'.format(len(resultado), len(falhas)))
+    return 1 if falhas else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
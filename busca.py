@@ -0,0 +1,82 @@
+#busca textual de livros (SQLite FTS5).
+import re
+
+from sqlalchemy import select, text
+
+from models import Livro
+
+# pesos do bm25 por coluna: titulo, autor, descricao
+PESOS_BM25 = (10.0, 5.0, 1.0)
+
+# índice externo: o conteúdo fica na tabela livro, o FTS guarda só os tokens
+SQL_CRIAR_FTS = [
+    '''CREATE VIRTUAL TABLE IF NOT EXISTS livro_fts USING fts5(
+           titulo, autor, descricao,
+           content='livro', content_rowid='id_livro',
+           tokenize='unicode61 remove_diacritics 2',
+           prefix='2 3'
+       )''',
+    '''CREATE TRIGGER IF NOT EXISTS livro_fts_insert AFTER INSERT ON livro BEGIN
+           INSERT INTO livro_fts (rowid, titulo, autor, descricao)
+           VALUES (new.id_livro, new.titulo, new.autor, new.descricao);
+       END''',
+    '''CREATE TRIGGER IF NOT EXISTS livro_fts_delete AFTER DELETE ON livro BEGIN
+           INSERT INTO livro_fts (livro_fts, rowid, titulo, autor, descricao)
+           VALUES ('delete', old.id_livro, old.titulo, old.autor, old.descricao);
+       END''',
+    # só reindexa quando uma coluna buscável muda (status_emprestado muda muito)
+    '''CREATE TRIGGER IF NOT EXISTS livro_fts_update AFTER UPDATE OF titulo, autor, descricao ON livro BEGIN
+           INSERT INTO livro_fts (livro_fts, rowid, titulo, autor, descricao)
+           VALUES ('delete', old.id_livro, old.titulo, old.autor, old.descricao);
+           INSERT INTO livro_fts (rowid, titulo, autor, descricao)
+           VALUES (new.id_livro, new.titulo, new.autor, new.descricao);
+       END''',
+]
+
+
+def criar_indice_busca(conn):
+    """
+        Cria a tabela FTS5 e os triggers que a mantêm em sincronia com `livro`.
+    """
+    for sql in SQL_CRIAR_FTS:
+        conn.exec_driver_sql(sql)
+    reconstruir_indice_busca(conn)
+
+
+def reconstruir_indice_busca(conn):
+    """
+        Refaz o índice inteiro a partir da tabela `livro`.
+
+        Necessário para dados que existiam antes dos triggers.
+    """
+    conn.exec_driver_sql("INSERT INTO livro_fts (livro_fts) VALUES ('rebuild')")
+    conn.exec_driver_sql("INSERT INTO livro_fts (livro_fts) VALUES ('optimize')")
+
+
+def montar_consulta_fts(termo):
+    """
+        Converte o texto digitado em uma consulta FTS5.
+
+        Cada palavra vira um termo entre aspas com `*` (busca por prefixo),
+        então operadores e caracteres especiais digitados não quebram a
+        consulta. Todas as palavras precisam aparecer (AND implícito).
+    """
+    palavras = re.findall(r'\w+', termo or '')
+    if not palavras:
+        return None
+    return ' '.join('"{}"*'.format(palavra) for palavra in palavras)
+
+
+def sql_busca_livros(consulta, limit, offset):
+    """
+        SELECT dos livros que casam com `consulta`, ordenados pelo bm25.
+    """
+    pesos = ', '.join(str(peso) for peso in PESOS_BM25)
+    sql = text(f'''
+        SELECT livro.* FROM livro_fts
+        JOIN livro ON livro.id_livro = livro_fts.rowid
+        WHERE livro_fts MATCH :consulta
+        ORDER BY bm25(livro_fts, {pesos})
+        LIMIT :limit OFFSET :offset
+    ''').bindparams(consulta=consulta, limit=limit, offset=offset)
+    return select(Livro).from_statement(sql)
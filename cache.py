@@ -0,0 +1,127 @@
+#cache em memória das consultas por id (livro, usuario e emprestimo).
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+class CacheLRU:
+    """
+        Cache limitado com remoção LRU e expiração por TTL.
+
+        Guarda os dicionários já serializados das entidades, com chave
+        `(entidade, id)`. As escritas (`novo_*` / `editar_*`) chamam
+        `invalidar` depois do commit.
+
+        Quem lê do banco para preencher o cache pega `geracao()` antes da
+        consulta e a passa para `set`: se a chave foi invalidada nesse meio
+        tempo o valor lido pode ser anterior ao commit e não é guardado.
+    """
+
+    def __init__(self, tamanho_maximo=1024, ttl=30.0, ativo=True):
+        self.tamanho_maximo = tamanho_maximo
+        self.ttl = ttl
+        self.ativo = ativo
+        self._dados = OrderedDict()
+        self._lock = threading.Lock()
+        # geração em que cada chave foi invalidada por último; as mais antigas
+        # saem do dicionário e passam a valer pelo piso
+        self._geracao = 0
+        self._invalidadas = OrderedDict()
+        self._piso = 0
+        self.descartados = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirados = 0
+        self.invalidacoes = 0
+
+    def get(self, entidade, id):
+        """
+            Retorna o valor guardado ou `None` se não existir ou tiver expirado.
+        """
+        if not self.ativo:
+            return None
+        chave = (entidade, int(id))
+        with self._lock:
+            item = self._dados.get(chave)
+            if item is None:
+                self.misses += 1
+                return None
+            expira_em, valor = item
+            if expira_em < time.monotonic():
+                del self._dados[chave]
+                self.expirados += 1
+                self.misses += 1
+                return None
+            self._dados.move_to_end(chave)
+            self.hits += 1
+            return valor
+
+    def geracao(self):
+        with self._lock:
+            return self._geracao
+
+    def set(self, entidade, id, valor, geracao=None):
+        """
+            Guarda `valor`; com `geracao` (lida antes da consulta ao banco)
+            ignora o valor se a chave foi invalidada depois dela.
+        """
+        if not self.ativo:
+            return
+        chave = (entidade, int(id))
+        with self._lock:
+            if geracao is not None and self._invalidadas.get(chave, self._piso) > geracao:
+                self.descartados += 1
+                return
+            self._dados[chave] = (time.monotonic() + self.ttl, valor)
+            self._dados.move_to_end(chave)
+            while len(self._dados) > self.tamanho_maximo:
+                self._dados.popitem(last=False)
+                self.evictions += 1
+
+    def invalidar(self, entidade, *ids):
+        with self._lock:
+            self._geracao += 1
+            for id in ids:
+                if id is None:
+                    continue
+                chave = (entidade, int(id))
+                self._invalidadas[chave] = self._geracao
+                self._invalidadas.move_to_end(chave)
+                if self._dados.pop(chave, None) is not None:
+                    self.invalidacoes += 1
+            while len(self._invalidadas) > self.tamanho_maximo:
+                _, geracao = self._invalidadas.popitem(last=False)
+                self._piso = max(self._piso, geracao)
+
+    def limpar(self):
+        with self._lock:
+            self._dados.clear()
+            # leituras em andamento também não podem guardar o que leram
+            self._geracao += 1
+            self._invalidadas.clear()
+            self._piso = self._geracao
+
+    def estatisticas(self):
+        with self._lock:
+            return {
+                'ativo': self.ativo,
+                'tamanho': len(self._dados),
+                'tamanho_maximo': self.tamanho_maximo,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirados': self.expirados,
+                'invalidacoes': self.invalidacoes,
+                'descartados': self.descartados,
+            }
+
+
+# CACHE_DESATIVADO=1 desliga o cache (útil para depurar)
+cache_entidades = CacheLRU(
+    tamanho_maximo=int(os.environ.get('CACHE_TAMANHO', 10000)),
+    ttl=float(os.environ.get('CACHE_TTL', 30)),
+    ativo=os.environ.get('CACHE_DESATIVADO', '0') not in ('1', 'true', 'True'),
+)
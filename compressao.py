@@ -0,0 +1,72 @@
+#compressão gzip das respostas, negociada pelo Accept-Encoding.
+import gzip
+import os
+import zlib
+
+from flask import request
+
+# GZIP_NIVEL de 1 (mais rápido) a 9 (menor); respostas menores que
+# GZIP_MINIMO bytes vão sem compressão, o cabeçalho gzip não compensa
+NIVEL = int(os.environ.get('GZIP_NIVEL', 6))
+TAMANHO_MINIMO = int(os.environ.get('GZIP_MINIMO', 1024))
+ATIVO = os.environ.get('GZIP_DESATIVADO', '0') not in ('1', 'true', 'True')
+
+
+def compressivel(mimetype):
+    """
+        JSON (inclusive NDJSON e `+json`), CSV e texto; imagens e binários já vêm comprimidos.
+    """
+    return mimetype.startswith('text/') or mimetype.endswith('json')
+
+
+def comprimir_stream(partes, nivel=NIVEL):
+    """
+        Comprime um corpo gerado aos poucos sem juntá-lo em memória.
+
+        O zlib só devolve dados quando junta o suficiente para um bloco, então
+        as partes pequenas das listagens (uma por linha) não viram blocos pequenos.
+    """
+    compressor = zlib.compressobj(nivel, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for parte in partes:
+        if isinstance(parte, str):
+            parte = parte.encode()
+        dados = compressor.compress(parte)
+        if dados:
+            yield dados
+    yield compressor.flush()
+
+
+def instalar(app, nivel=NIVEL, tamanho_minimo=TAMANHO_MINIMO, ativo=ATIVO):
+    """
+        Registra o `after_request` que comprime as respostas quando o cliente aceita gzip.
+    """
+
+    @app.after_request
+    def comprimir_resposta(response):
+        if not ativo or request.method == 'HEAD' or response.direct_passthrough:
+            return response
+        if response.status_code < 200 or response.status_code in (204, 304):
+            return response
+        if 'Content-Encoding' in response.headers or not compressivel(response.mimetype):
+            return response
+
+        response.vary.add('Accept-Encoding')
+        if not request.accept_encodings['gzip']:
+            return response
+
+        if response.is_streamed:
+            # o tamanho final não é conhecido, então o streaming é sempre comprimido
+            original = response.response
+            response.response = comprimir_stream(original, nivel)
+            # o gerador original (e o contexto do stream_with_context) é
+            # encerrado mesmo se o cliente desconectar antes do fim
+            if hasattr(original, 'close'):
+                response.call_on_close(original.close)
+            response.headers.pop('Content-Length', None)
+        else:
+            dados = response.get_data()
+            if len(dados) < tamanho_minimo:
+                return response
+            response.set_data(gzip.compress(dados, nivel))
+        response.headers['Content-Encoding'] = 'gzip'
+        return response
@@ -0,0 +1,242 @@
+#configuração do banco de dados (engine, pool e sessões).
+import os
+import threading
+import time
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
+
+DATABASE_URL_PADRAO = 'sqlite:///base_biblioteca.sqlite3'
+
+# PRAGMAs aplicados em cada conexão SQLite nova, por perfil.
+# - padrao: WAL (leitores não bloqueiam o escritor) com fsync só nos checkpoints
+# - seguro: WAL com fsync a cada commit
+# - memoria: banco temporário, sem journal em disco
+PERFIS_SQLITE = {
+    'padrao': {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'mmap_size': 256 * 1024 * 1024,
+        'cache_size': -64000,  # negativo = KiB (64 MB)
+        'busy_timeout': 5000,
+        'temp_store': 'MEMORY',
+    },
+    'seguro': {
+        'journal_mode': 'WAL',
+        'synchronous': 'FULL',
+        'mmap_size': 256 * 1024 * 1024,
+        'cache_size': -64000,
+        'busy_timeout': 10000,
+        'temp_store': 'MEMORY',
+    },
+    'memoria': {
+        'journal_mode': 'MEMORY',
+        'synchronous': 'OFF',
+        'cache_size': -64000,
+        'busy_timeout': 5000,
+        'temp_store': 'MEMORY',
+    },
+}
+
+
+def ler_configuracao():
+    """
+        Lê a configuração do banco das variáveis de ambiente.
+
+        - `DATABASE_URL`: URL do SQLAlchemy (padrão: `sqlite:///base_biblioteca.sqlite3`)
+        - `DATABASE_PERFIL`: perfil de PRAGMAs do SQLite (`padrao`, `seguro` ou `memoria`)
+        - `DATABASE_POOL_SIZE`, `DATABASE_MAX_OVERFLOW`, `DATABASE_POOL_TIMEOUT`: pool de conexões de leitura
+        - `DATABASE_POOL_ESCRITA`: conexões da engine de escrita (padrão 1, escritas em fila)
+        - `DATABASE_ECHO`: `1` para logar o SQL executado
+    """
+    return {
+        'url': os.environ.get('DATABASE_URL', DATABASE_URL_PADRAO),
+        'perfil': os.environ.get('DATABASE_PERFIL', 'padrao'),
+        'pool_size': int(os.environ.get('DATABASE_POOL_SIZE', 20)),
+        'max_overflow': int(os.environ.get('DATABASE_MAX_OVERFLOW', 20)),
+        'pool_escrita': int(os.environ.get('DATABASE_POOL_ESCRITA', 1)),
+        'pool_timeout': float(os.environ.get('DATABASE_POOL_TIMEOUT', 30)),
+        'echo': os.environ.get('DATABASE_ECHO', '0') in ('1', 'true', 'True'),
+    }
+
+
+class PoolMedido(QueuePool):
+    """
+        `QueuePool` que mede quanto tempo as requisições esperam por uma conexão.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._lock_medidas = threading.Lock()
+        self.esperas = 0
+        self.tempo_espera = 0.0
+        self.espera_maxima = 0.0
+        self.timeouts = 0
+
+    def _do_get(self):
+        inicio = time.perf_counter()
+        try:
+            return super()._do_get()
+        except PoolTimeoutError:
+            with self._lock_medidas:
+                self.timeouts += 1
+            raise
+        finally:
+            espera = time.perf_counter() - inicio
+            with self._lock_medidas:
+                self.esperas += 1
+                self.tempo_espera += espera
+                self.espera_maxima = max(self.espera_maxima, espera)
+
+    def estatisticas(self):
+        with self._lock_medidas:
+            return {
+                'tamanho': self.size(),
+                'em_uso': self.checkedout(),
+                'livres': self.checkedin(),
+                'overflow': max(self.overflow(), 0),
+                'esperas': self.esperas,
+                'tempo_espera': self.tempo_espera,
+                'espera_maxima': self.espera_maxima,
+                'timeouts': self.timeouts,
+            }
+
+
+def configurar_sqlite(engine, pragmas):
+    """
+        Registra os eventos que aplicam os PRAGMAs em cada conexão nova.
+
+        O driver sqlite3 abre transações por conta própria e não entende
+        SAVEPOINT direito, então o controle do BEGIN passa para o SQLAlchemy
+        (receita da documentação do SQLAlchemy para o pysqlite).
+    """
+    @event.listens_for(engine, 'connect')
+    def ao_conectar(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+        cursor = dbapi_connection.cursor()
+        for nome, valor in pragmas.items():
+            cursor.execute(f'PRAGMA {nome}={valor}')
+        cursor.close()
+
+    @event.listens_for(engine, 'begin')
+    def ao_iniciar(conn):
+        conn.exec_driver_sql('BEGIN')
+
+
+def sqlite_em_memoria(url):
+    return url.get_backend_name() == 'sqlite' and url.database in (None, '', ':memory:')
+
+
+def criar_engine(url=None, perfil=None, somente_leitura=False, **opcoes):
+    """
+        Cria a engine a partir da configuração do ambiente.
+
+        A engine de escrita tem um pool pequeno (`DATABASE_POOL_ESCRITA`,
+        sem overflow): no SQLite só um escritor grava por vez, então as
+        escritas esperam na fila do pool em vez de disputar o lock do banco.
+        Com `somente_leitura` o pool usa `DATABASE_POOL_SIZE` e, no SQLite,
+        o arquivo é aberto com `mode=ro` e `PRAGMA query_only`.
+
+        Argumentos explícitos sobrescrevem as variáveis de ambiente.
+    """
+    config = ler_configuracao()
+    url = make_url(url or config['url'])
+    perfil = perfil or config['perfil']
+    sqlite = url.get_backend_name() == 'sqlite'
+    em_memoria = sqlite_em_memoria(url)
+
+    kwargs = {'echo': config['echo']}
+    if not em_memoria:
+        # sqlite em memória usa um pool próprio (SingletonThreadPool/StaticPool)
+        kwargs['poolclass'] = PoolMedido
+        kwargs['pool_timeout'] = config['pool_timeout']
+        if somente_leitura:
+            kwargs.update(pool_size=config['pool_size'], max_overflow=config['max_overflow'])
+        else:
+            kwargs.update(pool_size=config['pool_escrita'], max_overflow=0)
+    if not sqlite:
+        kwargs['pool_pre_ping'] = True
+    if somente_leitura and sqlite and not em_memoria and not url.database.startswith('file:'):
+        url = url.set(database='file:' + url.database).update_query_dict({'mode': 'ro', 'uri': 'true'})
+    kwargs.update(opcoes)
+
+    engine = create_engine(url, **kwargs)
+    if sqlite:
+        if perfil not in PERFIS_SQLITE:
+            raise ValueError(f'Perfil de SQLite desconhecido: {perfil}')
+        pragmas = dict(PERFIS_SQLITE[perfil])
+        if em_memoria:
+            pragmas.pop('journal_mode', None)
+            pragmas.pop('mmap_size', None)
+        if somente_leitura:
+            # o journal_mode é definido pela engine de escrita
+            pragmas.pop('journal_mode', None)
+            pragmas['query_only'] = 'ON'
+        configurar_sqlite(engine, pragmas)
+    return engine
+
+
+class Tardio:
+    """
+        Objeto criado por `fabrica()` só no primeiro uso.
+
+        Atributos e chamadas são repassados ao objeto real, então
+        `engine.connect()` ou `local_session()` funcionam como antes, mas
+        importar o módulo não abre pool nem lê configuração. Para APIs que
+        exigem o objeto real (ex.: `event.listen`) use `obter()`.
+    """
+
+    def __init__(self, fabrica):
+        self._fabrica = fabrica
+        self._objeto = None
+        self._lock = threading.Lock()
+
+    @property
+    def criado(self):
+        return self._objeto is not None
+
+    def obter(self):
+        if self._objeto is None:
+            with self._lock:
+                if self._objeto is None:
+                    self._objeto = self._fabrica()
+        return self._objeto
+
+    def __getattr__(self, nome):
+        return getattr(self.obter(), nome)
+
+    def __call__(self, *args, **kwargs):
+        return self.obter()(*args, **kwargs)
+
+
+def estatisticas_pool(engine):
+    """
+        Uso do pool da engine (`None` se a engine ainda não foi criada ou se
+        o pool não for medido, ex.: SQLite em memória).
+    """
+    if isinstance(engine, Tardio):
+        if not engine.criado:
+            return None
+        engine = engine.obter()
+    if isinstance(engine.pool, PoolMedido):
+        return engine.pool.estatisticas()
+    return None
+
+
+def _criar_engine_leitura():
+    if sqlite_em_memoria(engine.url):
+        # cada conexão em memória seria um banco diferente
+        return engine.obter()
+    return criar_engine(somente_leitura=True)
+
+
+#conexão de banco (escrita) e a de leitura, usada pelas rotas GET; criadas no primeiro uso.
+engine = Tardio(criar_engine)
+engine_leitura = Tardio(_criar_engine_leitura)
+
+#gerenciar sessao com banco de dados.
+local_session = Tardio(lambda: sessionmaker(bind=engine.obter()))
+sessao_leitura = Tardio(lambda: sessionmaker(bind=engine_leitura.obter()))
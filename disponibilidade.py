@@ -0,0 +1,77 @@
+#disponibilidade dos livros por período (emprestimos em aberto como intervalos de datas).
+from datetime import date, timedelta
+
+from sqlalchemy import select, func, literal, Date
+
+from models import Emprestimo
+
+
+def fim_efetivo(hoje):
+    """
+        Fim do período de um emprestimo em aberto.
+
+        Um emprestimo atrasado continua com o livro até a devolução, então
+        ocupa pelo menos até hoje (o fim é exclusivo: o livro volta no dia).
+    """
+    return func.max(Emprestimo.data_devolucao, literal(hoje + timedelta(days=1), Date))
+
+
+def sql_periodos(id_livro, de, ate=None, hoje=None, ignorar=None):
+    """
+        Emprestimos em aberto do livro que ocupam algum dia a partir de `de`
+        (e antes de `ate`, se informado), em ordem de início.
+
+        Os emprestimos em aberto de um livro são uma faixa contígua do índice
+        (`ID_livro`, `status_finalizado`, `data_emprestimo`, `data_devolucao`),
+        então a busca não passa pelo histórico de emprestimos finalizados.
+    """
+    fim = fim_efetivo(hoje or date.today())
+    sql = select(Emprestimo.id_emprestimo, Emprestimo.data_emprestimo, fim.label('data_fim')).where(
+        Emprestimo.ID_livro == id_livro,
+        Emprestimo.status_finalizado == False,
+        fim > de,
+    )
+    if ate is not None:
+        sql = sql.where(Emprestimo.data_emprestimo < ate)
+    if ignorar is not None:
+        sql = sql.where(Emprestimo.id_emprestimo != ignorar)
+    return sql.order_by(Emprestimo.data_emprestimo)
+
+
+def buscar_conflito(db_session, id_livro, de, ate, ignorar=None):
+    """
+        Primeiro emprestimo em aberto que se sobrepõe a [`de`, `ate`), ou `None`.
+    """
+    return db_session.execute(sql_periodos(id_livro, de, ate, ignorar=ignorar).limit(1)).first()
+
+
+def proxima_data_livre(periodos, de, dias=1):
+    """
+        Primeira data a partir de `de` com `dias` seguidos livres.
+
+        `periodos` são as linhas de `sql_periodos` (em ordem de início); a
+        busca anda pelos intervalos até achar um espaço do tamanho pedido.
+    """
+    inicio = de
+    for periodo in periodos:
+        if periodo.data_emprestimo >= inicio + timedelta(days=dias):
+            break
+        inicio = max(inicio, periodo.data_fim)
+    return inicio
+
+
+def periodos_livres(periodos, de, ate):
+    """
+        Intervalos [de, ate) sem emprestimo dentro da janela pedida.
+    """
+    livres = []
+    inicio = de
+    for periodo in periodos:
+        if periodo.data_emprestimo > inicio:
+            livres.append((inicio, min(periodo.data_emprestimo, ate)))
+        inicio = max(inicio, periodo.data_fim)
+        if inicio >= ate:
+            break
+    if inicio < ate:
+        livres.append((inicio, ate))
+    return livres
@@ -0,0 +1,129 @@
+#fila de escrita com group commit: escritas de requisições diferentes gravadas na mesma transação.
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from database import local_session
+
+logger = logging.getLogger('bancoAPI.escrita')
+
+# FILA_ESCRITA=1 liga a fila. Depois da primeira operação o lote espera até
+# FILA_ESCRITA_JANELA_MS por outras, e fecha antes se chegar a FILA_ESCRITA_LOTE
+ATIVA = os.environ.get('FILA_ESCRITA', '0') in ('1', 'true', 'True')
+JANELA = float(os.environ.get('FILA_ESCRITA_JANELA_MS', 1)) / 1000
+TAMANHO_MAXIMO = int(os.environ.get('FILA_ESCRITA_LOTE', 64))
+
+
+class FilaEscrita:
+    """
+        Escritor único que junta as operações enviadas ao mesmo tempo e grava
+        todas em uma transação: um commit (e um fsync) por lote, não por requisição.
+
+        Cada operação é uma função `operacao(db_session)` executada na thread
+        da fila, dentro de um SAVEPOINT: um erro desfaz só ela e é levantado
+        para quem a enviou, e as outras do lote seguem para o commit. Como a
+        sessão é fechada depois do commit, a operação deve devolver valores
+        simples (ex.: o id criado) e não objetos do ORM.
+    """
+
+    def __init__(self, fabrica_sessao=local_session, janela=JANELA, tamanho_maximo=TAMANHO_MAXIMO):
+        self._fabrica_sessao = fabrica_sessao
+        self.janela = janela
+        self.tamanho_maximo = tamanho_maximo
+        self._fila = queue.SimpleQueue()
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._lock_medidas = threading.Lock()
+        self.lotes = 0
+        self.operacoes = 0
+        self.erros = 0
+        self.maior_lote = 0
+
+    def executar(self, operacao, timeout=None):
+        """
+            Envia `operacao` para o próximo lote e espera o commit dele.
+
+            Retorna o valor devolvido pela operação ou levanta o erro dela
+            (ou o do commit, que vale para o lote inteiro).
+        """
+        futuro = Future()
+        self._iniciar()
+        self._fila.put((operacao, futuro))
+        return futuro.result(timeout)
+
+    def _iniciar(self):
+        # a thread não passa pelo fork dos workers: cada processo cria a sua
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self._fila = queue.SimpleQueue()
+                self._thread = threading.Thread(target=self._executar, name='fila-escrita', daemon=True)
+                self._thread.start()
+                self._pid = os.getpid()
+
+    def _coletar(self):
+        lote = [self._fila.get()]
+        limite = time.monotonic() + self.janela
+        while len(lote) < self.tamanho_maximo:
+            restante = limite - time.monotonic()
+            try:
+                # as que chegaram durante o commit anterior entram sem esperar
+                lote.append(self._fila.get(timeout=restante) if restante > 0 else self._fila.get_nowait())
+            except queue.Empty:
+                break
+        return lote
+
+    def _executar(self):
+        while True:
+            lote = self._coletar()
+            try:
+                self._gravar(lote)
+            except Exception as e:
+                logger.exception('falha na fila de escrita')
+                for _, futuro in lote:
+                    if not futuro.done():
+                        futuro.set_exception(e)
+
+    def _gravar(self, lote):
+        resultados = []
+        db_session = self._fabrica_sessao()
+        try:
+            for operacao, futuro in lote:
+                if not futuro.set_running_or_notify_cancel():
+                    continue
+                try:
+                    with db_session.begin_nested():
+                        resultados.append((futuro, operacao(db_session), None))
+                except Exception as e:
+                    resultados.append((futuro, None, e))
+            db_session.commit()
+        except Exception:
+            db_session.rollback()
+            raise
+        finally:
+            db_session.close()
+
+        with self._lock_medidas:
+            self.lotes += 1
+            self.operacoes += len(resultados)
+            self.erros += sum(1 for _, _, erro in resultados if erro is not None)
+            self.maior_lote = max(self.maior_lote, len(resultados))
+        for futuro, valor, erro in resultados:
+            if erro is None:
+                futuro.set_result(valor)
+            else:
+                futuro.set_exception(erro)
+
+    def estatisticas(self):
+        with self._lock_medidas:
+            return {
+                'lotes': self.lotes,
+                'operacoes': self.operacoes,
+                'erros': self.erros,
+                'maior_lote': self.maior_lote,
+            }
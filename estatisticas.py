@@ -0,0 +1,107 @@
+#contadores do acervo e dos emprestimos mantidos por triggers (GET /estatisticas).
+
+CHAVES = (
+    'livros_total',
+    'livros_ativos',
+    'livros_emprestados',
+    'usuarios_total',
+    'usuarios_ativos',
+    'emprestimos_total',
+    'emprestimos_abertos',
+)
+
+
+def _somar(chave, expressao):
+    return f"UPDATE estatistica SET valor = valor + ({expressao}) WHERE chave = '{chave}';"
+
+
+def _somar_usuario(id_usuario, expressao):
+    return f'''INSERT INTO estatistica_usuario (id_usuario, emprestimos_abertos)
+               SELECT {id_usuario}, {expressao} WHERE {id_usuario} IS NOT NULL
+               ON CONFLICT (id_usuario) DO UPDATE
+               SET emprestimos_abertos = emprestimos_abertos + excluded.emprestimos_abertos;'''
+
+
+# os triggers rodam dentro da mesma transação da escrita, então os
+# contadores nunca ficam diferentes dos dados (inclusive nas rotas em massa)
+SQL_TRIGGERS = [
+    f'''CREATE TRIGGER IF NOT EXISTS estatistica_livro_insert AFTER INSERT ON livro BEGIN
+            {_somar('livros_total', '1')}
+            {_somar('livros_ativos', 'new.livro_ativo')}
+            {_somar('livros_emprestados', 'new.status_emprestado')}
+        END''',
+    f'''CREATE TRIGGER IF NOT EXISTS estatistica_livro_update AFTER UPDATE OF livro_ativo, status_emprestado ON livro BEGIN
+            {_somar('livros_ativos', 'new.livro_ativo - old.livro_ativo')}
+            {_somar('livros_emprestados', 'new.status_emprestado - old.status_emprestado')}
+        END''',
+    f'''CREATE TRIGGER IF NOT EXISTS estatistica_livro_delete AFTER DELETE ON livro BEGIN
+            {_somar('livros_total', '-1')}
+            {_somar('livros_ativos', '-old.livro_ativo')}
+            {_somar('livros_emprestados', '-old.status_emprestado')}
+        END''',
+    f'''CREATE TRIGGER IF NOT EXISTS estatistica_usuario_insert AFTER INSERT ON usuario BEGIN
+            {_somar('usuarios_total', '1')}
+            {_somar('usuarios_ativos', 'new.usuario_ativo')}
+        END''',
+    f'''CREATE TRIGGER IF NOT EXISTS estatistica_usuario_update AFTER UPDATE OF usuario_ativo ON usuario BEGIN
+            {_somar('usuarios_ativos', 'new.usuario_ativo - old.usuario_ativo')}
+        END''',
+    f'''CREATE TRIGGER IF NOT EXISTS estatistica_usuario_delete AFTER DELETE ON usuario BEGIN
+            {_somar('usuarios_total', '-1')}
+            {_somar('usuarios_ativos', '-old.usuario_ativo')}
+        END''',
+    f'''CREATE TRIGGER IF NOT EXISTS estatistica_emprestimo_insert AFTER INSERT ON emprestimo BEGIN
+            {_somar('emprestimos_total', '1')}
+            {_somar('emprestimos_abertos', '1 - new.status_finalizado')}
+            {_somar_usuario('new."ID"', '1 - new.status_finalizado')}
+        END''',
+    f'''CREATE TRIGGER IF NOT EXISTS estatistica_emprestimo_update AFTER UPDATE OF status_finalizado, "ID" ON emprestimo BEGIN
+            {_somar('emprestimos_abertos', 'old.status_finalizado - new.status_finalizado')}
+            {_somar_usuario('old."ID"', 'old.status_finalizado - 1')}
+            {_somar_usuario('new."ID"', '1 - new.status_finalizado')}
+        END''',
+    f'''CREATE TRIGGER IF NOT EXISTS estatistica_emprestimo_delete AFTER DELETE ON emprestimo BEGIN
+            {_somar('emprestimos_total', '-1')}
+            {_somar('emprestimos_abertos', 'old.status_finalizado - 1')}
+            {_somar_usuario('old."ID"', 'old.status_finalizado - 1')}
+        END''',
+]
+
+
+def criar_estatisticas(conn):
+    """
+        Cria os triggers dos contadores e calcula os valores iniciais.
+
+        As tabelas `estatistica` e `estatistica_usuario` são criadas pelo
+        `create_all` (models.py).
+    """
+    for sql in SQL_TRIGGERS:
+        conn.exec_driver_sql(sql)
+    reconciliar_estatisticas(conn)
+
+
+def reconciliar_estatisticas(conn):
+    """
+        Recalcula todos os contadores do zero a partir das tabelas.
+
+        Serve para corrigir os contadores depois de escritas feitas por fora
+        da aplicação com os triggers desligados, ou para conferir os valores.
+    """
+    conn.exec_driver_sql('DELETE FROM estatistica')
+    conn.exec_driver_sql('''
+        INSERT INTO estatistica (chave, valor)
+        SELECT 'livros_total', COUNT(*) FROM livro
+        UNION ALL SELECT 'livros_ativos', COALESCE(SUM(livro_ativo), 0) FROM livro
+        UNION ALL SELECT 'livros_emprestados', COALESCE(SUM(status_emprestado), 0) FROM livro
+        UNION ALL SELECT 'usuarios_total', COUNT(*) FROM usuario
+        UNION ALL SELECT 'usuarios_ativos', COALESCE(SUM(usuario_ativo), 0) FROM usuario
+        UNION ALL SELECT 'emprestimos_total', COUNT(*) FROM emprestimo
+        UNION ALL SELECT 'emprestimos_abertos', COALESCE(SUM(1 - status_finalizado), 0) FROM emprestimo
+    ''')
+    conn.exec_driver_sql('DELETE FROM estatistica_usuario')
+    conn.exec_driver_sql('''
+        INSERT INTO estatistica_usuario (id_usuario, emprestimos_abertos)
+        SELECT "ID", COUNT(*) FROM emprestimo
+        WHERE status_finalizado = 0 AND "ID" IS NOT NULL
+        GROUP BY "ID"
+    ''')
@@ -0,0 +1,239 @@
+#métricas por rota (latência, status, consultas SQL) no formato texto do Prometheus.
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+from flask import g, has_app_context, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger_sql_lenta = logging.getLogger('bancoAPI.sql_lenta')
+
+# limites dos buckets do histograma de latência, em segundos
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+# consultas mais lentas que isso entram no log de SQL lenta (METRICAS_SQL_LENTA_MS)
+LIMIAR_SQL_LENTA = float(os.environ.get('METRICAS_SQL_LENTA_MS', 100)) / 1000
+MAXIMO_SQL_LENTAS = 100
+
+
+class Histograma:
+    def __init__(self):
+        self.contagens = [0] * (len(BUCKETS) + 1)
+        self.soma = 0.0
+        self.total = 0
+
+    def observar(self, valor):
+        for i, limite in enumerate(BUCKETS):
+            if valor <= limite:
+                self.contagens[i] += 1
+                break
+        else:
+            self.contagens[-1] += 1
+        self.soma += valor
+        self.total += 1
+
+
+class Metricas:
+    """
+        Guarda as métricas do processo.
+
+        Os contadores são atualizados uma vez por requisição (quando a
+        resposta é fechada), então o custo por consulta SQL fica só em somar dois números no `g`.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencias = {}
+        self.requisicoes = {}
+        self.sql_consultas = {}
+        self.sql_tempo = {}
+        self.sql_consultas_fora_requisicao = 0
+        self.sql_lentas = deque(maxlen=MAXIMO_SQL_LENTAS)
+
+    def registrar_requisicao(self, rota, metodo, status, duracao, consultas, tempo_sql):
+        chave = (rota, metodo)
+        with self._lock:
+            histograma = self.latencias.get(chave)
+            if histograma is None:
+                histograma = self.latencias[chave] = Histograma()
+            histograma.observar(duracao)
+            chave_status = (rota, metodo, status)
+            self.requisicoes[chave_status] = self.requisicoes.get(chave_status, 0) + 1
+            self.sql_consultas[chave] = self.sql_consultas.get(chave, 0) + consultas
+            self.sql_tempo[chave] = self.sql_tempo.get(chave, 0.0) + tempo_sql
+
+    def registrar_sql_fora_requisicao(self):
+        with self._lock:
+            self.sql_consultas_fora_requisicao += 1
+
+    def registrar_sql_lenta(self, dados):
+        with self._lock:
+            self.sql_lentas.append(dados)
+
+    def exportar_prometheus(self, extras=()):
+        """
+            Texto no formato de exposição do Prometheus.
+
+            `extras` é uma sequência de `(nome, tipo, ajuda, valor)` com
+            métricas de outros módulos (ex.: contadores do cache). `valor`
+            também pode ser uma lista de `(rotulos, valor)` para uma série por rótulo.
+        """
+        linhas = []
+
+        def rotulos(**valores):
+            return ','.join('{}="{}"'.format(k, str(v).replace('"', '\\"')) for k, v in valores.items())
+
+        with self._lock:
+            linhas.append('# HELP http_requests_total Requisições por rota, método e status.')
+            linhas.append('# TYPE http_requests_total counter')
+            for (rota, metodo, status), valor in sorted(self.requisicoes.items()):
+                linhas.append('http_requests_total{%s} %d' % (rotulos(rota=rota, metodo=metodo, status=status), valor))
+
+            linhas.append('# HELP http_request_duration_seconds Latência das requisições por rota.')
+            linhas.append('# TYPE http_request_duration_seconds histogram')
+            for (rota, metodo), histograma in sorted(self.latencias.items()):
+                acumulado = 0
+                for limite, contagem in zip(BUCKETS + ('+Inf',), histograma.contagens):
+                    acumulado += contagem
+                    linhas.append('http_request_duration_seconds_bucket{%s} %d' % (
+                        rotulos(rota=rota, metodo=metodo, le=limite), acumulado))
+                linhas.append('http_request_duration_seconds_sum{%s} %.6f' % (rotulos(rota=rota, metodo=metodo), histograma.soma))
+                linhas.append('http_request_duration_seconds_count{%s} %d' % (rotulos(rota=rota, metodo=metodo), histograma.total))
+
+            linhas.append('# HELP db_queries_total Consultas SQL executadas por rota.')
+            linhas.append('# TYPE db_queries_total counter')
+            for (rota, metodo), valor in sorted(self.sql_consultas.items()):
+                linhas.append('db_queries_total{%s} %d' % (rotulos(rota=rota, metodo=metodo), valor))
+            linhas.append('db_queries_total{%s} %d' % (rotulos(rota='', metodo=''), self.sql_consultas_fora_requisicao))
+
+            linhas.append('# HELP db_query_duration_seconds_total Tempo gasto no banco por rota.')
+            linhas.append('# TYPE db_query_duration_seconds_total counter')
+            for (rota, metodo), valor in sorted(self.sql_tempo.items()):
+                linhas.append('db_query_duration_seconds_total{%s} %.6f' % (rotulos(rota=rota, metodo=metodo), valor))
+
+            linhas.append('# HELP db_slow_queries_logged Consultas no log de SQL lenta (últimas %d).' % MAXIMO_SQL_LENTAS)
+            linhas.append('# TYPE db_slow_queries_logged gauge')
+            linhas.append('db_slow_queries_logged %d' % len(self.sql_lentas))
+
+        for nome, tipo, ajuda, valor in extras:
+            linhas.append('# HELP {} {}'.format(nome, ajuda))
+            linhas.append('# TYPE {} {}'.format(nome, tipo))
+            if isinstance(valor, list):
+                for valores_rotulos, valor_serie in valor:
+                    linhas.append('{}{{{}}} {}'.format(nome, rotulos(**valores_rotulos), valor_serie))
+            else:
+                linhas.append('{} {}'.format(nome, valor))
+        return '\n'.join(linhas) + '\n'
+
+
+metricas = Metricas()
+
+
+class Medicao:
+    """Contadores de uma requisição, guardados no `g`."""
+    __slots__ = ('inicio', 'consultas', 'tempo_sql')
+
+    def __init__(self):
+        self.inicio = time.perf_counter()
+        self.consultas = 0
+        self.tempo_sql = 0.0
+
+
+def explicar_consulta(conn, statement, parameters):
+    """
+        `EXPLAIN QUERY PLAN` da consulta lenta (só SQLite e só SELECT/UPDATE/DELETE).
+    """
+    if conn.dialect.name != 'sqlite':
+        return None
+    if not statement.lstrip().upper().startswith(('SELECT', 'UPDATE', 'DELETE', 'WITH')):
+        return None
+    try:
+        cursor = conn.connection.driver_connection.cursor()
+        try:
+            cursor.execute('EXPLAIN QUERY PLAN ' + statement, parameters)
+            return [linha[-1] for linha in cursor.fetchall()]
+        finally:
+            cursor.close()
+    except Exception as e:
+        return ['erro ao gerar plano: {}'.format(e)]
+
+
+def instalar(app):
+    """
+        Registra os hooks do Flask no `app` e, uma vez por processo, os
+        eventos do SQLAlchemy.
+
+        Os eventos ficam na classe `Engine` e valem para todas as engines
+        (leitura e escrita), inclusive as criadas depois, no primeiro uso.
+    """
+
+    @app.before_request
+    def iniciar_medicao():
+        g.metricas_medicao = Medicao()
+
+    # o registro é feito no fechamento da resposta e não no after_request:
+    # em respostas com streaming o corpo (e as consultas SQL dele) só é
+    # gerado depois, e a latência deve incluir esse tempo
+    @app.after_request
+    def agendar_registro(response):
+        medicao = g.get('metricas_medicao')
+        if medicao is None:
+            return response
+        rota = request.url_rule.rule if request.url_rule is not None else 'nao_encontrada'
+        metodo = request.method
+        status = response.status_code
+
+        def registrar():
+            metricas.registrar_requisicao(rota, metodo, status,
+                                          time.perf_counter() - medicao.inicio,
+                                          medicao.consultas, medicao.tempo_sql)
+
+        response.call_on_close(registrar)
+        return response
+
+    instalar_eventos_sql()
+
+
+_eventos_instalados = False
+
+
+def instalar_eventos_sql():
+    global _eventos_instalados
+    if _eventos_instalados:
+        return
+    _eventos_instalados = True
+
+    # um valor só por conexão, sobrescrito a cada comando: quando o comando
+    # falha o after_cursor_execute não roda, e uma pilha cresceria sem fim
+    def antes_sql(conn, cursor, statement, parameters, context, executemany):
+        conn.info['metricas_inicio'] = time.perf_counter()
+
+    def depois_sql(conn, cursor, statement, parameters, context, executemany):
+        inicio = conn.info.pop('metricas_inicio', None)
+        if inicio is None:
+            return
+        duracao = time.perf_counter() - inicio
+        medicao = g.get('metricas_medicao') if has_app_context() else None
+        if medicao is not None:
+            medicao.consultas += 1
+            medicao.tempo_sql += duracao
+        else:
+            metricas.registrar_sql_fora_requisicao()
+
+        if duracao >= LIMIAR_SQL_LENTA and statement != 'BEGIN':
+            plano = None if executemany else explicar_consulta(conn, statement, parameters)
+            dados = {
+                'duracao_ms': round(duracao * 1000, 3),
+                'sql': statement,
+                'plano': plano,
+                'rota': request.url_rule.rule if has_request_context() and request.url_rule else None,
+                'quando': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            }
+            metricas.registrar_sql_lenta(dados)
+            logger_sql_lenta.warning('SQL lenta (%.1f ms) em %s: %s | plano: %s',
+                                     dados['duracao_ms'], dados['rota'], statement, plano)
+
+    event.listen(Engine, 'before_cursor_execute', antes_sql)
+    event.listen(Engine, 'after_cursor_execute', depois_sql)
@@ -0,0 +1,195 @@
+#migrações do schema do banco (versão guardada em PRAGMA user_version).
+from models import Base, engine
+from busca import criar_indice_busca
+from estatisticas import criar_estatisticas
+from mudancas import criar_log_mudancas
+
+
+def versao_atual(conn):
+    return conn.exec_driver_sql('PRAGMA user_version').scalar()
+
+
+def tipo_coluna(conn, tabela, coluna):
+    for info in conn.exec_driver_sql(f'PRAGMA table_info({tabela})'):
+        if info[1] == coluna:
+            return info[2].upper()
+    return None
+
+
+def converter_datas_emprestimo(conn):
+    """
+        Converte `data_emprestimo` e `data_devolucao` de VARCHAR para DATE.
+
+        As datas antigas estão como `dd/mm/aaaa` e passam a ser guardadas em
+        ISO (`aaaa-mm-dd`), que é o formato do tipo Date do SQLAlchemy e que
+        ordena corretamente no índice. Também cria o índice composto
+        (`status_finalizado`, `data_devolucao`) usado pelas consultas de atraso.
+    """
+    if tipo_coluna(conn, 'emprestimo', 'data_devolucao') != 'DATE':
+        conn.exec_driver_sql('ALTER TABLE emprestimo RENAME TO emprestimo_antiga')
+        conn.exec_driver_sql('''
+            CREATE TABLE emprestimo (
+                id_emprestimo INTEGER NOT NULL,
+                data_emprestimo DATE NOT NULL,
+                data_devolucao DATE NOT NULL,
+                status_finalizado BOOLEAN NOT NULL,
+                "ID" INTEGER,
+                "ID_livro" INTEGER,
+                PRIMARY KEY (id_emprestimo),
+                FOREIGN KEY("ID") REFERENCES usuario (id),
+                FOREIGN KEY("ID_livro") REFERENCES livro (id_livro)
+            )
+        ''')
+        data_iso = '''CASE WHEN {0} LIKE '__/__/____'
+                      THEN substr({0}, 7, 4) || '-' || substr({0}, 4, 2) || '-' || substr({0}, 1, 2)
+                      ELSE {0} END'''
+        conn.exec_driver_sql(f'''
+            INSERT INTO emprestimo (id_emprestimo, data_emprestimo, data_devolucao,
+                                    status_finalizado, "ID", "ID_livro")
+            SELECT id_emprestimo, {data_iso.format('data_emprestimo')},
+                   {data_iso.format('data_devolucao')}, status_finalizado, "ID", "ID_livro"
+            FROM emprestimo_antiga
+        ''')
+        conn.exec_driver_sql('DROP TABLE emprestimo_antiga')
+    conn.exec_driver_sql('CREATE INDEX IF NOT EXISTS ix_emprestimo_status_devolucao '
+                         'ON emprestimo (status_finalizado, data_devolucao)')
+
+
+def criar_busca_livros(conn):
+    """
+        Cria o índice FTS5 de `livro` (titulo, autor, descricao) e indexa os livros existentes.
+    """
+    if conn.dialect.name == 'sqlite':
+        criar_indice_busca(conn)
+
+
+def criar_contadores_estatisticas(conn):
+    """
+        Cria os triggers dos contadores de `GET /estatisticas` e os calcula pela primeira vez.
+    """
+    if conn.dialect.name == 'sqlite':
+        criar_estatisticas(conn)
+
+
+def formatar_cpfs_usuario(conn):
+    """
+        Converte os CPFs guardados só com dígitos para `000.000.000-00`.
+
+        É o formato gravado por `novo_usuario` e usado como chave do
+        `POST /usuarios/sync`; sem isso o mesmo CPF poderia existir nas
+        duas formas. CPFs cuja forma formatada já existe ficam como estão.
+    """
+    formatado = "substr(cpf, 1, 3) || '.' || substr(cpf, 4, 3) || '.' || substr(cpf, 7, 3) || '-' || substr(cpf, 10, 2)"
+    conn.exec_driver_sql(f'''
+        UPDATE usuario SET cpf = {formatado}
+        WHERE length(cpf) = 11 AND cpf NOT GLOB '*[^0-9]*'
+          AND NOT EXISTS (SELECT 1 FROM usuario AS outro WHERE outro.cpf = {formatado.replace('cpf', 'usuario.cpf')})
+    ''')
+
+
+def criar_indices_emprestimo(conn):
+    """
+        Cria os índices das chaves estrangeiras de `emprestimo`.
+
+        Sem eles `GET /emprestimos/user<id>` varria a tabela inteira
+        (verificado com `python -m benchmark.planos`).
+    """
+    conn.exec_driver_sql('CREATE INDEX IF NOT EXISTS ix_emprestimo_usuario_status '
+                         'ON emprestimo ("ID", status_finalizado)')
+    conn.exec_driver_sql('CREATE INDEX IF NOT EXISTS ix_emprestimo_livro ON emprestimo ("ID_livro")')
+
+
+def criar_indice_data_emprestimo(conn):
+    """
+        Índice de `data_emprestimo`, usado pelo filtro `desde`/`ate` e pela
+        ordenação de `GET /emprestimos/export`.
+    """
+    conn.exec_driver_sql('CREATE INDEX IF NOT EXISTS ix_emprestimo_data_emprestimo '
+                         'ON emprestimo (data_emprestimo)')
+
+
+def criar_colunas_atraso(conn):
+    """
+        Adiciona `status_atrasado` e `multa` em `emprestimo` (varredura de atrasos).
+    """
+    if tipo_coluna(conn, 'emprestimo', 'status_atrasado') is None:
+        conn.exec_driver_sql('ALTER TABLE emprestimo ADD COLUMN status_atrasado BOOLEAN NOT NULL DEFAULT 0')
+    if tipo_coluna(conn, 'emprestimo', 'multa') is None:
+        conn.exec_driver_sql('ALTER TABLE emprestimo ADD COLUMN multa FLOAT NOT NULL DEFAULT 0')
+
+
+def criar_triggers_mudancas(conn):
+    """
+        Cria os triggers do log de mudanças (`GET /mudancas`).
+    """
+    if conn.dialect.name == 'sqlite':
+        criar_log_mudancas(conn)
+
+
+def criar_indice_periodo_emprestimo(conn):
+    """
+        Troca o índice de `ID_livro` por (`ID_livro`, `status_finalizado`,
+        `data_emprestimo`, `data_devolucao`), usado nas consultas de
+        disponibilidade por período; o antigo é prefixo do novo.
+    """
+    conn.exec_driver_sql('CREATE INDEX IF NOT EXISTS ix_emprestimo_livro_periodo '
+                         'ON emprestimo ("ID_livro", status_finalizado, data_emprestimo, data_devolucao)')
+    conn.exec_driver_sql('DROP INDEX IF EXISTS ix_emprestimo_livro')
+
+
+def formatar_telefones_usuario(conn):
+    """
+        Converte os telefones guardados só com dígitos (11) para `00 00000-0000`.
+
+        `novo_usuario` gravava o telefone como veio, enquanto `editar_usuarios`
+        e o `POST /usuarios/sync` gravam formatado; sem isso o primeiro sync
+        de um usuario cadastrado pela API o contaria como atualizado.
+    """
+    conn.exec_driver_sql('''
+        UPDATE usuario SET telefone = substr(telefone, 1, 2) || ' ' || substr(telefone, 3, 5) || '-' || substr(telefone, 8, 4)
+        WHERE length(telefone) = 11 AND telefone NOT GLOB '*[^0-9]*'
+    ''')
+
+
+# em ordem; a posição na lista (a partir de 1) é o número da versão.
+# Cada migração deve funcionar também em bancos novos, criados já com o
+# schema atual pelo create_all.
+MIGRACOES = [
+    converter_datas_emprestimo,
+    criar_busca_livros,
+    criar_contadores_estatisticas,
+    formatar_cpfs_usuario,
+    criar_indices_emprestimo,
+    criar_indice_data_emprestimo,
+    criar_colunas_atraso,
+    criar_triggers_mudancas,
+    criar_indice_periodo_emprestimo,
+    formatar_telefones_usuario,
+]
+
+
+def aplicar_migracoes(bind=engine):
+    """
+        Cria as tabelas que faltam e aplica as migrações pendentes.
+
+        Cada migração roda na sua própria transação junto com a atualização
+        do `user_version`, então uma falha não deixa o banco pela metade.
+    """
+    Base.metadata.create_all(bind=bind)
+    aplicadas = []
+    with bind.connect() as conn:
+        versao = versao_atual(conn)
+        conn.rollback()
+        for numero, migracao in enumerate(MIGRACOES, start=1):
+            if numero <= versao:
+                continue
+            with conn.begin():
+                migracao(conn)
+                conn.exec_driver_sql(f'PRAGMA user_version = {numero}')
+            aplicadas.append(migracao.__name__)
+    return aplicadas
+
+
+if __name__ == '__main__':
+    for nome in aplicar_migracoes():
+        print('migração aplicada:', nome)
@@ -1,16 +1,19 @@
 #importar biblioteca.
-from sqlalchemy import create_engine, Column, Integer, String, ForeignKey, Float, Boolean, Date
-#importar session e sessionmaker.
-from sqlalchemy.orm import sessionmaker, declarative_base, Relationship
+import os
+from datetime import date
 
-#configurar a conexão de banco.
-engine = create_engine('sqlite:///base_biblioteca.sqlite3')
+from sqlalchemy import Column, Integer, String, ForeignKey, Float, Boolean, Date, DateTime, Index, func
+#importar declarative_base.
+from sqlalchemy.orm import declarative_base, Relationship
 
-#gerenciar sessao com banco de dados.
+#engine e sessoes configuradas em database.py (DATABASE_URL, PRAGMAs e pool).
 #db_session = scoped_session(sessionmaker(bind=engine)) antigo
-local_session = sessionmaker(bind=engine)
+from database import engine, local_session
 
 Base = declarative_base()
+
+# valor da multa por dia de atraso (MULTA_DIARIA)
+MULTA_DIARIA = float(os.environ.get('MULTA_DIARIA', 1.0))
 #Base.query = db_session.query_property()
 
 class Usuario(Base):
@@ -52,6 +55,8 @@ class Livro(Base):
     isbn = Column(String, nullable=False)
     titulo = Column(String, nullable=False, index=True)
     autor = Column(String, nullable=False, index=True)
+    # tem emprestimo em aberto que já começou; uma reserva futura só marca o
+    # livro no dia do início (atrasos.marcar_reservas_iniciadas)
     status_emprestado = Column(Boolean, nullable=False, index=True, default=False)
     descricao = Column(String)
     livro_ativo = Column(Boolean, nullable=False, index=True, default=True)
@@ -86,15 +91,33 @@ class Livro(Base):
 class Emprestimo(Base):
     __tablename__ = 'emprestimo'
     id_emprestimo = Column(Integer, primary_key=True)
-    data_emprestimo = Column(String, nullable=False)
-    data_devolucao = Column(String, nullable=False)
+    data_emprestimo = Column(Date, nullable=False)
+    data_devolucao = Column(Date, nullable=False)
     status_finalizado = Column(Boolean, nullable=False, default=False)
+    # status_atrasado é marcado pela varredura de atrasos (atrasos.py) e na
+    # escrita de emprestimos já vencidos; multa é a da devolução. Enquanto o
+    # emprestimo está em aberto os dois são calculados na leitura (atraso())
+    status_atrasado = Column(Boolean, nullable=False, default=False, server_default='0')
+    multa = Column(Float, nullable=False, default=0, server_default='0')
 
     ID = Column(Integer, ForeignKey('usuario.id'))
     ID_livro = Column(Integer, ForeignKey('livro.id_livro'))
     usuario_relacao = Relationship('Usuario')
     livro_relacao = Relationship('Livro')
 
+    __table_args__ = (
+        # emprestimos em aberto por data de devolução (atrasados / vencendo)
+        Index('ix_emprestimo_status_devolucao', 'status_finalizado', 'data_devolucao'),
+        # emprestimos de um usuário (GET /emprestimos/user<id>); serve também
+        # para as buscas só por "ID", que é o prefixo do índice
+        Index('ix_emprestimo_usuario_status', 'ID', 'status_finalizado'),
+        # emprestimos de um livro; os em aberto, como intervalos de datas,
+        # ficam em uma faixa ordenada pelo início (disponibilidade.py)
+        Index('ix_emprestimo_livro_periodo', 'ID_livro', 'status_finalizado', 'data_emprestimo', 'data_devolucao'),
+        # exportação por período (GET /emprestimos/export)
+        Index('ix_emprestimo_data_emprestimo', 'data_emprestimo'),
+    )
+
     def __repr__(self):
         return '<id_emprestimo={}, id_livro={}, id_usuario={}>'.format(self.id_emprestimo,
                                                                        self.ID_livro,
@@ -111,20 +134,109 @@ class Emprestimo(Base):
     #     db_session.delete(self)
     #     db_session.commit()
 
-    def serialize_emprestimo(self):
+    def atraso(self, hoje=None):
+        """
+            `(status_atrasado, multa)` do emprestimo em `hoje`.
+
+            Em aberto os dois vêm de `data_devolucao`, sem depender da
+            varredura; finalizado, valem os gravados na devolução.
+        """
+        if self.status_finalizado:
+            return self.status_atrasado, self.multa
+        dias = ((hoje or date.today()) - self.data_devolucao).days
+        if dias <= 0:
+            return False, 0.0
+        return True, round(dias * MULTA_DIARIA, 2)
+
+    def serialize_emprestimo(self, expand=()):
+        status_atrasado, multa = self.atraso()
         dados_emprestimo = {
             'id_emprestimo': self.id_emprestimo,
-            'data_emprestimo': self.data_emprestimo,
-            'data_devolucao': self.data_devolucao,
+            'data_emprestimo': self.data_emprestimo.isoformat(),
+            'data_devolucao': self.data_devolucao.isoformat(),
             'status_finalizado': self.status_finalizado,
+            'status_atrasado': status_atrasado,
+            'multa': multa,
             'ID': self.ID,
             'ID_livro': self.ID_livro,
         }
+        # objetos relacionados embutidos (carregar antes com contains_eager/joinedload)
+        if 'livro' in expand:
+            dados_emprestimo['livro'] = self.livro_relacao.serialize_livro()
+        if 'usuario' in expand:
+            dados_emprestimo['usuario'] = self.usuario_relacao.serialize_usuario()
         return dados_emprestimo
 
 
+class Estatistica(Base):
+    # contadores globais mantidos por triggers (estatisticas.py)
+    __tablename__ = 'estatistica'
+    chave = Column(String, primary_key=True)
+    valor = Column(Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return '<Estatistica({}={})>'.format(self.chave, self.valor)
+
+
+class EstatisticaUsuario(Base):
+    # emprestimos em aberto por usuario, mantidos por triggers (estatisticas.py)
+    __tablename__ = 'estatistica_usuario'
+    id_usuario = Column(Integer, ForeignKey('usuario.id'), primary_key=True)
+    emprestimos_abertos = Column(Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return '<EstatisticaUsuario(id_usuario={}, emprestimos_abertos={})>'.format(self.id_usuario,
+                                                                                  self.emprestimos_abertos)
+
+
+class Varredura(Base):
+    # marca d'água das tarefas periódicas (atrasos.py)
+    __tablename__ = 'varredura'
+    nome = Column(String, primary_key=True)
+    data_referencia = Column(Date, nullable=False)
+    atualizados = Column(Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return '<Varredura({}, data_referencia={})>'.format(self.nome, self.data_referencia)
+
+
+class Mudanca(Base):
+    # log de alterações de livro, usuario e emprestimo, gravado por triggers (mudancas.py)
+    __tablename__ = 'mudanca'
+    # AUTOINCREMENT: um seq nunca é reutilizado, nem depois da compactação
+    seq = Column(Integer, primary_key=True)
+    entidade = Column(String, nullable=False)
+    id_entidade = Column(Integer, nullable=False)
+    operacao = Column(String, nullable=False)
+    # colunas alteradas separadas por vírgula; NULL no insert e no delete (todas)
+    colunas = Column(String)
+    data = Column(DateTime, nullable=False, server_default=func.current_timestamp())
+
+    __table_args__ = (
+        # mudanças de uma entidade em ordem de seq (o rowid é o fim do índice)
+        Index('ix_mudanca_entidade', 'entidade'),
+        # mudanças de cada registro (compactação)
+        Index('ix_mudanca_entidade_id', 'entidade', 'id_entidade'),
+        {'sqlite_autoincrement': True},
+    )
+
+    def __repr__(self):
+        return '<Mudanca(seq={}, {} {} {})>'.format(self.seq, self.operacao, self.entidade, self.id_entidade)
+
+    def serialize_mudanca(self):
+        return {
+            'seq': self.seq,
+            'entidade': self.entidade,
+            'id': self.id_entidade,
+            'operacao': self.operacao,
+            'colunas': self.colunas.split(',') if self.colunas else None,
+            'data': self.data.isoformat(),
+        }
+
+
 def init_db():
-    Base.metadata.create_all(bind=engine)
+    from migracoes import aplicar_migracoes
+    aplicar_migracoes(engine)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,120 @@
+#log de mudanças de livro, usuario e emprestimo (GET /mudancas), gravado por triggers.
+import logging
+
+from sqlalchemy import select, update, delete, func
+
+from models import Base, engine, Mudanca
+
+logger = logging.getLogger('bancoAPI.mudancas')
+
+# tabela -> chave primária
+ENTIDADES = {
+    'livro': 'id_livro',
+    'usuario': 'id',
+    'emprestimo': 'id_emprestimo',
+}
+# registros compactados por transação
+TAMANHO_LOTE_COMPACTACAO = 500
+
+
+def _registrar(entidade, id_entidade, operacao, colunas='NULL'):
+    return (f"INSERT INTO mudanca (entidade, id_entidade, operacao, colunas) "
+            f"VALUES ('{entidade}', {id_entidade}, '{operacao}', {colunas});")
+
+
+def sql_triggers(entidade):
+    """
+        Triggers de insert, update e delete de `entidade`.
+
+        No update só as colunas que mudaram de valor entram em `colunas`, e
+        um UPDATE que não muda nada não gera registro.
+    """
+    chave = ENTIDADES[entidade]
+    colunas = [f'"{coluna.name}"' for coluna in Base.metadata.tables[entidade].columns]
+    mudou = ' OR '.join(f'old.{c} IS NOT new.{c}' for c in colunas)
+    # ",titulo,autor" -> "titulo,autor"
+    alteradas = 'substr({}, 2)'.format(' || '.join(
+        f"""CASE WHEN old.{c} IS NOT new.{c} THEN ',{c.strip('"')}' ELSE '' END""" for c in colunas))
+    return [
+        f'''CREATE TRIGGER mudanca_{entidade}_insert AFTER INSERT ON {entidade} BEGIN
+                {_registrar(entidade, f'new."{chave}"', 'insert')}
+            END''',
+        f'''CREATE TRIGGER mudanca_{entidade}_update AFTER UPDATE ON {entidade} WHEN {mudou} BEGIN
+                {_registrar(entidade, f'new."{chave}"', 'update', alteradas)}
+            END''',
+        f'''CREATE TRIGGER mudanca_{entidade}_delete AFTER DELETE ON {entidade} BEGIN
+                {_registrar(entidade, f'old."{chave}"', 'delete')}
+            END''',
+    ]
+
+
+def criar_log_mudancas(conn):
+    """
+        (Re)cria os triggers do log de mudanças.
+
+        A lista de colunas comparadas no update vem dos modelos, então uma
+        migração que adicionar colunas deve chamar esta função de novo. A
+        tabela `mudanca` é criada pelo `create_all` (models.py); registros que
+        já existiam não entram no log, os clientes partem do snapshot.
+    """
+    for entidade in ENTIDADES:
+        for operacao in ('insert', 'update', 'delete'):
+            conn.exec_driver_sql(f'DROP TRIGGER IF EXISTS mudanca_{entidade}_{operacao}')
+        for sql in sql_triggers(entidade):
+            conn.exec_driver_sql(sql)
+
+
+def juntar_mudancas(operacoes):
+    """
+        Junta as mudanças `(operacao, colunas)` de um registro, em ordem, em uma só.
+
+        Um insert ou delete vale pelo registro inteiro; depois de um insert
+        os updates continuam sendo o mesmo insert, e os updates seguidos
+        viram um update com a união das colunas.
+    """
+    operacao, colunas = 'update', {}
+    for op, cols in operacoes:
+        if op != 'update':
+            operacao, colunas = op, None
+        elif colunas is not None:
+            colunas.update(dict.fromkeys(cols.split(',')))
+    return operacao, (','.join(colunas) if colunas is not None else None)
+
+
+def compactar_mudancas(bind=engine, tamanho_lote=TAMANHO_LOTE_COMPACTACAO):
+    """
+        Deixa no log só a última mudança de cada registro.
+
+        A mudança mantida (o maior `seq`) recebe a junção das anteriores
+        (`juntar_mudancas`). Um cliente em qualquer `desde` continua vendo
+        todos os registros alterados depois dele, às vezes com mais colunas
+        do que mudaram desde então, e o log passa a crescer com o número de
+        registros alterados e não com o número de alterações.
+
+        Retorna `{'registros', 'removidas'}`.
+    """
+    with bind.connect() as conn:
+        chaves = conn.execute(
+            select(Mudanca.entidade, Mudanca.id_entidade)
+            .group_by(Mudanca.entidade, Mudanca.id_entidade)
+            .having(func.count() > 1)
+        ).all()
+
+    # uma transação por lote: as escritas da API entram entre um lote e outro
+    removidas = 0
+    for inicio in range(0, len(chaves), tamanho_lote):
+        with bind.begin() as conn:
+            for entidade, id_entidade in chaves[inicio:inicio + tamanho_lote]:
+                do_registro = (Mudanca.entidade == entidade, Mudanca.id_entidade == id_entidade)
+                linhas = conn.execute(select(Mudanca.seq, Mudanca.operacao, Mudanca.colunas)
+                                      .where(*do_registro).order_by(Mudanca.seq)).all()
+                if len(linhas) < 2:
+                    continue
+                operacao, colunas = juntar_mudancas((op, cols) for _, op, cols in linhas)
+                ultimo = linhas[-1].seq
+                conn.execute(update(Mudanca).where(Mudanca.seq == ultimo)
+                             .values(operacao=operacao, colunas=colunas))
+                removidas += conn.execute(delete(Mudanca).where(*do_registro, Mudanca.seq < ultimo)).rowcount
+
+    logger.info('log de mudanças compactado: %d registros, %d mudanças removidas', len(chaves), removidas)
+    return {'registros': len(chaves), 'removidas': removidas}
@@ -0,0 +1,64 @@
+#documento OpenAPI (/apidoc/openapi.json) guardado em disco, por hash da tabela de rotas.
+import hashlib
+import json
+import logging
+import os
+
+from flask_pydantic_spec import FlaskPydanticSpec
+
+logger = logging.getLogger('bancoAPI.openapi')
+
+
+def hash_rotas(app, extra=''):
+    """
+        Hash das rotas do `app` (regra, métodos, endpoint e docstring da view).
+
+        A docstring entra porque é dela que saem o resumo e a descrição de
+        cada operação no documento.
+    """
+    h = hashlib.sha256(extra.encode())
+    for regra in sorted(app.url_map.iter_rules(), key=lambda r: (r.rule, r.endpoint)):
+        view = app.view_functions.get(regra.endpoint)
+        h.update(repr((regra.rule, regra.endpoint, sorted(regra.methods or ()),
+                       getattr(view, '__doc__', None))).encode())
+    return h.hexdigest()
+
+
+class SpecEmCache(FlaskPydanticSpec):
+    """
+        `FlaskPydanticSpec` que gera o documento no primeiro acesso e o grava
+        em `caminho_cache`; os próximos processos com as mesmas rotas só leem o arquivo.
+    """
+
+    def __init__(self, *args, caminho_cache=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.caminho_cache = caminho_cache
+
+    @property
+    def spec(self):
+        if not hasattr(self, '_spec'):
+            self._spec = self._carregar_ou_gerar()
+        return self._spec
+
+    def _carregar_ou_gerar(self):
+        chave = hash_rotas(self.app, '{}:{}'.format(self.config.TITLE, self.config.VERSION))
+        if self.caminho_cache and os.path.exists(self.caminho_cache):
+            try:
+                with open(self.caminho_cache) as arquivo:
+                    dados = json.load(arquivo)
+                if dados.get('hash') == chave:
+                    return dados['spec']
+            except (OSError, ValueError, KeyError):
+                logger.warning('cache do OpenAPI inválido em %s, gerando de novo', self.caminho_cache)
+
+        spec = self._generate_spec()
+        if self.caminho_cache:
+            # grava num temporário e troca, para outro processo nunca ler o arquivo pela metade
+            temporario = '{}.{}.tmp'.format(self.caminho_cache, os.getpid())
+            try:
+                with open(temporario, 'w') as arquivo:
+                    json.dump({'hash': chave, 'spec': spec}, arquivo)
+                os.replace(temporario, self.caminho_cache)
+            except OSError as e:
+                logger.warning('não foi possível gravar o cache do OpenAPI: %s', e)
+        return spec
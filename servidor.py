@@ -0,0 +1,178 @@
+#servidor de produção: processo mestre + workers (prefork), cada um com um pool de threads.
+#precisa do fork do POSIX (Linux, macOS, BSD); no Windows só o servidor de desenvolvimento.
+#
+#uso:
+#   python app.py --workers 4 --threads 8 --porta 5001
+#
+#sinais do mestre:
+#   SIGTERM / SIGINT  encerra: os workers terminam as requisições em andamento e saem
+#   SIGHUP            recarrega: encerra os workers da mesma forma e executa o
+#                     mestre de novo (código novo) mantendo o socket aberto, então
+#                     as conexões que chegam nesse meio tempo esperam na fila do socket
+import logging
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.serving import BaseWSGIServer
+
+logger = logging.getLogger('bancoAPI.servidor')
+
+# socket herdado pelo mestre recarregado (SIGHUP)
+VARIAVEL_FD = 'BANCOAPI_FD'
+# tempo máximo para um worker terminar as requisições em andamento
+TEMPO_ENCERRAMENTO = 30
+
+
+class ServidorPool(BaseWSGIServer):
+    """
+        Servidor WSGI do werkzeug que atende as conexões com um número fixo de threads.
+    """
+
+    def __init__(self, host, porta, app, threads, fd):
+        super().__init__(host, porta, app, fd=fd)
+        self.pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='worker')
+
+    def get_request(self):
+        conn, endereco = super().get_request()
+        # o socket de escuta é não bloqueante (abrir_socket); no Linux o socket
+        # aceito nasce bloqueante, mas no BSD/macOS ele herda o modo do de escuta
+        conn.setblocking(True)
+        return conn, endereco
+
+    def process_request(self, request, client_address):
+        self.pool.submit(self._processar, request, client_address)
+
+    def _processar(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def encerrar(self):
+        # chamado fora da thread do serve_forever (shutdown espera o loop sair)
+        self.shutdown()
+        self.pool.shutdown(wait=True)
+
+
+def abrir_socket(host, porta):
+    fd = os.environ.pop(VARIAVEL_FD, None)
+    if fd is not None:
+        sock = socket.socket(fileno=int(fd))
+    else:
+        sock = socket.create_server((host, porta), backlog=1024)
+    sock.set_inheritable(True)
+    # vários workers esperam no mesmo socket: quem perde a corrida pelo
+    # accept recebe BlockingIOError (ignorado pelo socketserver) em vez de travar
+    sock.setblocking(False)
+    return sock
+
+
+def executar_worker(app, host, porta, threads, sock, numero, ao_iniciar):
+    """
+        Corpo do processo filho; nunca retorna.
+    """
+    codigo = 0
+    try:
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        if ao_iniciar is not None:
+            ao_iniciar(numero)
+        servidor = ServidorPool(host, porta, app, threads, sock.fileno())
+        encerrando = threading.Event()
+
+        def parar(signum, frame):
+            if not encerrando.is_set():
+                encerrando.set()
+                app.config['ENCERRANDO'] = True
+                threading.Thread(target=servidor.encerrar, daemon=True).start()
+
+        signal.signal(signal.SIGTERM, parar)
+        logger.info('worker %d (pid %d) atendendo com %d threads', numero, os.getpid(), threads)
+        servidor.serve_forever()
+        servidor.pool.shutdown(wait=True)
+    except Exception:
+        logger.exception('falha no worker %d', numero)
+        codigo = 1
+    finally:
+        os._exit(codigo)
+
+
+def servir(app, host='0.0.0.0', porta=5001, workers=2, threads=8, ao_iniciar=None):
+    """
+        Inicia o mestre: abre o socket, cria `workers` processos por fork e
+        recria os que morrerem. Só funciona com `os.fork` (POSIX).
+
+        `ao_iniciar(numero)` roda em cada worker logo depois do fork, antes de
+        atender requisições (ex.: descartar as conexões herdadas do pool do banco).
+    """
+    if not hasattr(os, 'fork'):
+        raise RuntimeError('O modo com workers precisa de fork (Linux/macOS)')
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(process)d] %(name)s: %(message)s')
+    sock = abrir_socket(host, porta)
+    ativos = {}
+    estado = {'sinal': None}
+
+    def iniciar(numero):
+        pid = os.fork()
+        if pid == 0:
+            executar_worker(app, host, porta, threads, sock, numero, ao_iniciar)
+        ativos[pid] = numero
+
+    def receber_sinal(signum, frame):
+        estado['sinal'] = signum
+
+    for sinal in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+        signal.signal(sinal, receber_sinal)
+
+    for numero in range(workers):
+        iniciar(numero)
+    logger.info('mestre (pid %d) em %s:%d com %d workers', os.getpid(), host, porta, workers)
+
+    while estado['sinal'] is None:
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            pid = 0
+        if pid == 0:
+            time.sleep(0.5)
+            continue
+        # pids desconhecidos são workers de antes de um SIGHUP terminando
+        numero = ativos.pop(pid, None)
+        if numero is not None and estado['sinal'] is None:
+            logger.warning('worker %d (pid %d) saiu com status %d, iniciando outro', numero, pid, status)
+            iniciar(numero)
+
+    for pid in ativos:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+
+    if estado['sinal'] == signal.SIGHUP:
+        # os workers antigos continuam terminando as requisições deles; o
+        # socket fica com o mestre novo, que já aceita conexões
+        logger.info('recarregando o mestre')
+        os.environ[VARIAVEL_FD] = str(sock.fileno())
+        os.execv(sys.executable, [sys.executable] + sys.argv)
+
+    limite = time.monotonic() + TEMPO_ENCERRAMENTO
+    while ativos and time.monotonic() < limite:
+        try:
+            pid, _ = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            break
+        if pid == 0:
+            time.sleep(0.1)
+        else:
+            ativos.pop(pid, None)
+    for pid in ativos:
+        os.kill(pid, signal.SIGKILL)
+    sock.close()
+    logger.info('mestre encerrado')
@@ -0,0 +1,65 @@
+#configuração dos testes: banco SQLite temporário (a DATABASE_URL precisa
+#estar definida antes do primeiro uso das engines de database.py).
+import itertools
+import os
+import sys
+import tempfile
+
+import pytest
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ)
+
+PASTA_BANCO = tempfile.mkdtemp(prefix='bancoapi_testes_')
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(PASTA_BANCO, 'testes.sqlite3')
+
+# dados sintéticos do benchmark, gravados antes do primeiro teste; os CPFs
+# dos testes começam depois dos do gerador ('{:011d}'.format(id))
+TAMANHOS_SINTETICOS = {'usuarios': 300, 'livros': 800, 'emprestimos': 3000}
+SEMENTE = 42
+_cpfs = itertools.count(10 ** 9)
+
+
+def ultimo_id(coluna):
+    from sqlalchemy import select, func
+    from database import local_session
+    with local_session() as db_session:
+        return db_session.execute(select(func.max(coluna))).scalar()
+
+
+@pytest.fixture(scope='session')
+def app():
+    from benchmark import gerador
+    from app import create_app
+    gerador.popular(os.environ['DATABASE_URL'], semente=SEMENTE, **TAMANHOS_SINTETICOS)
+    return create_app({'TESTING': True, 'OPENAPI_CACHE': None})
+
+
+@pytest.fixture
+def cliente(app):
+    from cache import cache_entidades
+    cache_entidades.limpar()
+    return app.test_client()
+
+
+@pytest.fixture
+def criar_usuario(cliente):
+    from models import Usuario
+
+    def criar(telefone='18999999999'):
+        cpf = '{:011d}'.format(next(_cpfs))
+        resposta = cliente.post('/usuarios', json={'nome': 'Teste', 'cpf': cpf, 'telefone': telefone})
+        assert resposta.status_code == 200, resposta.get_json()
+        return ultimo_id(Usuario.id)
+    return criar
+
+
+@pytest.fixture
+def criar_livro(cliente):
+    from models import Livro
+
+    def criar(titulo='Livro de teste'):
+        resposta = cliente.post('/livros', json={'titulo': titulo, 'autor': 'Autor', 'isbn': '123', 'descricao': ''})
+        assert resposta.status_code == 200, resposta.get_json()
+        return ultimo_id(Livro.id_livro)
+    return criar
@@ -0,0 +1,50 @@
+from datetime import date, timedelta
+
+from test_emprestimos import emprestar
+
+
+def dados_emprestimo(cliente, id_emprestimo):
+    return cliente.get('/emprestimos/id{}'.format(id_emprestimo)).get_json()['result']['emprestimo']
+
+
+def test_emprestimo_vencido_no_cadastro_ja_sai_atrasado(cliente, criar_usuario, criar_livro):
+    from models import MULTA_DIARIA
+
+    hoje = date.today()
+    resposta = emprestar(cliente, criar_usuario(), criar_livro(), hoje - timedelta(days=10), dias=3)
+    id_emprestimo = resposta.get_json()['id_emprestimo']
+    dados = dados_emprestimo(cliente, id_emprestimo)
+    assert dados['status_atrasado'] is True
+    assert dados['multa'] == round(7 * MULTA_DIARIA, 2)
+
+    # a devolução grava a multa do dia
+    assert cliente.post('/emprestimos/devolucoes', json={'emprestimos': [id_emprestimo]}).status_code == 200
+    dados = dados_emprestimo(cliente, id_emprestimo)
+    assert dados['status_finalizado'] is True
+    assert dados['multa'] == round(7 * MULTA_DIARIA, 2)
+
+
+def test_varredura_so_grava_os_que_venceram_desde_a_ultima(cliente, criar_usuario, criar_livro):
+    from atrasos import varrer_atrasos
+    from conftest import ultimo_id
+    from database import engine
+    from models import Mudanca
+
+    # datas bem à frente, depois de todos os emprestimos dos outros testes
+    inicio = date.today() + timedelta(days=1000)
+    resposta = emprestar(cliente, criar_usuario(), criar_livro(), inicio, dias=5)
+    id_emprestimo = resposta.get_json()['id_emprestimo']
+    vencimento = inicio + timedelta(days=5)
+
+    varrer_atrasos(engine, hoje=vencimento)
+    assert dados_emprestimo(cliente, id_emprestimo)['status_atrasado'] is False
+
+    resultado = varrer_atrasos(engine, hoje=vencimento + timedelta(days=1))
+    assert resultado['atualizados'] == 1
+
+    # nos dias seguintes o emprestimo continua atrasado, a multa cresce na
+    # leitura e a varredura não regrava nada nem gera mudanças
+    seq = ultimo_id(Mudanca.seq)
+    for dias in (2, 3):
+        assert varrer_atrasos(engine, hoje=vencimento + timedelta(days=dias))['atualizados'] == 0
+    assert ultimo_id(Mudanca.seq) == seq
@@ -0,0 +1,99 @@
+import io
+import json
+
+
+class CorpoLento(io.BytesIO):
+    """Corpo NDJSON que anota quantas conexões de escrita estão em uso a cada leitura."""
+
+    def __init__(self, linhas, pool):
+        super().__init__(b''.join(json.dumps(linha).encode() + b'\n' for linha in linhas))
+        self.pool = pool
+        self.em_uso = []
+
+    def read(self, *args):
+        self.em_uso.append(self.pool.checkedout())
+        return super().read(*args)
+
+    def readline(self, *args):
+        self.em_uso.append(self.pool.checkedout())
+        return super().readline(*args)
+
+    def readinto(self, *args):
+        self.em_uso.append(self.pool.checkedout())
+        return super().readinto(*args)
+
+
+def livros(quantidade):
+    return [{'titulo': 'Bulk {}'.format(i), 'autor': 'Autor', 'isbn': '123'} for i in range(quantidade)]
+
+
+def usuarios(quantidade, inicio):
+    return [{'nome': 'Sync', 'cpf': '{:011d}'.format(inicio + i), 'telefone': '18999999999'}
+            for i in range(quantidade)]
+
+
+def enviar(cliente, rota, corpo):
+    return cliente.post(rota, input_stream=corpo, content_type='application/x-ndjson',
+                        content_length=len(corpo.getvalue()))
+
+
+def test_bulk_nao_segura_conexao_de_escrita_entre_lotes(cliente, monkeypatch):
+    import app as modulo_app
+    from database import engine
+
+    monkeypatch.setattr(modulo_app, 'TAMANHO_LOTE_VALIDACAO', 3)
+    corpo = CorpoLento(livros(10), engine.obter().pool)
+    resposta = enviar(cliente, '/livros/bulk', corpo)
+    assert resposta.status_code == 200, resposta.get_json()
+    assert resposta.get_json()['result']['inseridos'] == 10
+    assert corpo.em_uso and max(corpo.em_uso) == 0
+
+
+def test_sync_nao_segura_conexao_de_escrita_entre_lotes(cliente, monkeypatch):
+    import app as modulo_app
+    from database import engine
+
+    monkeypatch.setattr(modulo_app, 'TAMANHO_LOTE_SYNC', 3)
+    corpo = CorpoLento(usuarios(10, 90000000000), engine.obter().pool)
+    resposta = enviar(cliente, '/usuarios/sync', corpo)
+    assert resposta.status_code == 200, resposta.get_json()
+    assert resposta.get_json()['result']['inseridos'] == 10
+    assert corpo.em_uso and max(corpo.em_uso) == 0
+
+
+def test_timeout_do_pool_de_escrita_responde_503(cliente, monkeypatch):
+    from database import engine
+
+    pool = engine.obter().pool
+    monkeypatch.setattr(pool, '_timeout', 0.1)
+    # ocupa todas as conexões de escrita
+    conexoes = [engine.connect() for _ in range(pool.size())]
+    try:
+        resposta = cliente.post('/livros', json={'titulo': 'Sem vaga', 'autor': 'Autor', 'isbn': '123', 'descricao': ''})
+        assert resposta.status_code == 503
+        assert resposta.headers['Retry-After'] == '1'
+        resposta = enviar(cliente, '/livros/bulk', CorpoLento(livros(2), pool))
+        assert resposta.status_code == 503
+    finally:
+        for conexao in conexoes:
+            conexao.close()
+
+
+def test_falha_no_meio_informa_lotes_gravados(cliente, monkeypatch):
+    import app as modulo_app
+    from sqlalchemy import select, func
+    from database import local_session
+    from models import Livro
+
+    monkeypatch.setattr(modulo_app, 'TAMANHO_LOTE_VALIDACAO', 50)
+    linhas = ['titulo,autor,isbn'] + ['Parcial {:04d},Autor,123'.format(i) for i in range(600)]
+    # bytes inválidos em UTF-8 depois dos primeiros blocos lidos do stream
+    corpo = '\n'.join(linhas).encode() + b'\nInv\xe1lido,Autor,123\n'
+    resposta = cliente.post('/livros/bulk', data=corpo, content_type='text/csv')
+    assert resposta.status_code == 400
+    dados = resposta.get_json()
+    assert dados['inseridos'] > 0 and dados['inseridos'] % 50 == 0
+    assert dados['linha'] == dados['inseridos'] + 1
+    with local_session() as db_session:
+        gravados = db_session.execute(select(func.count()).where(Livro.titulo.like('Parcial %'))).scalar()
+    assert gravados == dados['inseridos']
@@ -0,0 +1,55 @@
+from cache import CacheLRU
+
+
+def test_set_depois_de_invalidar_nao_guarda_valor_antigo():
+    cache = CacheLRU()
+    # leitor: miss, pega a geração e consulta o banco
+    assert cache.get('livro', 1) is None
+    geracao = cache.geracao()
+    lido = {'id_livro': 1, 'status_emprestado': False}
+    # escrita concorrente: commit e invalidação antes do set do leitor
+    cache.invalidar('livro', 1)
+    cache.set('livro', 1, lido, geracao)
+    assert cache.get('livro', 1) is None
+    assert cache.estatisticas()['descartados'] == 1
+
+    # a próxima leitura, feita depois da invalidação, é guardada
+    geracao = cache.geracao()
+    cache.set('livro', 1, {'id_livro': 1, 'status_emprestado': True}, geracao)
+    assert cache.get('livro', 1)['status_emprestado'] is True
+
+
+def test_invalidar_outra_chave_nao_descarta():
+    cache = CacheLRU()
+    geracao = cache.geracao()
+    cache.invalidar('livro', 2)
+    cache.set('livro', 1, {'id_livro': 1}, geracao)
+    assert cache.get('livro', 1) == {'id_livro': 1}
+
+
+def test_chave_removida_do_controle_vale_pelo_piso():
+    cache = CacheLRU(tamanho_maximo=2)
+    geracao = cache.geracao()
+    cache.invalidar('livro', 1)
+    cache.invalidar('livro', 2, 3)
+    # a invalidação do livro 1 saiu do dicionário, mas o piso ainda barra o valor antigo
+    cache.set('livro', 1, {'id_livro': 1}, geracao)
+    assert cache.get('livro', 1) is None
+
+
+def test_leitura_da_rota_com_invalidacao_no_meio(cliente, criar_livro, monkeypatch):
+    import app as modulo_app
+    from cache import cache_entidades
+
+    id_livro = criar_livro()
+    original = modulo_app.Livro.serialize_livro
+
+    def serializar_e_invalidar(livro):
+        # simula uma escrita que faz commit entre a consulta e o set
+        dados = original(livro)
+        cache_entidades.invalidar('livro', id_livro)
+        return dados
+
+    monkeypatch.setattr(modulo_app.Livro, 'serialize_livro', serializar_e_invalidar)
+    assert cliente.get('/livros/id{}'.format(id_livro)).status_code == 200
+    assert cache_entidades.get('livro', id_livro) is None
@@ -0,0 +1,106 @@
+from datetime import date, timedelta
+
+
+def emprestar(cliente, id_usuario, id_livro, inicio, dias=7):
+    return cliente.post('/emprestimos', json={
+        'id_usuario': id_usuario, 'id_livro': id_livro, 'data_emprestimo': inicio.isoformat(),
+        'tempo_emprestimo': dias, 'tipo_tempo': 'd'})
+
+
+def status_livro(cliente, id_livro):
+    return cliente.get('/livros/id{}'.format(id_livro)).get_json()['result']['status_emprestado']
+
+
+def test_reserva_futura_nao_marca_livro_como_emprestado(cliente, criar_usuario, criar_livro):
+    from atrasos import marcar_reservas_iniciadas
+    from database import engine
+
+    id_usuario, id_livro = criar_usuario(), criar_livro()
+    inicio = date.today() + timedelta(days=10)
+    resposta = emprestar(cliente, id_usuario, id_livro, inicio)
+    assert resposta.status_code == 200, resposta.get_json()
+    assert status_livro(cliente, id_livro) is False
+    # o período continua ocupado para outra reserva
+    assert emprestar(cliente, id_usuario, id_livro, inicio + timedelta(days=2)).status_code == 409
+
+    marcar_reservas_iniciadas(engine, hoje=inicio - timedelta(days=1))
+    assert status_livro(cliente, id_livro) is False
+    marcar_reservas_iniciadas(engine, hoje=inicio)
+    assert status_livro(cliente, id_livro) is True
+
+
+def test_emprestimo_de_hoje_marca_livro(cliente, criar_usuario, criar_livro):
+    id_livro = criar_livro()
+    assert emprestar(cliente, criar_usuario(), id_livro, date.today()).status_code == 200
+    assert status_livro(cliente, id_livro) is True
+
+
+def test_devolucao_libera_livro_com_reserva_futura(cliente, criar_usuario, criar_livro):
+    id_usuario, id_livro = criar_usuario(), criar_livro()
+    atual = emprestar(cliente, id_usuario, id_livro, date.today(), dias=3).get_json()['id_emprestimo']
+    assert emprestar(cliente, id_usuario, id_livro, date.today() + timedelta(days=20)).status_code == 200
+
+    resposta = cliente.post('/emprestimos/devolucoes', json={'emprestimos': [atual]})
+    assert resposta.status_code == 200, resposta.get_json()
+    assert status_livro(cliente, id_livro) is False
+
+
+def test_livro_ja_marcado_como_emprestado_responde_409(cliente, criar_usuario, criar_livro):
+    from sqlalchemy import update
+    from database import local_session
+    from models import Livro
+
+    id_usuario, id_livro = criar_usuario(), criar_livro()
+    # marcado por outro pedido que ainda não gravou o emprestimo: só o
+    # compare-and-set do UPDATE barra o segundo emprestimo
+    with local_session() as db_session:
+        db_session.execute(update(Livro).where(Livro.id_livro == id_livro).values(status_emprestado=True))
+        db_session.commit()
+
+    resposta = emprestar(cliente, id_usuario, id_livro, date.today())
+    assert resposta.status_code == 409
+    assert 'proxima_data_livre' in resposta.get_json()
+    # uma reserva futura não depende da marcação de hoje
+    assert emprestar(cliente, id_usuario, id_livro, date.today() + timedelta(days=30)).status_code == 200
+
+
+def test_livro_inativo_responde_400(cliente, criar_usuario, criar_livro):
+    from sqlalchemy import update
+    from database import local_session
+    from models import Livro
+
+    id_livro = criar_livro()
+    with local_session() as db_session:
+        db_session.execute(update(Livro).where(Livro.id_livro == id_livro).values(livro_ativo=False))
+        db_session.commit()
+    assert emprestar(cliente, criar_usuario(), id_livro, date.today()).status_code == 400
+
+
+def test_edicao_e_devolucao_pela_fila_de_escrita(app, cliente, criar_usuario, criar_livro, monkeypatch):
+    from escrita import FilaEscrita
+
+    fila = FilaEscrita()
+    monkeypatch.setitem(app.extensions, 'fila_escrita', fila)
+    id_usuario, id_livro = criar_usuario(), criar_livro()
+    primeiro = emprestar(cliente, id_usuario, id_livro, date.today(), dias=3).get_json()['id_emprestimo']
+    assert cliente.put('/emprestimos/{}'.format(primeiro), json={'status': '1'}).status_code == 200
+    assert status_livro(cliente, id_livro) is False
+
+    segundo = emprestar(cliente, id_usuario, id_livro, date.today()).get_json()['id_emprestimo']
+    # reabrir o primeiro esbarra no segundo e não deixa nada gravado
+    resposta = cliente.put('/emprestimos/{}'.format(primeiro), json={'status': '0'})
+    assert resposta.status_code == 409
+    assert 'proxima_data_livre' in resposta.get_json()
+
+    resposta = cliente.post('/emprestimos/devolucoes', json={'emprestimos': [segundo]})
+    assert resposta.status_code == 200, resposta.get_json()
+    assert status_livro(cliente, id_livro) is False
+    assert cliente.put('/emprestimos/{}'.format(primeiro), json={'status': '0'}).status_code == 200
+    assert status_livro(cliente, id_livro) is True
+    assert cliente.put('/emprestimos/{}'.format(10 ** 9), json={'status': '1'}).status_code == 400
+
+    outro = criar_livro()
+    assert cliente.put('/livros/{}'.format(outro), json={'livro_ativo': False}).status_code == 200
+    assert emprestar(cliente, id_usuario, outro, date.today()).status_code == 400
+    assert cliente.put('/usuarios/{}'.format(id_usuario), json={'telefone': '11987654321'}).status_code == 200
+    assert fila.operacoes >= 10
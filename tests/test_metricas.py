@@ -0,0 +1,32 @@
+import threading
+
+import pytest
+from sqlalchemy import text
+
+
+def test_comando_com_erro_nao_deixa_inicio_na_conexao(app):
+    from database import engine
+
+    with engine.connect() as conn:
+        for _ in range(5):
+            with pytest.raises(Exception):
+                conn.execute(text('SELECT * FROM tabela_que_nao_existe'))
+        conn.execute(text('SELECT 1'))
+        assert 'metricas_inicio' not in conn.info
+
+
+def test_consultas_fora_de_requisicao_contadas_sem_perder_incrementos(app):
+    from metricas import metricas
+
+    antes = metricas.sql_consultas_fora_requisicao
+
+    def registrar():
+        for _ in range(10000):
+            metricas.registrar_sql_fora_requisicao()
+
+    threads = [threading.Thread(target=registrar) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert metricas.sql_consultas_fora_requisicao - antes == 40000
@@ -0,0 +1,17 @@
+def test_rotas_sem_varredura_completa(app):
+    from benchmark.executor import CENARIOS
+    from benchmark.planos import verificar, varreduras_proibidas, descrever
+    from cache import cache_entidades
+    from conftest import TAMANHOS_SINTETICOS, SEMENTE
+    from database import engine, engine_leitura
+
+    # com estatísticas o planejador escolhe os índices como em produção
+    with engine.begin() as conn:
+        conn.exec_driver_sql('ANALYZE')
+    # sem cache, para que as leituras por id cheguem ao banco
+    cache_entidades.limpar()
+
+    resultado = verificar(app, {engine.obter(), engine_leitura.obter()}, CENARIOS, TAMANHOS_SINTETICOS, SEMENTE)
+    assert len(resultado) == len(CENARIOS)
+    falhas = varreduras_proibidas(resultado)
+    assert not falhas, '\n'.join(descrever(rota, sql, plano) for rota, sql, plano, _ in falhas)
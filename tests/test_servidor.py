@@ -0,0 +1,65 @@
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+import urllib.request
+
+import pytest
+
+from conftest import RAIZ, PASTA_BANCO
+
+pytestmark = pytest.mark.skipif(not hasattr(os, 'fork'), reason='o servidor com workers precisa de fork')
+
+
+def porta_livre():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def requisitar(base, caminho, metodo='GET', corpo=None):
+    dados = json.dumps(corpo).encode() if corpo is not None else None
+    req = urllib.request.Request(base + caminho, data=dados, method=metodo,
+                                 headers={'Content-Type': 'application/json'} if dados else {})
+    with urllib.request.urlopen(req, timeout=10) as resposta:
+        return json.loads(resposta.read())
+
+
+@pytest.fixture
+def servidor():
+    porta = porta_livre()
+    ambiente = dict(os.environ, DATABASE_URL='sqlite:///' + os.path.join(PASTA_BANCO, 'workers.sqlite3'),
+                    VARREDURA_INTERVALO='0')
+    processo = subprocess.Popen([sys.executable, 'app.py', '--workers', '3', '--threads', '2',
+                                 '--host', '127.0.0.1', '--porta', str(porta)],
+                                cwd=RAIZ, env=ambiente, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    base = 'http://127.0.0.1:{}'.format(porta)
+    limite = time.monotonic() + 15
+    while True:
+        try:
+            requisitar(base, '/pronto')
+            break
+        except OSError:
+            if time.monotonic() > limite:
+                processo.kill()
+                raise
+            time.sleep(0.1)
+    yield base
+    processo.send_signal(signal.SIGTERM)
+    processo.wait(timeout=40)
+
+
+def test_escrita_em_um_worker_invalida_o_cache_dos_outros(servidor):
+    requisitar(servidor, '/livros', 'POST', {'titulo': 'Antes', 'autor': 'Autor', 'isbn': '1', 'descricao': ''})
+    id_livro = requisitar(servidor, '/livros?limit=1000')['result'][-1]['id_livro']
+
+    # cada urlopen é uma conexão nova, então as leituras se espalham pelos workers
+    for _ in range(30):
+        assert requisitar(servidor, '/livros/id{}'.format(id_livro))['result']['titulo'] == 'Antes'
+
+    requisitar(servidor, '/livros/{}'.format(id_livro), 'PUT', {'titulo': 'Depois'})
+    titulos = {requisitar(servidor, '/livros/id{}'.format(id_livro))['result']['titulo'] for _ in range(30)}
+    assert titulos == {'Depois'}
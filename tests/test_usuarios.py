@@ -0,0 +1,36 @@
+def test_sync_depois_do_cadastro_com_os_mesmos_dados_nao_altera(cliente):
+    from conftest import ultimo_id
+    from models import Mudanca
+
+    usuario = {'nome': 'Ida e volta', 'cpf': '55544433322', 'telefone': '18912345678'}
+    assert cliente.post('/usuarios', json=usuario).status_code == 200
+    seq = ultimo_id(Mudanca.seq)
+
+    resposta = cliente.post('/usuarios/sync', json=[usuario])
+    assert resposta.status_code == 200, resposta.get_json()
+    assert resposta.get_json()['result'] == {'inseridos': 0, 'atualizados': 0, 'inalterados': 1, 'erros': []}
+    assert ultimo_id(Mudanca.seq) == seq
+
+
+def test_telefone_normalizado_no_cadastro_e_na_edicao(cliente, criar_usuario):
+    id_usuario = criar_usuario(telefone='18912345678')
+    assert cliente.get('/usuarios/id{}'.format(id_usuario)).get_json()['result']['telefone'] == '18 91234-5678'
+
+    assert cliente.put('/usuarios/{}'.format(id_usuario), json={'telefone': '11987654321'}).status_code == 200
+    assert cliente.get('/usuarios/id{}'.format(id_usuario)).get_json()['result']['telefone'] == '11 98765-4321'
+
+
+def test_cpf_com_pontuacao_aceito_no_cadastro_e_na_edicao(cliente):
+    from conftest import ultimo_id
+    from models import Usuario
+
+    resposta = cliente.post('/usuarios', json={'nome': 'Pontuado', 'cpf': '111.222.333-44', 'telefone': '18912345678'})
+    assert resposta.status_code == 200, resposta.get_json()
+    id_usuario = ultimo_id(Usuario.id)
+    assert cliente.get('/usuarios/id{}'.format(id_usuario)).get_json()['result']['cpf'] == '111.222.333-44'
+    # o mesmo CPF sem pontuação é o mesmo usuario
+    assert cliente.post('/usuarios', json={'nome': 'Outro', 'cpf': '11122233344', 'telefone': '1'}).status_code == 400
+
+    assert cliente.put('/usuarios/{}'.format(id_usuario), json={'cpf': '111.222.333-55'}).status_code == 200
+    assert cliente.get('/usuarios/id{}'.format(id_usuario)).get_json()['result']['cpf'] == '111.222.333-55'
+    assert cliente.put('/usuarios/{}'.format(id_usuario), json={'cpf': '123'}).status_code == 400